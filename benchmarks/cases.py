@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+#####################################################
+# Benchmarks of ingest, detection and storage steps #
+#####################################################
+
+# Every case gets the lines of a synthetic CSV (purple.synthetic) and
+# returns a Result: rows handled, the time they took and the latency of
+# every operation (a row, a batch, a prediction...). run.py runs each
+# case in its own process so its peak memory is its own.
+#
+# Cases with `db=True` write to PostgreSQL (and rethinkdb, through
+# TradesAnalyser): run them on a scratch database, their trades are
+# deleted afterwards but the synthetic symbols and traders are kept.
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from purple.finance import Trade
+from purple.tracing import LatencyHistogram
+
+# csv_hash of the trades written by the db cases
+BENCHMARK_HASH = 'benchmark'
+# Trades of a symbol per prediction
+PREDICT_WINDOW = 500
+# Trades per bulk insert
+WRITE_BATCH = 2500
+
+
+class Result:
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+        self.latency = LatencyHistogram()
+
+    def timed(self, function, *args):
+        '''
+        Call function once, recording the time it took
+        '''
+        started = time.time()
+        value = function(*args)
+        elapsed = time.time() - started
+        self.seconds += elapsed
+        self.latency.record(elapsed)
+        return value
+
+    def metrics(self):
+        return {
+            'rows': self.rows,
+            'seconds': self.seconds,
+            'rows_per_second': self.rows / self.seconds if self.seconds else 0.0,
+            'operations': self.latency.count,
+            'p50_ms': self.latency.quantile(0.5) * 1000,
+            'p99_ms': self.latency.quantile(0.99) * 1000,
+            'p999_ms': self.latency.quantile(0.999) * 1000
+        }
+
+
+# name -> (function, needs the databases)
+CASES = {}
+
+
+def case(name, db=False):
+    def register(function):
+        CASES[name] = (function, db)
+        return function
+    return register
+
+
+def parsed(lines):
+    trades = [Trade(line) for line in lines]
+    return [t for t in trades if not t.parse_err]
+
+
+@case('parse')
+def parse(lines):
+    result = Result()
+    for line in lines:
+        result.timed(Trade, line)
+    result.rows = len(lines)
+    return result
+
+
+@case('first_day')
+def first_day(lines):
+    from purple.anomalous_trade_finder import AnomalousTradeFinder
+
+    trades = parsed(lines)
+    finder = AnomalousTradeFinder(persist=False)
+    result = Result()
+    for i, t in enumerate(trades):
+        result.timed(finder.add, t, i)
+    result.timed(finder.calculate_anomalies_first_day, True)
+    result.rows = len(trades)
+    return result
+
+
+@case('single_trade')
+def single_trade(lines):
+    from purple.anomalous_trade_finder import AnomalousTradeFinder
+
+    # The first half is the history the second is checked against
+    trades = parsed(lines)
+    half = len(trades) // 2
+    finder = AnomalousTradeFinder(persist=False)
+    for i, t in enumerate(trades[:half]):
+        finder.add(t, i)
+    finder.calculate_anomalies_first_day(True)
+    result = Result()
+    for i, t in enumerate(trades[half:]):
+        result.timed(finder.calculate_anomalies_single_trade, t, half + i)
+    result.rows = len(trades) - half
+    return result
+
+
+@case('predict')
+def predict(lines):
+    from predictions import predict
+
+    by_symbol = {}
+    for t in parsed(lines):
+        by_symbol.setdefault(t.symbol, []).append(t)
+    result = Result()
+    for trades in by_symbol.values():
+        for start in range(0, len(trades) - 1, PREDICT_WINDOW):
+            window = trades[start:start + PREDICT_WINDOW]
+            if len(window) > 1:
+                result.timed(predict, window)
+                result.rows += len(window)
+    return result
+
+
+def delete_benchmark_trades():
+    from purple import db
+
+    db.session.query(db.TradeModel).filter_by(csv_hash=BENCHMARK_HASH).delete()
+    db.session.commit()
+
+
+@case('analyser_add', db=True)
+def analyser_add(lines):
+    from purple.analysis import TradesAnalyser
+
+    trades = parsed(lines)
+    analyser = TradesAnalyser()
+    result = Result()
+    try:
+        for t in trades:
+            result.timed(analyser.add, t, BENCHMARK_HASH, True, True)
+        result.timed(analyser.force_commit)
+    finally:
+        delete_benchmark_trades()
+    result.rows = len(trades)
+    return result
+
+
+@case('batch_writes', db=True)
+def batch_writes(lines):
+    from datetime import date
+    from purple import db
+
+    trades = parsed(lines)
+    for symbol, sector in set((t.symbol, t.sector) for t in trades):
+        db.SymbolModel.get_or_create(symbol, sector)
+    db.session.commit()
+    ids = db.reserve_trade_ids(len(trades))
+    rows = [{
+        'id': pk, 'price': t.price, 'bid': t.bid, 'ask': t.ask, 'size': t.size,
+        'symbol_name': t.symbol, 'flagged': False, 'analysis_date': date.today(),
+        'csv_hash': BENCHMARK_HASH, 'datetime': t.time
+    } for pk, t in zip(ids, trades)]
+
+    def write(batch):
+        db.session.bulk_insert_mappings(db.TradeModel, batch)
+        db.session.commit()
+
+    result = Result()
+    try:
+        for start in range(0, len(rows), WRITE_BATCH):
+            result.timed(write, rows[start:start + WRITE_BATCH])
+    finally:
+        delete_benchmark_trades()
+    result.rows = len(rows)
+    return result
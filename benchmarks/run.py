@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###################################################
+# Benchmarks compared to a baseline (exit code 1) #
+###################################################
+
+# Runs every case of cases.py a few times, each in a new process, over
+# the same seeded synthetic trades, and the cold starts of startup.py.
+# Reports rows per second, peak memory and latency percentiles of the
+# fastest run, then compares them to baseline.json: fewer rows per
+# second or more memory than `tolerance` allows is a regression, as is
+# a start over its budget or 50% slower than the baseline.
+#
+#   python benchmarks/run.py                 -> exit code 1 on a regression
+#   python benchmarks/run.py --only parse predict
+#   python benchmarks/run.py --db            -> also the cases writing to the dbs
+#   python benchmarks/run.py --save          -> results become the baseline
+
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import cases
+import startup
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# Synthetic trades handled by every case, and their seed
+TRADES = 50000
+SEED = 0
+# Part of the baseline a result may be worse by
+TOLERANCE = 0.3
+# Cold starts vary more (disk cache), and have budgets too
+STARTUP_TOLERANCE = 0.5
+# Runs of every case, the fastest is kept
+REPEAT = 5
+
+
+def write_trades(path, trades=TRADES, seed=SEED):
+    sys.path.insert(0, ROOT)
+    from purple.synthetic import generate
+    with open(path, 'w') as f:
+        generate(f, trades=trades, seed=seed)
+
+
+def run_case(name, path, out):
+    '''
+    In the child process: run a case over the lines at
+    path and write its metrics to out
+    '''
+    function, _ = cases.CASES[name]
+    with open(path) as f:
+        lines = f.read().split('\n')[1:-1]
+    metrics = function(lines).metrics()
+    # kilobytes on Linux
+    metrics['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    with open(out, 'w') as f:
+        json.dump(metrics, f)
+
+
+def measure(name, path, repeat=REPEAT):
+    '''
+    Run a case `repeat` times, each in a new process,
+    returns the metrics of the fastest run
+    '''
+    runs = [measure_once(name, path) for _ in range(repeat)]
+    return max(runs, key=lambda metrics: metrics['rows_per_second'])
+
+
+def measure_once(name, path):
+    handle, out = tempfile.mkstemp(prefix='purple-benchmark-', suffix='.json')
+    os.close(handle)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, os.path.abspath(__file__), '--child', name, path, out],
+                cwd=ROOT, stdout=devnull
+            )
+        with open(out) as f:
+            return json.load(f)
+    finally:
+        os.remove(out)
+
+
+def regressions(results, baseline, trades, tolerance=TOLERANCE):
+    '''
+    Descriptions of the results of a run over `trades`
+    trades worse than the baseline, or over budget
+    '''
+    found = []
+    for name, result in sorted(results.items()):
+        if 'median_ms' in result and result['median_ms'] > result['budget_ms']:
+            found.append('{}: {:.1f}ms to start, budget {:.0f}ms'.format(name, result['median_ms'], result['budget_ms']))
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        if 'median_ms' in result:
+            if result['median_ms'] > base['median_ms'] * (1 + max(tolerance, STARTUP_TOLERANCE)):
+                found.append('{}: {:.1f}ms to start, baseline {:.1f}ms'.format(name, result['median_ms'], base['median_ms']))
+            continue
+        # Runs over a different number of trades don't compare
+        if baseline.get('trades') != trades:
+            continue
+        if result['rows_per_second'] < base['rows_per_second'] * (1 - tolerance):
+            found.append('{}: {:.0f} rows/s, baseline {:.0f}'.format(name, result['rows_per_second'], base['rows_per_second']))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            found.append('{}: {:.0f}MB peak, baseline {:.0f}MB'.format(name, result['peak_rss_mb'], base['peak_rss_mb']))
+    return found
+
+
+def report(name, result):
+    if 'median_ms' in result:
+        print '{:<24} {:>12} {:>9} {:>9.1f}ms (budget {:.0f}ms)'.format(
+            name, '', '', result['median_ms'], result['budget_ms']
+        )
+        return
+    print '{:<24} {:>10.0f}/s {:>7.0f}MB {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+        name, result['rows_per_second'], result['peak_rss_mb'],
+        result['p50_ms'], result['p99_ms'], result['p999_ms']
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of ingest, detection and storage')
+    parser.add_argument('--only', nargs='+', metavar='CASE', help='Cases to run (startup for the cold starts).')
+    parser.add_argument('--db', action='store_true', help='Also run the cases writing to the databases.')
+    parser.add_argument('--trades', type=int, default=TRADES, help='Synthetic trades. (default: {})'.format(TRADES))
+    parser.add_argument('--seed', type=int, default=SEED, help='(default: {})'.format(SEED))
+    parser.add_argument(
+        '--repeat', type=int, default=REPEAT,
+        help='Runs of every case, the fastest counts. (default: {})'.format(REPEAT)
+    )
+    parser.add_argument(
+        '--tolerance', type=float, default=TOLERANCE,
+        help='Part of the baseline a result may be worse by. (default: {})'.format(TOLERANCE)
+    )
+    parser.add_argument('--baseline', default=BASELINE, help='(default: benchmarks/baseline.json)')
+    parser.add_argument('--save', action='store_true', help='Store the results as the baseline.')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_case(*args.child)
+        return
+
+    names = args.only or sorted(cases.CASES) + ['startup']
+    unknown = [name for name in names if name not in cases.CASES and name != 'startup']
+    if unknown:
+        parser.error('Unknown cases: {}'.format(', '.join(unknown)))
+
+    results = {}
+    failed = []
+    print '{:<24} {:>12} {:>9} {:>9} {:>9} {:>9}'.format('case', 'rows', 'peak rss', 'p50 ms', 'p99 ms', 'p999 ms')
+    handle, path = tempfile.mkstemp(prefix='purple-benchmark-', suffix='.csv')
+    os.close(handle)
+    try:
+        write_trades(path, args.trades, args.seed)
+        for name in names:
+            if name == 'startup' or name not in cases.CASES:
+                continue
+            if cases.CASES[name][1] and not args.db:
+                print '{:<24} skipped, needs the databases (--db)'.format(name)
+                continue
+            try:
+                results[name] = measure(name, path, args.repeat)
+            except subprocess.CalledProcessError, e:
+                print '{:<24} failed (exit code {})'.format(name, e.returncode)
+                failed.append(name)
+                continue
+            report(name, results[name])
+    finally:
+        os.remove(path)
+
+    if 'startup' in names:
+        for name, (median, budget) in sorted(startup.run().items()):
+            results['startup:' + name] = {'median_ms': median, 'budget_ms': budget}
+            report('startup:' + name, results['startup:' + name])
+
+    if failed:
+        print '\nFailed: {}'.format(', '.join(failed))
+        sys.exit(1)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'trades': args.trades, 'results': results}, f, indent=2, sort_keys=True, separators=(',', ': '))
+            f.write('\n')
+        print '\nBaseline written to {}'.format(args.baseline)
+        return
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    found = regressions(results, baseline, args.trades, args.tolerance)
+    if found:
+        print '\nRegressions:\n  ' + '\n  '.join(found)
+        sys.exit(1)
+    print '\nNo regression against {}'.format(args.baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###################################
+# Cold start time of main.py runs #
+###################################
+
+# Every case is run in a fresh interpreter a few times and its median wall
+# time compared to a budget. Commands that need the databases are measured
+# up to the point they would connect: importing what they load.
+#
+#   python benchmarks/startup.py            -> exit code 1 if over budget
+#   python benchmarks/startup.py --scale 2  -> on a slower machine
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (arguments of python, budget in ms)
+CASES = [
+    ('help', (['main.py', '--help'], 150)),
+    ('init-db', (['-c', 'import purple.app'], 1000)),
+    ('file', (['-c', 'import purple.app, purple.analysis, purple.spill, purple.archive'], 1500)),
+    ('stream', (['-c', 'import purple.app, purple.analysis, purple.pipeline'], 1500)),
+    ('backtest', (['-c', 'import purple.app, purple.backtest'], 1500)),
+    ('daemon', (['-c', 'import purple.daemon; purple.daemon.preload()'], 2000)),
+]
+RUNS = 5
+
+
+def cold_start(args, runs=RUNS):
+    '''
+    Median wall time in ms of `python args` in a new process
+    '''
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.check_call([sys.executable] + args, cwd=ROOT, stdout=devnull)
+            times.append((time.time() - started) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def run(cases=CASES, runs=RUNS, scale=1.0):
+    '''
+    Measure every case, returns {name: (median ms, budget ms)}
+    '''
+    results = {}
+    for name, (args, budget) in cases:
+        results[name] = (cold_start(args, runs), budget * scale)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start time of main.py commands')
+    parser.add_argument('--runs', type=int, default=RUNS, help='Runs per case. (default: {})'.format(RUNS))
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply every budget by SCALE.')
+    args = parser.parse_args()
+
+    over = 0
+    results = run(runs=args.runs, scale=args.scale)
+    for name, _ in CASES:
+        median, budget = results[name]
+        status = 'ok' if median <= budget else 'OVER BUDGET'
+        over += median > budget
+        print '{:<10} {:>8.1f}ms  (budget {:.0f}ms)  {}'.format(name, median, budget, status)
+    sys.exit(1 if over else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+'use strict'
+
+const crypto = require('crypto');
+const r = require('rethinkdb');
+
+/*
+ * Most bytes of response bodies held at once
+ */
+const MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+/*
+ * Milliseconds before changefeeds that failed are opened again
+ */
+const WATCH_RETRY_INTERVAL = 5000
+
+/*
+ * Responses of the API kept in memory until the data they were read
+ * from changes. Every response is stored with tags ('symbols',
+ * 'symbol:AV.L', 'alerts'...) and invalidate(tag) drops those with
+ * the tag. Least recently used responses are dropped first once
+ * their bodies take more than maxBytes.
+ */
+class ResponseCache {
+    constructor(maxBytes = MAX_CACHE_BYTES) {
+        this.maxBytes = maxBytes
+        this.bytes = 0
+        // key -> { body, etag, tags, type }, a Map iterates in insertion order
+        this.entries = new Map()
+        // tag -> Set of keys
+        this.tagged = new Map()
+        // tag -> this.clock when it was last invalidated, to spot
+        // responses read before
+        this.invalidated = new Map()
+        this.clock = 0
+        this.cleared = 0
+        // Only once changes are followed, see watch()
+        this.enabled = false
+        this.hits = 0
+        this.misses = 0
+    }
+
+    get(key) {
+        const entry = this.entries.get(key)
+        if (entry) {
+            // Most recently used last
+            this.entries.delete(key)
+            this.entries.set(key, entry)
+        }
+        return entry
+    }
+
+    set(key, body, tags, type = 'application/json') {
+        const size = Buffer.byteLength(body)
+        if (size > this.maxBytes / 4) {
+            return null
+        }
+        this.delete(key)
+        const etag = `"${crypto.createHash('sha1').update(body).digest('base64')}"`
+        const entry = { body, etag, tags, size, type }
+        this.entries.set(key, entry)
+        this.bytes += size
+        tags.forEach((tag) => {
+            if (!this.tagged.has(tag)) {
+                this.tagged.set(tag, new Set())
+            }
+            this.tagged.get(tag).add(key)
+        })
+        // Evict least recently used
+        const keys = this.entries.keys()
+        while (this.bytes > this.maxBytes) {
+            this.delete(keys.next().value)
+        }
+        return entry
+    }
+
+    delete(key) {
+        const entry = this.entries.get(key)
+        if (!entry) {
+            return
+        }
+        this.entries.delete(key)
+        this.bytes -= entry.size
+        entry.tags.forEach((tag) => {
+            const keys = this.tagged.get(tag)
+            keys.delete(key)
+            if (!keys.size) {
+                this.tagged.delete(tag)
+            }
+        })
+    }
+
+    // Whether none of the tags was invalidated after the clock was at since
+    unchangedSince(tags, since) {
+        return this.cleared <= since &&
+            tags.every(tag => (this.invalidated.get(tag) || 0) <= since)
+    }
+
+    invalidate(tag) {
+        this.clock += 1
+        this.invalidated.set(tag, this.clock)
+        const keys = this.tagged.get(tag)
+        if (keys) {
+            Array.from(keys).forEach(key => this.delete(key))
+        }
+    }
+
+    clear() {
+        this.clock += 1
+        this.cleared = this.clock
+        this.entries.clear()
+        this.tagged.clear()
+        this.bytes = 0
+    }
+
+    metrics() {
+        return {
+            entries: this.entries.size,
+            bytes: this.bytes,
+            hits: this.hits,
+            misses: this.misses,
+        }
+    }
+
+    /*
+     * Express middleware answering from the cache, or storing what the
+     * handler sends with res.json(). tags(req) lists the tags of the
+     * response, handlers only finding them with their query add them to
+     * res.locals.cacheTags before sending. GET responses carry an ETag and a request with a
+     * matching If-None-Match gets a 304 without a body.
+     */
+    middleware(tags) {
+        return (req, res, next) => {
+            if (!this.enabled) {
+                next()
+                return
+            }
+            // Trades are sent as rows or columns depending on Accept
+            const key = req.method === 'GET'
+                ? `${req.originalUrl} ${req.get('Accept')}`
+                : `${req.method} ${req.originalUrl} ${JSON.stringify(req.body)}`
+            const send = (entry) => {
+                res.set('Content-Type', entry.type)
+                res.vary('Accept')
+                if (req.method === 'GET') {
+                    res.set('ETag', entry.etag)
+                    if (req.get('If-None-Match') === entry.etag) {
+                        res.status(304).end()
+                        return
+                    }
+                }
+                res.send(entry.body)
+            }
+
+            const entry = this.get(key)
+            if (entry) {
+                this.hits += 1
+                send(entry)
+                return
+            }
+            this.misses += 1
+
+            const started = this.clock
+            const json = res.json.bind(res)
+            res.json = (data) => {
+                const responseTags = tags(req).concat(res.locals.cacheTags || [])
+                // Only successful reads of data unchanged since the request started
+                if (res.statusCode !== 200 || (data && data.success === false) ||
+                        !this.unchangedSince(responseTags, started)) {
+                    return json(data)
+                }
+                const type = res.get('Content-Type') || 'application/json'
+                const stored = this.set(key, JSON.stringify(data), responseTags, type)
+                if (!stored) {
+                    return json(data)
+                }
+                return send(stored)
+            }
+            next()
+        }
+    }
+
+    /*
+     * Invalidate responses when the ingest commits trades of a symbol
+     * (symbol_versions table) or any alert or counter changes. The list
+     * of symbols only changes with a new listed_at: the symbol was added
+     * or its characteristics were updated. Nothing
+     * is cached before every changefeed is open nor after one of them fails
+     * (e.g. tables dropped by a db reset), they are opened again later.
+     */
+    watch(conn) {
+        const cursors = []
+        let failed = false
+        const fail = (err) => {
+            console.error(err);
+            if (failed) {
+                return
+            }
+            failed = true
+            this.disable()
+            cursors.forEach(cursor => cursor.close())
+            setTimeout(() => this.watch(conn), WATCH_RETRY_INTERVAL)
+        }
+        const feeds = [
+            [r.table('symbol_versions'), (change) => {
+                const { old_val: before, new_val: after } = change
+                this.invalidate(`symbol:${(after || before).id}`)
+                if (!before || !after || String(before.listed_at) !== String(after.listed_at)) {
+                    this.invalidate('symbols')
+                }
+            }],
+            [r.table('alerts'), () => this.invalidate('alerts')],
+            [r.table('alert_counts'), () => this.invalidate('alert_counts')],
+        ]
+        feeds.forEach(([query, onChange]) => {
+            query.changes().run(conn, (feedErr, cursor) => {
+                if (feedErr) {
+                    fail(feedErr)
+                    return
+                }
+                if (failed) {
+                    cursor.close()
+                    return
+                }
+                cursors.push(cursor)
+                this.enabled = cursors.length === feeds.length
+                cursor.each((err, change) => {
+                    if (err) {
+                        fail(err)
+                        return false
+                    }
+                    onChange(change)
+                    return true
+                })
+            })
+        })
+    }
+
+    disable() {
+        this.enabled = false
+        this.clear()
+    }
+}
+
+module.exports = {
+    ResponseCache,
+    MAX_CACHE_BYTES,
+}
@@ -1,6 +1,7 @@
 
 const r = require('rethinkdb');
 const pgp = require('pg-promise')({});
+const { COLUMNS_TYPE, encodeTrades } = require('./src/columns');
 
 const dbConfig = {
     host: 'localhost',
@@ -19,6 +20,22 @@ const handleException = (err, res, reason) => {
         .json({ success: false, reason })
 }
 
+/*
+ * Answer with trade rows, or as columns (see src/columns.js)
+ * to clients accepting them
+ */
+const sendTrades = (req, res, trades, status = 200) => {
+    res.vary('Accept')
+    if (req.accepts(['application/json', COLUMNS_TYPE]) === COLUMNS_TYPE) {
+        res.status(status)
+            .type(COLUMNS_TYPE)
+            .json({ success: true, columns: encodeTrades(trades) })
+        return
+    }
+    res.status(status)
+        .json({ success: true, trades })
+}
+
 const getSymbols = (req, res) => {
     db.any('SELECT * FROM symbols ORDER BY name')
     .then((symbols) => {
@@ -44,78 +61,114 @@ const getSymbol = (req, res) => {
             ) AS derivedTable ORDER BY datetime ASC`,
         { tradeFields, symbol })
         .then((trades) => {
-            res.status(200)
-                .json({
-                    success: true,
-                    trades
-                })
+            sendTrades(req, res, trades)
         })
         .catch(err => handleException(err, res))
     }
 }
 
+// Most trades returned for a time range
+const MAX_CONTEXT_TRADES = 10000
+
 const getFlaggedTrades = (req, res) => {
     const tradeid = req.params.tradeid
     if (tradeid != null) {
-        // try and get initial trade
-        db.oneOrNone('SELECT id, symbol_name FROM trades WHERE id = $1', tradeid)
-        .then((trade) => {
-            if (trade != null) {
-                // get some trades on each side of flagged trade
-                db.any(
-                    `SELECT * FROM (
-                        (
-                            SELECT $(tradeFields^) FROM trades
-                            WHERE id <= $(tradeid) AND symbol_name = $(symbol_name)
-                            ORDER BY datetime DESC LIMIT 201
-                        )
-                        UNION
-                        (
-                            SELECT $(tradeFields^) FROM trades
-                            WHERE id > $(tradeid) AND symbol_name = $(symbol_name)
-                            ORDER BY datetime ASC LIMIT 30
-                        )
-                    ) AS sbq ORDER BY datetime ASC`,
-                    {
-                        tradeFields,
-                        tradeid: trade.id,
-                        symbol_name: trade.symbol_name
-                    }
-                )
-                .then((trades) => {
-                    res.status(200)
-                        .json({
-                            success: true,
-                            trades,
-                        })
-                })
-            } else { /* trade does not exist */
-                res.status(404)
-                    .json({
-                        success: true,
-                        trades: []
-                    })
+        db.oneOrNone('SELECT symbol_name FROM trades WHERE id = $(tradeid)', { tradeid })
+        .then((flagged) => {
+            if (!flagged) { /* trade does not exist */
+                sendTrades(req, res, [], 404)
+                return null
             }
+            const symbol = flagged.symbol_name
+            // Cached until trades of the symbol are committed
+            res.locals.cacheTags = [`symbol:${symbol}`]
+            // Trades on each side of the flagged trade, read from the
+            // (symbol_name, datetime) index starting at the trade itself
+            return db.any(
+                `WITH flagged AS (
+                    SELECT id, datetime FROM trades WHERE id = $(tradeid)
+                )
+                SELECT * FROM (
+                    (
+                        SELECT $(tradeFields^) FROM trades
+                        WHERE symbol_name = $(symbol)
+                            AND (datetime, id) <= (SELECT datetime, id FROM flagged)
+                        ORDER BY datetime DESC, id DESC LIMIT 201
+                    )
+                    UNION ALL
+                    (
+                        SELECT $(tradeFields^) FROM trades
+                        WHERE symbol_name = $(symbol)
+                            AND (datetime, id) > (SELECT datetime, id FROM flagged)
+                        ORDER BY datetime ASC, id ASC LIMIT 30
+                    )
+                ) AS sbq ORDER BY datetime ASC, id ASC`,
+                { tradeFields, tradeid, symbol }
+            )
+            .then(trades => sendTrades(req, res, trades))
         })
         .catch(err => handleException(err, res))
     }
 }
 
+// Trades of a symbol in [from, to), both ISO 8601 timestamps
+const getContextTrades = (req, res) => {
+    const symbol = req.params.symbol
+    const from = new Date(req.query.from)
+    const to = new Date(req.query.to)
+    if (!symbol || isNaN(from.getTime()) || isNaN(to.getTime())) {
+        res.status(400)
+            .json({ success: false, reason: 'Expected a symbol and from and to timestamps' })
+        return
+    }
+    // Trade times are stored as London local time
+    db.any(
+        `SELECT $(tradeFields^) FROM trades
+        WHERE
+            symbol_name = $(symbol) AND
+            datetime >= ($(from)::timestamptz AT TIME ZONE 'Europe/London') AND
+            datetime < ($(to)::timestamptz AT TIME ZONE 'Europe/London')
+        ORDER BY datetime ASC, id ASC
+        LIMIT $(limit)`,
+        {
+            tradeFields,
+            symbol,
+            from: from.toISOString(),
+            to: to.toISOString(),
+            limit: MAX_CONTEXT_TRADES
+        }
+    )
+    .then((trades) => {
+        sendTrades(req, res, trades)
+    })
+    .catch(err => handleException(err, res))
+}
+
+// Trades from the hour before to the hour after `hour` on ?day=YYYY-MM-DD,
+// or on the last day the symbol traded, for alerts without a time range
 const getFlaggedTimeConstraintTrades = (req, res) => {
-    const hour = req.params.hour
+    const hour = parseInt(req.params.hour, 10)
     const symbol = req.params.symbol
-    if (hour && symbol) {
+    const day = req.query.day || null
+    if (!isNaN(hour) && symbol) {
         db.any(
-            `SELECT $(tradeFields^) FROM trades
+            `WITH d AS (
+                SELECT COALESCE(
+                    $(day)::date,
+                    (SELECT max(datetime) FROM trades WHERE symbol_name = $(symbol))::date
+                )::timestamp AS start
+            )
+            SELECT $(tradeFields^) FROM trades, d
             WHERE
-                EXTRACT(hour from datetime) >= $(hour) - 1 AND
-                EXTRACT(hour from datetime) < $(hour) + 2 AND
-                symbol_name = $(symbol)
-            ORDER BY datetime ASC`,
-            { tradeFields, hour, symbol }
+                symbol_name = $(symbol) AND
+                datetime >= d.start + ($(hour) - 1) * interval '1 hour' AND
+                datetime < d.start + ($(hour) + 2) * interval '1 hour'
+            ORDER BY datetime ASC, id ASC
+            LIMIT $(limit)`,
+            { tradeFields, hour, symbol, day, limit: MAX_CONTEXT_TRADES }
         )
         .then((trades) => {
-            res.status(200).json({ success: true, trades })
+            sendTrades(req, res, trades)
         })
         .catch(err => handleException(err, res))
     }
@@ -136,11 +189,7 @@ const tradesBefore = (req, res) => {
             { tradeFields, before, symbol, count }
         )
         .then((trades) => {
-            res.status(200)
-                .json({
-                    success: true,
-                    trades
-                })
+            sendTrades(req, res, trades)
         })
         .catch(err => handleException(err, res))
     }
@@ -159,11 +208,7 @@ const tradesAfter = (req, res) => {
             { tradeFields, after, symbol, count }
         )
         .then((trades) => {
-            res.status(200)
-                .json({
-                    success: true,
-                    trades
-                })
+            sendTrades(req, res, trades)
         })
         .catch(err => handleException(err, res))
     }
@@ -180,30 +225,103 @@ const getTrade = (req, res) => {
     .catch(err => handleException(err, res))
 }
 
+// Escape a word to be used in a regex
+const escapeRegex = word => word.replace(/[.*+?^${}()|[\]\\]/g, '\\$&')
+
+// Alerts per page of search results
+const SEARCH_PAGE = 50
+
+// Severities of alerts, most severe first
+const SEVERITIES = [1, 2, 3]
+
 const searchAlerts = (req, res, conn) => {
     const rawTerm = req.body.term
-    if (rawTerm) {
-        const term = rawTerm.toString().toLowerCase()
-        r.table('alerts')
-        .filter(alert => alert('description').downcase().match(`(?i)${term}`))
-        .orderBy('severity') // ascending is default
-        .limit(50)
-        .run(conn, (queryErr, cursor) => {
-            if (!queryErr) {
-                cursor.toArray((err, alerts) => {
-                    if (!err) {
-                        res.status(200).json({ alerts })
-                        return // eslint-disable-line
+    const { symbol, errorCode } = req.body
+    const page = Math.max(parseInt(req.body.page, 10) || 0, 0)
+    const words = rawTerm ? rawTerm.toString().toLowerCase().split(/\s+/).filter(word => word) : []
+
+    const narrow = (query) => {
+        let narrowed = query
+        words.slice(1).forEach((word) => {
+            narrowed = narrowed.filter(alert => alert('description').downcase().match(escapeRegex(word)))
+        })
+        if (symbol) {
+            narrowed = narrowed.filter({ symbol })
+        }
+        if (errorCode) {
+            narrowed = narrowed.filter({ error_code: errorCode })
+        }
+        return narrowed
+    }
+
+    const fail = (err) => {
+        console.error(err);
+        res.status(200).json({ alerts: [] })
+    }
+
+    if (words.length) {
+        // Alerts with a word of their description starting with the
+        // first word, read from the severity_tokens index one severity
+        // at a time so they come most severe first without sorting every
+        // match. The other words only filter that stream.
+        const wanted = (page + 1) * SEARCH_PAGE
+        const seen = new Set()
+        const alerts = []
+        const next = (severities, skip = 0) => {
+            if (!severities.length || alerts.length >= wanted) {
+                res.status(200).json({ alerts: alerts.slice(page * SEARCH_PAGE, wanted) })
+                return
+            }
+            const severity = severities[0]
+            const count = wanted - alerts.length
+            narrow(r.table('alerts')
+                .between(
+                    [severity, words[0], r.minval],
+                    [severity, `${words[0]}\uffff`, r.maxval],
+                    { index: 'severity_tokens' }
+                )
+                .orderBy({ index: 'severity_tokens' }))
+                .skip(skip)
+                .limit(count)
+                .run(conn)
+                .then(cursor => cursor.toArray())
+                .then((found) => {
+                    // An alert has one entry per word starting with the first one
+                    found.forEach((alert) => {
+                        if (!seen.has(alert.id)) {
+                            seen.add(alert.id)
+                            alerts.push(alert)
+                        }
+                    })
+                    if (found.length === count) {
+                        next(severities, skip + count)
+                    } else {
+                        next(severities.slice(1))
                     }
                 })
-            } else {
-                console.error(queryErr);
-                res.status(200).json({ alerts: [] })
-            }
-        })
-    } else {
+                .catch(fail)
+        }
+        next(SEVERITIES)
+        return
+    }
+
+    if (!symbol && !errorCode) {
         res.status(200).json({ alerts: [] })
+        return
     }
+    // Latest alerts of a symbol or error code, straight from their index
+    const [field, value] = symbol ? ['symbol_time', symbol] : ['error_code_time', errorCode]
+    narrow(r.table('alerts')
+        .orderBy({ index: r.desc(field) })
+        .between([value, r.minval], [value, r.maxval], { index: field }))
+        .skip(page * SEARCH_PAGE)
+        .limit(SEARCH_PAGE)
+        .run(conn)
+        .then(cursor => cursor.toArray())
+        .then((alerts) => {
+            res.status(200).json({ alerts })
+        })
+        .catch(fail)
 }
 
 const cancelOneAlert = (req, res, conn) => {
@@ -214,8 +332,15 @@ const cancelOneAlert = (req, res, conn) => {
             .delete({ returnChanges: true })
             .run(conn, (err, result) => {
                 if (!err) {
-                    // get tradeid from result set
+                    countAlertChanges(conn, result.changes)
+                        .catch(countErr => console.error(countErr))
+                    // get tradeid from result set, alerts about hours or
+                    // days of trades have none
                     const tradeid = result.changes[0].old_val.trade_pk
+                    if (!Number.isInteger(tradeid) || tradeid < 0) {
+                        res.status(200).json({ success: true })
+                        return
+                    }
                     db.none(
                         'UPDATE trades SET flagged = FALSE WHERE id = $(tradeid)',
                         { tradeid }
@@ -237,10 +362,85 @@ const cancelOneAlert = (req, res, conn) => {
     }
 }
 
-const getAlertCount = (req, res, conn) => {
+/*
+ * Alert counters, kept in the alert_counts table so polling never has
+ * to count the alerts table itself. Whatever writes an alert updates
+ * them: the analysis when it raises one (purple/db.py count_alerts),
+ * this server when one is reviewed or deleted.
+ */
+
+// Counters an alert is part of
+const countKeys = alert => [
+    'total',
+    `reviewed:${Boolean(alert.reviewed)}`,
+    `severity:${alert.severity}`,
+    `symbol:${alert.symbol}`,
+]
+
+// Apply the changes of a write with returnChanges to the counters
+const countAlertChanges = (conn, changes) => {
+    const deltas = {}
+    const add = (alert, delta) => {
+        if (alert) {
+            countKeys(alert).forEach((key) => {
+                deltas[key] = (deltas[key] || 0) + delta
+            })
+        }
+    }
+    changes.forEach((change) => {
+        add(change.old_val, -1)
+        add(change.new_val, 1)
+    })
+    const updates = Object.keys(deltas)
+        .filter(id => deltas[id] !== 0)
+        .map(id => ({ id, count: deltas[id] }))
+    if (!updates.length) {
+        return Promise.resolve()
+    }
+    return r.expr(updates).forEach(update =>
+        r.table('alert_counts').get(update('id')).replace(row =>
+            r.branch(
+                row.eq(null),
+                update,
+                row.merge({ count: row('count').add(update('count')) })
+            )
+        )
+    ).run(conn)
+}
+
+// Fields of an alert a reviewer may change
+const REVIEW_FIELDS = ['severity', 'description', 'reviewed']
+
+const updateAlert = (req, res, conn) => {
+    const alertid = req.body.alertid
+    const fields = {}
+    REVIEW_FIELDS.forEach((field) => {
+        if (req.body[field] !== undefined) {
+            fields[field] = req.body[field]
+        }
+    })
+    if (!alertid || !Object.keys(fields).length) {
+        res.status(200).json({ success: false })
+        return
+    }
     r.table('alerts')
-        .filter({ reviewed: false })
-        .count()
+        .get(alertid)
+        .update(fields, { returnChanges: true })
+        .run(conn)
+        .then(result => countAlertChanges(conn, result.changes))
+        .then(() => {
+            res.status(200).json({ success: true })
+        })
+        .catch((err) => {
+            console.error(err);
+            res.status(200).json({ success: false })
+        })
+}
+
+const getAlertCount = (req, res, conn) => {
+    r.table('alert_counts')
+        .get('reviewed:false')('count')
+        .default(0)
         .run(conn, (err, count) => {
             if (!err) {
                 res.status(200).json({ count })
@@ -251,6 +451,26 @@ const getAlertCount = (req, res, conn) => {
         })
 }
 
+const getAlertCounts = (req, res, conn) => {
+    r.table('alert_counts')
+        .run(conn, (queryErr, cursor) => {
+            if (queryErr) {
+                console.log(queryErr);
+                res.status(200).json({ counts: {} })
+                return
+            }
+            cursor.toArray((err, rows) => {
+                const counts = {}
+                if (!err) {
+                    rows.forEach((row) => {
+                        counts[row.id] = row.count
+                    })
+                }
+                res.status(200).json({ counts })
+            })
+        })
+}
+
 module.exports = {
     getSymbols,
     getSymbol,
@@ -261,5 +481,8 @@ module.exports = {
     searchAlerts,
     cancelOneAlert,
     getAlertCount,
+    getAlertCounts,
+    updateAlert,
     getFlaggedTimeConstraintTrades,
+    getContextTrades,
 }
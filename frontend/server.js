@@ -7,6 +7,7 @@ const bodyParser = require('body-parser');
 const multer = require('multer');
 const r = require('rethinkdb');
 const process = require('process');
+const net = require('net');
 const spawn = require('child_process').spawn;
 
 const app = express();
@@ -15,6 +16,7 @@ const server = http.Server(app);
 // const io = require('socket.io')(server);
 const horizon = require('@horizon/server');
 const db = require('./db');
+const ResponseCache = require('./cache').ResponseCache;
 
 const httpServer = server.listen(8181);
 
@@ -53,13 +55,83 @@ const upload = multer({
 })
 const uploadHandler = upload.single('file')
 
+/*
+ * Port of the analysis daemon (python main.py --daemon)
+ */
+const DAEMON_PORT = 8282
+
+/*
+ * Run main.py with the given arguments. Jobs are handed to the
+ * analysis daemon, which starts them in milliseconds with
+ * everything already loaded, or spawned when it isn't running.
+ * With wait, callback is only called once the job is over.
+ */
+const runJob = (args, wait, done) => {
+    let connected = false
+    let called = false
+    let response = ''
+    const callback = (job) => {
+        if (!called) {
+            called = true
+            done(job)
+        }
+    }
+    const socket = net.connect(DAEMON_PORT, 'localhost')
+
+    socket.on('connect', () => {
+        connected = true
+        socket.end(`${JSON.stringify({ args, wait })}\n`)
+    })
+    socket.on('data', (chunk) => {
+        response += chunk
+    })
+    socket.on('end', () => {
+        try {
+            callback(JSON.parse(response))
+        } catch (e) {
+            callback({ success: false })
+        }
+    })
+    socket.on('close', () => {
+        if (connected) {
+            // The daemon went away before answering
+            callback({ success: false })
+        }
+    })
+    socket.on('error', () => {
+        if (connected) {
+            return
+        }
+        /* No daemon: spawn python process that does analysis in the background
+         * docs from: nodejs.org/api/child_process.html#child_process_child_process
+        */
+        const child = spawn('python', ['../main.py'].concat(args), {
+            stdio: 'inherit'
+        })
+        if (wait) {
+            child.on('close', (code) => callback({ success: true, pid: child.pid, code }))
+        } else {
+            callback({ success: true, pid: child.pid })
+        }
+    })
+}
+
+/*
+ * Responses of the API, until the data they were read from changes
+ */
+const cache = new ResponseCache()
+const tagged = (...tags) => cache.middleware(() => tags)
+const bySymbol = cache.middleware(req => [`symbol:${req.params.symbol}`])
+
 /*
  * API: calls to postgres
  */
-app.get('/api/symbols', db.getSymbols)
-app.get('/api/symbol/:symbol', db.getSymbol)
-app.get('/api/trades/flagged/:tradeid/', db.getFlaggedTrades)
-app.get('/api/trades/flagged/:symbol/:hour', db.getFlaggedTimeConstraintTrades)
+app.get('/api/symbols', tagged('symbols'), db.getSymbols)
+app.get('/api/symbol/:symbol', bySymbol, db.getSymbol)
+// Tagged with the symbol of the trade once the query found it
+app.get('/api/trades/flagged/:tradeid/', tagged(), db.getFlaggedTrades)
+app.get('/api/trades/flagged/:symbol/:hour', bySymbol, db.getFlaggedTimeConstraintTrades)
+app.get('/api/trades/context/:symbol', bySymbol, db.getContextTrades)
 
  /*
   * Connect to RethinkDB here
@@ -71,12 +143,21 @@ app.get('/api/trades/flagged/:symbol/:hour', db.getFlaggedTimeConstraintTrades)
  })
  .then((conn) => {
      // API: Search alerts
-     app.post('/api/alerts/search', (req, res) => db.searchAlerts(req, res, conn))
+     app.post('/api/alerts/search', tagged('alerts'), (req, res) => db.searchAlerts(req, res, conn))
 
      // API: Delete anomaly (single one)
      app.post('/api/alerts/delete', (req, res) => db.cancelOneAlert(req, res, conn))
 
-     app.post('/api/alertcount', (req, res) => db.getAlertCount(req, res, conn))
+     // API: Review anomaly (severity, description)
+     app.post('/api/alerts/update', (req, res) => db.updateAlert(req, res, conn))
+
+     app.post('/api/alertcount', tagged('alert_counts'), (req, res) => db.getAlertCount(req, res, conn))
+
+     // API: Alerts per severity, symbol and review state
+     app.get('/api/alertcounts', tagged('alert_counts'), (req, res) => db.getAlertCounts(req, res, conn))
+
+     // Drop cached responses when their data changes
+     cache.watch(conn)
 
      // Kill process endpoint
      app.post('/killprocess', (req, res) => {
@@ -84,8 +165,14 @@ app.get('/api/trades/flagged/:symbol/:hour', db.getFlaggedTimeConstraintTrades)
          if (id) {
              r.table('tasks').get(id).run(conn, (err, task) => {
                  if (!err) {
+                     /* a queued task is cancelled, the daemon skips it */
+                     if (task.state === 'queued') {
+                         r.table('tasks').get(id).update({
+                             state: 'cancelled',
+                             terminated: true,
+                         }).run(conn)
                      /* verify the task isnt finished and kill process */
-                     if (!task.terminated) {
+                     } else if (!task.terminated) {
                          process.kill(task.pid)
                      }
                  }
@@ -113,20 +200,14 @@ app.post('/upload', (req, res) => {
             return
         }
 
-        /* At this point upload is complete, start analysing file:
-         * spawn python process that does analysis in the background
-         * docs from: nodejs.org/api/child_process.html#child_process_child_process
-        */
-        const child = spawn('python', ['../main.py', '-f', req.file.path], {
-            stdio: 'inherit'
-        })
-        const pid = child.pid
-
-        res.json({
-            pid,
-            success: true,
-            filename: req.file.originalname,
-            size: req.file.size,
+        /* At this point upload is complete, start analysing file */
+        runJob(['-f', req.file.path], false, (job) => {
+            res.json({
+                pid: job.pid,
+                success: job.success,
+                filename: req.file.originalname,
+                size: req.file.size,
+            })
         })
     })
 })
@@ -139,19 +220,14 @@ app.post('/setstream', (req, res) => {
     const port = req.body.port || 80
 
     if (streamUrl && port) {
-        /* At this point, start analysing stream:
-         * spawn python process that does analysis in the background
-        */
-        const child = spawn('python', ['../main.py', '-s', streamUrl, '-p', port], {
-            stdio: 'inherit'
-        })
-        const pid = child.pid
-
-        res.json({
-            success: true,
-            streamUrl: req.body.streamUrl,
-            port: req.body.port,
-            pid
+        /* At this point, start analysing stream */
+        runJob(['-s', streamUrl, '-p', String(port)], false, (job) => {
+            res.json({
+                success: job.success,
+                streamUrl: req.body.streamUrl,
+                port: req.body.port,
+                pid: job.pid,
+            })
         })
         return
     }
@@ -164,10 +240,9 @@ app.post('/setstream', (req, res) => {
  * Reset the db from client
  */
 app.post('/resetdb', (req, res) => {
-    spawn('python', ['../main.py', '--reset-db', '--init-db'], {
-        stdio: 'inherit'
-    }).on('close', (code) => {
-        res.json({ success: true, code })
+    runJob(['--reset-db', '--init-db'], true, (job) => {
+        cache.clear()
+        res.json({ success: job.success, code: job.code })
     })
 })
 
@@ -0,0 +1,102 @@
+/*
+ * Columnar wire format of trade series, used by the server (db.js) and
+ * the charts. Instead of one object per trade repeating every key:
+ *
+ *   {
+ *       length: 3,
+ *       id: [1041, 1, 2],                        first value then deltas
+ *       datetime: [1484321201917, 9355, 2986],   epoch ms, first value then deltas
+ *       scale: 100,                              prices are integers once multiplied by it
+ *       price: [46974, 379, 59],                 first value then deltas
+ *       bid: [-66, -85, -14],                    bid - price
+ *       ask: [0, 0, 0],                          ask - price
+ *       size: [15952, 10000, 12000],
+ *       flagged: [0, 1, 0]
+ *   }
+ *
+ * Prices that are not integers at any scale up to 1e6 are sent as they
+ * are (scale 0, no deltas).
+ */
+
+const COLUMNS_TYPE = 'application/vnd.purple.columns+json'
+const MAX_PRICE_SCALE = 1000000
+
+const deltas = (values) => {
+    const out = new Array(values.length)
+    let previous = 0
+    for (let i = 0; i < values.length; i++) { // eslint-disable-line
+        out[i] = values[i] - previous
+        previous = values[i]
+    }
+    return out
+}
+
+// Smallest power of ten making every price of the rows an integer
+const priceScale = (rows) => {
+    for (let scale = 1; scale <= MAX_PRICE_SCALE; scale *= 10) {
+        const exact = rows.every(row => ['price', 'bid', 'ask'].every((field) => {
+            const scaled = row[field] * scale
+            return Math.abs(scaled - Math.round(scaled)) < 1e-6
+        }))
+        if (exact) {
+            return scale
+        }
+    }
+    return 0
+}
+
+/*
+ * Trade rows (as read from postgres) to columns
+ */
+const encodeTrades = (rows) => {
+    const scale = priceScale(rows)
+    const scaled = field => rows.map(row => (scale ? Math.round(row[field] * scale) : row[field]))
+    const price = scaled('price')
+    const spread = field => scaled(field).map((value, i) => value - price[i])
+    return {
+        length: rows.length,
+        id: deltas(rows.map(row => row.id)),
+        datetime: deltas(rows.map(row => new Date(row.datetime).getTime())),
+        scale,
+        price: scale ? deltas(price) : price,
+        bid: spread('bid'),
+        ask: spread('ask'),
+        size: rows.map(row => Number(row.size)),
+        flagged: rows.map(row => (row.flagged ? 1 : 0)),
+    }
+}
+
+/*
+ * Columns to typed arrays, without an object per trade
+ */
+const decodeTrades = (columns) => {
+    const length = columns.length
+    const id = new Float64Array(length)
+    const datetime = new Float64Array(length)
+    const price = new Float64Array(length)
+    const bid = new Float64Array(length)
+    const ask = new Float64Array(length)
+    const size = new Float64Array(columns.size)
+    const flagged = new Uint8Array(columns.flagged)
+    const scale = columns.scale || 1
+    let lastId = 0
+    let lastDatetime = 0
+    let lastPrice = 0
+    for (let i = 0; i < length; i++) { // eslint-disable-line
+        lastId += columns.id[i]
+        lastDatetime += columns.datetime[i]
+        lastPrice = columns.scale ? lastPrice + columns.price[i] : columns.price[i]
+        id[i] = lastId
+        datetime[i] = lastDatetime
+        price[i] = lastPrice / scale
+        bid[i] = (lastPrice + columns.bid[i]) / scale
+        ask[i] = (lastPrice + columns.ask[i]) / scale
+    }
+    return { length, id, datetime, price, bid, ask, size, flagged }
+}
+
+module.exports = {
+    COLUMNS_TYPE,
+    encodeTrades,
+    decodeTrades,
+}
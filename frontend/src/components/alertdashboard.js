@@ -54,17 +54,6 @@ class AlertDashboard extends React.Component {
         })
     }
 
-    cancelMultiple(id) {
-        const horizon = this.props.horizon
-        try {
-            horizon('alerts').remove(id)
-            this.handleSuccessfulDelete()
-            browserHistory.push('/flagged')
-        } catch (err) {
-            console.log(err);
-        }
-    }
-
     cancelOne(alertid) {
         fetch('/api/alerts/delete', { // eslint-disable-line
             method: 'POST',
@@ -98,12 +87,8 @@ class AlertDashboard extends React.Component {
     }
 
     handleCancelAnomaly() {
-        const { alert } = this.props
-        if (alert.trade_pk === -1) {
-            this.cancelMultiple(alert.id)
-        } else {
-            this.cancelOne(alert.id)
-        }
+        // The server also keeps the alert counters and flagged trades in step
+        this.cancelOne(this.props.alert.id)
     }
 
     render() {
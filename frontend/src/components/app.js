@@ -41,10 +41,14 @@ class App extends React.Component {
             .order('datetime', 'descending')
             .watch({ rawChanges: true })
             .subscribe((notifChange) => {
-                if (notifChange.type === 'add') {
+                if (notifChange.type === 'add' || notifChange.type === 'change') {
                     const notif = notifChange.new_val
+                    // Updated notifications (e.g. feed outages) replace
+                    // the one already shown instead of stacking up
+                    this.props.notificationsystem.removeNotification(notif.id)
                     this.props.notificationsystem.addNotification({
                         allowHTML: true,
+                        uid: notif.id,
                         level: notif.level,
                         message: notif.message || null,
                         title: notif.title || null,
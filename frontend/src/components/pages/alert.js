@@ -11,6 +11,7 @@ import {
 } from 'semantic-ui-react'
 
 import AlertDashboard from '../alertdashboard'
+import { COLUMNS_TYPE, decodeTrades } from '../../columns'
 
 import isEqual from 'lodash/isEqual'
 import find from 'lodash/find'
@@ -21,7 +22,7 @@ class AlertPage extends React.Component {
     initialState = {
         doesNotExist: false,
         alert: null,
-        trades: [],
+        trades: { length: 0 },
     }
 
     constructor(props) {
@@ -86,7 +87,7 @@ class AlertPage extends React.Component {
     }
 
     loadOne(tradeid) {
-        fetch(`/api/trades/flagged/${tradeid}`) // eslint-disable-line
+        fetch(`/api/trades/flagged/${tradeid}`, { headers: { Accept: COLUMNS_TYPE } }) // eslint-disable-line
         .then((res) => {
             if (res.status >= 200 && res.status < 300) {
                 return res.json()
@@ -98,7 +99,7 @@ class AlertPage extends React.Component {
         .then((res) => {
             if (this.mounted) {
                 this.setState({
-                    trades: res.trades,
+                    trades: decodeTrades(res.columns),
                 })
             }
         })
@@ -110,7 +111,7 @@ class AlertPage extends React.Component {
     }
 
     loadMultiple(hour, symbol) {
-        fetch(`/api/trades/flagged/${symbol}/${hour}`) // eslint-disable-line
+        fetch(`/api/trades/flagged/${symbol}/${hour}`, { headers: { Accept: COLUMNS_TYPE } }) // eslint-disable-line
         .then((res) => {
             if (res.status >= 200 && res.status < 300) {
                 return res.json()
@@ -122,7 +123,7 @@ class AlertPage extends React.Component {
         .then((res) => {
             if (this.mounted) {
                 this.setState({
-                    trades: res.trades,
+                    trades: decodeTrades(res.columns),
                 })
             }
         })
@@ -133,8 +134,36 @@ class AlertPage extends React.Component {
         })
     }
 
-    loadTrades({ trade_pk: tradeid, time: hour, symbol }) {
-        if (tradeid === -1) {
+    loadRange(symbol, from, to) {
+        const range = `from=${new Date(from).toISOString()}&to=${new Date(to).toISOString()}`
+        fetch(`/api/trades/context/${symbol}?${range}`, { headers: { Accept: COLUMNS_TYPE } }) // eslint-disable-line
+        .then((res) => {
+            if (res.status >= 200 && res.status < 300) {
+                return res.json()
+            }
+            const err = new Error(res.statusText)
+            err.response = res
+            throw err
+        })
+        .then((res) => {
+            if (this.mounted) {
+                this.setState({
+                    trades: decodeTrades(res.columns),
+                })
+            }
+        })
+        .catch((err) => {
+            if (this.mounted) {
+                // TODO
+            }
+        })
+    }
+
+    loadTrades({ trade_pk: tradeid, time: hour, symbol, from, to }) {
+        // Trades around the anomaly were picked when it was found
+        if (from && to) {
+            this.loadRange(symbol, from, to)
+        } else if (tradeid === -1) {
             this.loadMultiple(hour, symbol)
         } else {
             this.loadOne(tradeid)
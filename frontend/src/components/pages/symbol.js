@@ -14,6 +14,7 @@ import {
 } from 'semantic-ui-react'
 
 import SymbolDashboard from '../symboldashboard'
+import { COLUMNS_TYPE, decodeTrades } from '../../columns'
 
 import groupBy from 'lodash/groupBy'
 import map from 'lodash/map'
@@ -26,7 +27,7 @@ class SymbolPage extends React.Component {
             loadingError: false,
             doesNotExist: false,
             symbols: this.props.symbols || [],
-            trades: [],
+            trades: { length: 0 },
             pollIntervalID: null,
             liveTrades: true,
         }
@@ -93,7 +94,9 @@ class SymbolPage extends React.Component {
     }
 
     getTrades() {
-        fetch(`/api/symbol/${this.props.params.symbol}`) // eslint-disable-line
+        fetch(`/api/symbol/${this.props.params.symbol}`, { // eslint-disable-line
+            headers: { Accept: COLUMNS_TYPE }
+        })
         .then((res) => {
             if (res.status >= 200 && res.status < 300) {
                 return res.json()
@@ -108,7 +111,7 @@ class SymbolPage extends React.Component {
                     this.setState({
                         loadingError: false,
                         loading: false,
-                        trades: res.trades
+                        trades: decodeTrades(res.columns)
                     })
                 }
             }
@@ -6,7 +6,6 @@
   */
 
 import React, { PropTypes } from 'react'
-import { connect } from 'react-redux'
 import {
     Container,
     Grid,
@@ -35,6 +34,11 @@ class ReviewAnomalyController extends React.Component {
 
     descriptionMaker(type) {
         const { symbol } = this.props.alert
+        // The same anomaly on many symbols of a sector, alerted once
+        // for the sector (sectors.py collapse), e.g. VS-S
+        if (type.endsWith('-S')) {
+            return `${this.descriptionMaker(type.slice(0, -2))} sector`
+        }
         switch (type) {
         case 'VS':
             return `Hourly volume spike for ${symbol}`
@@ -48,28 +52,43 @@ class ReviewAnomalyController extends React.Component {
             return `Fat finger error on price for ${symbol}`
         case 'FFV':
             return `Fat finger error on volume for ${symbol}`
+        case 'SD':
+            return `${symbol} deviating from its sector`
+        case 'SVS':
+            return `Sector wide volume spike for ${symbol}`
+        case 'STR':
+            return `Sector wide trade rate spike for ${symbol}`
+        case 'WT':
+            return `Wash trade on ${symbol}`
+        case 'CT':
+            return `Circular trading on ${symbol}`
         case 'other':
         default:
             return `Other type of anomaly for ${symbol}`
         }
     }
 
-    handleSeverityChange(severity) {
-        const { horizon: hz, alert } = this.props
-        hz('alerts').update({
-            id: alert.id,
-            severity
+    // Goes through the server so the alert counters follow the change
+    updateAlert(fields) {
+        const { alert } = this.props
+        fetch('/api/alerts/update', { // eslint-disable-line
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(Object.assign({ alertid: alert.id }, fields))
         })
+        .catch(err => console.error(err)) // eslint-disable-line
+    }
+
+    handleSeverityChange(severity) {
+        this.updateAlert({ severity })
     }
 
     handleDescriptionChange(e, data) {
         const { value } = data
-        const { horizon: hz, alert } = this.props
         if (value === 'current') { return } // early return
-        hz('alerts').update({
-            id: alert.id,
-            description: this.descriptionMaker(value)
-        })
+        this.updateAlert({ description: this.descriptionMaker(value) })
     }
 
     render() {
@@ -87,6 +106,15 @@ class ReviewAnomalyController extends React.Component {
             { key: 4, value: 'FFV', text: this.descriptionMaker('FFV') },
             { key: 6, value: 'PDBR', text: this.descriptionMaker('PDBR') },
             { key: 7, value: 'PDBR-D', text: this.descriptionMaker('PDBR-D') },
+            { key: 9, value: 'SD', text: this.descriptionMaker('SD') },
+            { key: 10, value: 'SVS', text: this.descriptionMaker('SVS') },
+            { key: 13, value: 'STR', text: this.descriptionMaker('STR') },
+            { key: 14, value: 'VS-S', text: this.descriptionMaker('VS-S') },
+            { key: 15, value: 'PDBR-S', text: this.descriptionMaker('PDBR-S') },
+            { key: 16, value: 'FFP-S', text: this.descriptionMaker('FFP-S') },
+            { key: 17, value: 'FFV-S', text: this.descriptionMaker('FFV-S') },
+            { key: 11, value: 'WT', text: this.descriptionMaker('WT') },
+            { key: 12, value: 'CT', text: this.descriptionMaker('CT') },
             { key: 8, value: 'other', text: this.descriptionMaker('other') },
         ]
         return (
@@ -131,8 +159,4 @@ ReviewAnomalyController.propTypes = {
     alert: PropTypes.object.isRequired,
 }
 
-export default connect(
-    state => ({
-        horizon: state.db.horizon
-    })
-)(ReviewAnomalyController)
+export default ReviewAnomalyController
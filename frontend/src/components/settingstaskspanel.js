@@ -37,6 +37,7 @@ const SettingsTasksPanel = ({ tasks }) => (
             <Table.Row>
                 <Table.HeaderCell>Task</Table.HeaderCell>
                 <Table.HeaderCell>Type</Table.HeaderCell>
+                <Table.HeaderCell>State</Table.HeaderCell>
                 <Table.HeaderCell>PID</Table.HeaderCell>
                 <Table.HeaderCell>Created at</Table.HeaderCell>
                 <Table.HeaderCell textAlign='center'>Action</Table.HeaderCell>
@@ -12,6 +12,7 @@ const SettingsTasksPanelRow = ({ task, killProcess, notificationsystem }) => (
             {`${task.task.charAt(0).toUpperCase()}${task.task.slice(1)}`}
         </Table.Cell>
         <Table.Cell>{task.type}</Table.Cell>
+        <Table.Cell>{task.state || 'running'}</Table.Cell>
         <Table.Cell>{task.pid}</Table.Cell>
         <Table.Cell>{task.created_at.toUTCString()}</Table.Cell>
         <Table.Cell selectable collapsing textAlign='center'>
@@ -23,7 +24,7 @@ const SettingsTasksPanelRow = ({ task, killProcess, notificationsystem }) => (
                 }}
             >
                 <Icon name='remove circle' />
-                Kill task
+                {task.state === 'queued' ? 'Cancel task' : 'Kill task'}
             </a>
         </Table.Cell>
     </Table.Row>
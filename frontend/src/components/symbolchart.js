@@ -1,7 +1,7 @@
 /* eslint-disable react/forbid-prop-types, react/sort-comp, react/require-default-props */
 
 import React, { PropTypes } from 'react'
-import { utcParse, timeFormat } from 'd3-time-format'
+import { timeFormat } from 'd3-time-format'
 import { format, formatDefaultLocale } from 'd3-format'
 import {
     ChartCanvas,
@@ -31,8 +31,6 @@ const { ClickCallback } = interactive
 const { XAxis, YAxis } = axes
 const { fitWidth } = helper
 
-const parseDatetime = utcParse('%Y-%m-%dT%H:%M:%S.%LZ')
-
 formatDefaultLocale({
     decimal: '.',
     thousands: ',',
@@ -61,28 +59,49 @@ class SymbolChart extends React.Component {
         return false
     }
 
+    /*
+     * trades are decoded columns (see columns.js), extents and volumes
+     * are read from them. react-stockcharts only plots row objects,
+     * they are built once per new series.
+     */
     parseData(trades) { // eslint-disable-line
+        const { length } = trades
+        const rows = new Array(length)
         let maxVolume = 0
-        trades.forEach((d) => {
-            d.datetime = new Date(parseDatetime(d.datetime)) // eslint-disable-line
-            if (d.size > maxVolume) {
-                maxVolume = d.size
+        for (let i = 0; i < length; i++) { // eslint-disable-line
+            rows[i] = {
+                id: trades.id[i],
+                datetime: new Date(trades.datetime[i]),
+                price: trades.price[i],
+                bid: trades.bid[i],
+                ask: trades.ask[i],
+                size: trades.size[i],
+                flagged: trades.flagged[i] === 1,
             }
-        })
+            if (trades.size[i] > maxVolume) {
+                maxVolume = trades.size[i]
+            }
+        }
         /* try and get best minimum datetime */
-        const maxDatetime = trades[trades.length - 1].datetime
-        let minDatetime = trades[0].datetime
-        if (trades.length >= 100) {
-            minDatetime = trades[trades.length - 100].datetime
-        } else if (trades.length >= 70) {
-            minDatetime = trades[trades.length - 70].datetime
-        } else if (trades.length >= 40) {
-            minDatetime = trades[trades.length - 40].datetime
+        const maxDatetime = rows[length - 1].datetime
+        let minDatetime = rows[0].datetime
+        if (length >= 100) {
+            minDatetime = rows[length - 100].datetime
+        } else if (length >= 70) {
+            minDatetime = rows[length - 70].datetime
+        } else if (length >= 40) {
+            minDatetime = rows[length - 40].datetime
         }
-        return { trades, minDatetime, maxDatetime, maxVolume }
+        return { trades: rows, minDatetime, maxDatetime, maxVolume }
     }
 
     componentWillReceiveProps(newProps) {
+        /* live pages poll every second, nothing to do without new trades */
+        const previous = this.props.trades
+        const next = newProps.trades
+        if (next.length === previous.length && next.id[next.length - 1] === previous.id[previous.length - 1]) {
+            return
+        }
         const { trades, minDatetime, maxDatetime, maxVolume } = this.parseData(newProps.trades)
         this.setState({
             trades,
@@ -242,14 +261,14 @@ SymbolChart.propTypes = {
     width: PropTypes.number,
     ratio: PropTypes.number,
     handleClick: PropTypes.func.isRequired,
-    trades: PropTypes.array,
+    trades: PropTypes.object,
     flagAnomalies: PropTypes.bool,
     flagOne: PropTypes.number,
 }
 
 SymbolChart.defaultProps = {
     handleClick: () => {},
-    trades: [],
+    trades: { length: 0 },
     flagAnomalies: true,
 }
 
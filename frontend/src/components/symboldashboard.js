@@ -60,14 +60,14 @@ class SymbolDashboard extends React.Component {
 
 SymbolDashboard.propTypes = {
     symbol: PropTypes.string,
-    trades: PropTypes.array,
+    trades: PropTypes.object,
     loadingError: PropTypes.bool,
     horizon: PropTypes.any,
 }
 
 SymbolDashboard.defaultProps = {
     symbol: '',
-    trades: [],
+    trades: { length: 0 },
     loadingError: false,
     horzon: null,
 }
@@ -4,33 +4,60 @@
 # Collects data for testing
 
 import sys
+import time
 import socket
 import sqlite3 as s
 import argparse
 
 from purple.finance import Trade
 
-# Main table
+# Main table, created with its indexes on every start so databases
+# written by older versions get them too (their columns keep the
+# types they were created with)
 TABLE = '''
-DROP TABLE IF EXISTS trades;
-CREATE TABLE trades(
-    price NUMERIC,
-    size NUMERIC,
-    bid NUMERIC,
-    ask NUMERIC,
-    time TEXT,
+CREATE TABLE IF NOT EXISTS trades(
+    price REAL NOT NULL,
+    size INTEGER NOT NULL,
+    bid REAL NOT NULL,
+    ask REAL NOT NULL,
+    time TEXT NOT NULL,
     buyer TEXT,
     seller TEXT,
-    symbol TEXT,
+    symbol TEXT NOT NULL,
     sector TEXT
-);'''
+);
+CREATE INDEX IF NOT EXISTS trades_time ON trades(time);
+CREATE INDEX IF NOT EXISTS trades_symbol_time ON trades(symbol, time);'''
+
+# Run before TABLE by --init
+DROP_TABLE = 'DROP TABLE IF EXISTS trades;'
+
+# Pragmas for fast appends: with WAL, commits don't rewrite the
+# database and readers don't block the writer. synchronous=NORMAL
+# only syncs at checkpoints, a crash can lose the last batch but
+# never corrupts the db.
+PRAGMAS = '''
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA wal_autocheckpoint=10000;'''
+
+INSERT = (
+    'INSERT INTO '
+    'trades (price, size, bid, ask, time, buyer, seller, symbol, sector) '
+    'VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);'
+)
+
+# Bytes read from the socket at once
+RECV_SIZE = 65536
 
 # connect to sqlite
 conn = s.connect('data.db')
 
-def create_tables(cur):
+def create_tables(cur, wipe=False):
     try:
-        cur.executescript(TABLE)
+        cur.executescript((DROP_TABLE if wipe else '') + TABLE)
         conn.commit()
     except s.Error, e:
         if conn:
@@ -38,61 +65,140 @@ def create_tables(cur):
         print "Error: %s" % e.args[0]
         sys.exit(1)
 
-def insert_trade(cur, t):
-    global conn
-    cur.execute((
-        'INSERT INTO '
-        'trades (price, size, bid, ask, time, buyer, seller, symbol, sector) '
-        'VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?);'
-    ), (
+def row_of(t):
+    return (
         t.price, t.size, t.bid, t.ask,
-        t.time, t.seller, t.buyer,
+        # Same format as the rows of older versions (sqlite3's own
+        # datetime adapter), so times still sort and compare as text
+        t.time.isoformat(' '), t.buyer, t.seller,
         t.symbol, t.sector
-    ))
+    )
+
+def insert_trades(cur, rows):
+    global conn
+    cur.executemany(INSERT, rows)
     if conn:
         conn.commit()
 
 
+class Recorder:
+    '''
+    Buffers trades and writes them with executemany,
+    once `batch_size` rows are waiting or `interval`
+    seconds passed since the last write
+    '''
+    def __init__(self, cur, batch_size=1000, interval=1.0, report_interval=10.0):
+        self.cur = cur
+        self.batch_size = batch_size
+        self.interval = interval
+        self.report_interval = report_interval
+        self.rows = []
+        self.total = 0
+        self.started = time.time()
+        self.last_flush = self.started
+        self.last_report = self.started
+        self.reported_total = 0
+
+    def add(self, t):
+        self.rows.append(row_of(t))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def tick(self):
+        # Called after every read, writes slow trickles of trades too
+        now = time.time()
+        if self.rows and now - self.last_flush >= self.interval:
+            self.flush()
+        if now - self.last_report >= self.report_interval:
+            self.report(now)
+
+    def flush(self):
+        insert_trades(self.cur, self.rows)
+        self.total += len(self.rows)
+        self.rows = []
+        self.last_flush = time.time()
+
+    def report(self, now):
+        rate = (self.total - self.reported_total) / max(now - self.last_report, 1e-6)
+        average = self.total / max(now - self.started, 1e-6)
+        print 'Stored {} trades, {:.0f} rows/s (average {:.0f} rows/s)'.format(self.total, rate, average)
+        sys.stdout.flush()
+        self.last_report = now
+        self.reported_total = self.total
+
+
 def main():
     global conn
     parser = argparse.ArgumentParser()
-    parser.add_argument('--init', action='store_true')
+    parser.add_argument(
+        '--init', action='store_true',
+        help='Delete the stored trades before recording.'
+    )
+    parser.add_argument('--host', default='cs261.dcs.warwick.ac.uk')
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument(
+        '--batch-size', type=int, default=1000,
+        help='Trades written per transaction. (default: 1000)'
+    )
+    parser.add_argument(
+        '--flush-interval', type=float, default=1.0,
+        help='Longest time in seconds trades wait before being written. (default: 1)'
+    )
+    parser.add_argument(
+        '--report-interval', type=float, default=10.0,
+        help='Seconds between rows per second reports. (default: 10)'
+    )
     args = parser.parse_args()
 
     with conn:
         # get db cursor
         cur = conn.cursor()
-        # create tables if required
-        if (args.init):
-            create_tables(cur)
+        cur.executescript(PRAGMAS)
+        # create missing tables and indexes, wipe them with --init
+        create_tables(cur, wipe=args.init)
 
         # Open socket with given paramaters
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(('cs261.dcs.warwick.ac.uk', 80))
+            sock.connect((args.host, args.port))
         except socket.error, e:
             # Oopsy, couldn't connect
             print e
             sys.exit(1)
 
-        line = ''
+        recorder = Recorder(cur, args.batch_size, args.flush_interval, args.report_interval)
+        sock.settimeout(args.flush_interval)
+
+        pending = ''
         firstline = True
 
-        # read character by character until new line '\n'
-        # is found. Parse line at that time and continue.
-        while 1:
-            # read character
-            char = sock.recv(1)
-            if char == '\n':
-                if firstline:
-                    firstline = False
-                else:
+        # read blocks and split them into lines, the last
+        # (incomplete) line is kept until the next block
+        try:
+            while 1:
+                try:
+                    block = sock.recv(RECV_SIZE)
+                except socket.timeout:
+                    recorder.tick()
+                    continue
+                if not block:
+                    print 'Connection closed by the feed'
+                    break
+
+                lines = (pending + block).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    if firstline:
+                        firstline = False
+                        continue
                     t = Trade(line)
                     if not t.parse_err:
-                        insert_trade(cur, t)
-                line = ''
-            else:
-                line = line + char
+                        recorder.add(t)
+                recorder.tick()
+        finally:
+            if recorder.rows:
+                recorder.flush()
+            recorder.report(time.time())
 
 
 if __name__ == '__main__':
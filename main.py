@@ -4,7 +4,9 @@
 # Used to parse command line arguments
 import argparse
 
+# Both are cheap to import, commands load what they need when run
 from purple import App
+from purple.daemon import serve, DAEMON_PORT
 
 def main():
     parser = argparse.ArgumentParser(description='Purple trading backend')
@@ -31,14 +33,114 @@ def main():
         '-s', '--stream-url', type=str,
         help='URL to a stream of data.'
     )
+    # We want to analyse many streams at once
+    group.add_argument(
+        '--feeds', nargs='+', metavar='HOST:PORT',
+        help='Analyse several streams of data in one process.'
+    )
+    # We want to re-run analysis over stored trades
+    group.add_argument(
+        '--backtest', nargs=2, metavar=('FROM', 'TO'),
+        help='Re-run analysis over trades stored between two dates\
+        (YYYY-MM-DD, inclusive).'
+    )
     # Port of the stream, defaults to 80
     parser.add_argument(
         '-p', '--port', type=int, default=80,
         help='Specify a port to given stream url. (default: 80)'
     )
 
+    # Number of processes used for backtests and split streams
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='Number of processes used by --backtest (default: cpu count),\
+        or of symbol partitions a stream (-s) is split into. (default: 1)'
+    )
+    # Serve the partitions of a stream to other machines
+    parser.add_argument(
+        '--relay', type=int, metavar='PORT',
+        help='Split the stream (-s) into --workers partitions by symbol\
+        and serve partition k on PORT + k instead of analysing it.'
+    )
+    # What to do with lines of a stream while analysis can't keep up
+    parser.add_argument(
+        '--overload', choices=['block', 'shed', 'spill'], default='spill',
+        help='When more than --queue-size lines of a stream wait for\
+        analysis: stop reading (block), drop lines (shed) or write\
+        them to disk (spill). (default: spill)'
+    )
+    parser.add_argument(
+        '--queue-size', type=int, default=10000,
+        help='Lines of a stream held in memory waiting for analysis.\
+        (default: 10000)'
+    )
+    # Spill trades of a file to disk while reading it
+    parser.add_argument(
+        '--out-of-core', action='store_true',
+        help='Keep the trades of a file in temporary files on disk while\
+        reading it, for files larger than memory.'
+    )
+    # Append ingested trades to an on-disk archive
+    parser.add_argument(
+        '--archive', type=str, metavar='DIR',
+        help='Also append every trade to a compressed archive of\
+        day segments in DIR.'
+    )
+    # Use median/MAD thresholds from streaming quantile sketches
+    parser.add_argument(
+        '--robust', action='store_true',
+        help='Use median and MAD from per-symbol quantile sketches\
+        instead of mean and standard deviation for thresholds.'
+    )
+
+    # Profile the analysis of a file or stream
+    parser.add_argument(
+        '--profile', nargs='?', const='cprofile', choices=['cprofile', 'sampling'],
+        help='Profile the analysis of a file (-f) or stream (-s) and write\
+        a .prof file for snakeviz. sampling is cheaper, for live\
+        streams. (default: cprofile)'
+    )
+    parser.add_argument(
+        '--profile-out', type=str, metavar='FILE',
+        help='Where --profile writes its output.\
+        (default: purple-<file|stream>-<pid>.prof)'
+    )
+
+    # Prometheus metrics of the analysis
+    parser.add_argument(
+        '--metrics-port', type=int, metavar='PORT',
+        help='Serve metrics (trades, parse errors, queue depths, commit\
+        and alert latencies, anomalies...) in the Prometheus text format\
+        on http://localhost:PORT/metrics while analysing.'
+    )
+    parser.add_argument(
+        '--metrics-file', type=str, metavar='FILE',
+        help='Write the same metrics to FILE every few seconds, for the\
+        textfile collector of node_exporter.'
+    )
+
+    # Stay running and start jobs sent by the frontend
+    parser.add_argument(
+        '--daemon', type=int, nargs='?', const=DAEMON_PORT, metavar='PORT',
+        help='Keep everything loaded and run the jobs (command lines)\
+        sent to PORT on localhost. (default port: {})'.format(DAEMON_PORT)
+    )
+
+    # Tasks allowed to run at once
+    parser.add_argument(
+        '--max-tasks', type=int, default=2,
+        help='Analysis tasks running at once, the daemon queues the\
+        others with streams first. (default: 2)'
+    )
+    # Task queued for this job by the daemon
+    parser.add_argument('--task-id', type=str, help=argparse.SUPPRESS)
+
     args = parser.parse_args()
 
+    if args.daemon:
+        serve(parser, args.daemon, args.max_tasks)
+        return
+
     # Run our app with arguments
     App(args)
 
@@ -1,77 +1,143 @@
-import math,datetime, time
-from purple.finance import Trade
-
-# Symbol is a list of trades requested by the frontend
-def predict(symbol):
-    # Create lists of x/y values (times/prices) along with averages
-    times = []
-    prices = []
-    timeAvg = 0.0
-    priceAvg = 0.0
-    numTrades = 0
-    # Iterate throught the list symbol
-    for trade in symbol:
-        # Convert time to a number used for mathematical methods
-        time = time.mktime(trade.time.timetuple())
-        # Add times and prices to the lists...
-        times.append(time)
-        prices.append(trade.price)
-        # ...and then add them to the averages
-        timeAvg += time
-        priceAvg += trade.price
-        numTrades += 1
-    # Calculate averages
-    timeAvg /= numTrades
-    priceAvg /= numTrades
-
-    # Calculate average time gap
-    timeGap = 0.0
-    for i in range(1,numTrades):
-        timeGap += (times[i]-times[i-1])
-    timeGap /= numTrades
-    
-    # Gradient, intercept and standard deviation calculation
-    numerator = 0.0
-    denominator = 0.0
-    priceDev = 0.0
-    # Totals calculated by iterating over each trades
-    for i in range(numTrades):
-        numerator += (times[i]-timeAvg) * (prices[i]-priceAvg)
-        denominator += (times[i]-timeAvg) ** 2
-        priceDev += (prices[i]-priceAvg)**2
-    # m is the gradient of the trendline
-    m = numerator / denominator
-    # c is the intercept of the trendline
-    c = priceAvg - (m*timeAvg)
-    stDev = math.sqrt(priceDev/numTrades)
-
-    # Find co-ordinates for each prediction line
-    # DISTANCE is the number of trades away to predict
-    DISTANCE = 10
-    xVal = times[numTrades-1]
-    # The numbers used for time are converted back to the datetime format
-    startTime = datetime.datetime.fromtimestamp(xVal)
-    initialTime = datetime.datetime.fromtimestamp(times[0])
-    startPoint = (startTime,m*times[numTrades-1]+c)
-
-    # The final value to return is initialized, holding the trendline and the startpoint of each prediction line
-    predictionLines = [[(initialTime,m*times[0]+c),startPoint],
-                       [startPoint], #min3
-                       [startPoint], #min2
-                       [startPoint], #min1
-                       [startPoint], #0
-                       [startPoint], #max1
-                       [startPoint], #max2
-                       [startPoint]] #max3
-    # Append the prediction line values to each line
-    for p in range(-3,4):
-        for i in DISTANCE:
-            # Calculate the point at each x value up to DISTANCE trades away and append it to the respective line array
-            xVal += timeGap
-            xValTime = datetime.datetime.fromtimestamp(xVal)
-            predictionLines[p+4].append((xValTime,m*xVal+c+((math.sqrt(i)*p)*stDev)))
-        xVal = times[numTrades-1]
-    return (predictionLines)
-
-    # Prediction line consists of start and end co-ordinates of:
-    # [trendline, 3rdDevDown, 2ndDevDown, 1stDevDown, trendlineContinued, 1stDevUp, 2ndDevUp, 3rdDevUp]
+import math, datetime, time
+import numpy
+from purple.finance import Trade
+
+# DISTANCE is the number of trades away to predict
+DISTANCE = 10
+
+# Convert time to a number used for mathematical methods
+def to_timestamp(t):
+    return time.mktime(t.timetuple())
+
+# Least squares fit of a window of trades, using numpy arrays of times and prices
+# Returns gradient, intercept, standard deviation of prices and average time gap
+def fit_window(times, prices):
+    times = numpy.asarray(times, dtype=float)
+    prices = numpy.asarray(prices, dtype=float)
+    numTrades = len(times)
+
+    # Times are taken relative to the first trade to keep precision
+    origin = times[0]
+    offsets = times - origin
+    timeAvg = offsets.mean()
+    priceAvg = prices.mean()
+
+    timeDev = offsets - timeAvg
+    priceDev = prices - priceAvg
+    # m is the gradient of the trendline
+    m = (timeDev * priceDev).sum() / (timeDev ** 2).sum()
+    # c is the intercept of the trendline
+    c = priceAvg - m * (timeAvg + origin)
+    stDev = math.sqrt((priceDev ** 2).sum() / numTrades)
+    # Average time gap
+    timeGap = (times[-1] - times[0]) / numTrades
+
+    return m, c, stDev, timeGap
+
+# Symbol is a list of trades requested by the frontend
+def predict(symbol):
+    times = [to_timestamp(trade.time) for trade in symbol]
+    prices = [trade.price for trade in symbol]
+    m, c, stDev, timeGap = fit_window(times, prices)
+    return prediction_lines(m, c, stDev, timeGap, times[0], times[-1])
+
+# Find co-ordinates for each prediction line
+def prediction_lines(m, c, stDev, timeGap, firstTime, lastTime):
+    # The numbers used for time are converted back to the datetime format
+    startTime = datetime.datetime.fromtimestamp(lastTime)
+    initialTime = datetime.datetime.fromtimestamp(firstTime)
+    startPoint = (startTime, m * lastTime + c)
+
+    # The final value to return is initialized, holding the trendline and the startpoint of each prediction line
+    predictionLines = [[(initialTime, m * firstTime + c), startPoint],
+                       [startPoint], #min3
+                       [startPoint], #min2
+                       [startPoint], #min1
+                       [startPoint], #0
+                       [startPoint], #max1
+                       [startPoint], #max2
+                       [startPoint]] #max3
+    # Append the prediction line values to each line
+    for p in range(-3, 4):
+        xVal = lastTime
+        for i in range(1, DISTANCE + 1):
+            # Calculate the point at each x value up to DISTANCE trades away and append it to the respective line array
+            xVal += timeGap
+            xValTime = datetime.datetime.fromtimestamp(xVal)
+            predictionLines[p + 4].append((xValTime, m * xVal + c + ((math.sqrt(i) * p) * stDev)))
+    return predictionLines
+
+    # Prediction line consists of start and end co-ordinates of:
+    # [trendline, 3rdDevDown, 2ndDevDown, 1stDevDown, trendlineContinued, 1stDevUp, 2ndDevUp, 3rdDevUp]
+
+
+class TrendlineSums:
+    '''
+    Running sums of times and prices of a symbol, so the
+    trendline can be fitted in O(1) as trades arrive
+    '''
+    def __init__(self):
+        self.n = 0
+        # Times are summed relative to the first trade to keep precision
+        self.origin = None
+        self.last = None
+        self.sum_t = 0.0
+        self.sum_p = 0.0
+        self.sum_tt = 0.0
+        self.sum_tp = 0.0
+        self.sum_pp = 0.0
+
+    def add(self, timestamp, price):
+        if self.origin is None:
+            self.origin = timestamp
+        t = timestamp - self.origin
+        self.n += 1
+        self.last = timestamp
+        self.sum_t += t
+        self.sum_p += price
+        self.sum_tt += t * t
+        self.sum_tp += t * price
+        self.sum_pp += price * price
+
+    def fit(self):
+        n = float(self.n)
+        denominator = n * self.sum_tt - self.sum_t ** 2
+        m = (n * self.sum_tp - self.sum_t * self.sum_p) / denominator
+        priceAvg = self.sum_p / n
+        c = priceAvg - m * (self.sum_t / n + self.origin)
+        # Rounding can make the variance very slightly negative
+        stDev = math.sqrt(max(self.sum_pp / n - priceAvg ** 2, 0.0))
+        timeGap = (self.last - self.origin) / n
+        return m, c, stDev, timeGap
+
+
+class Predictor:
+    '''
+    Keeps running sums for every symbol as trades arrive and
+    caches prediction lines by symbol and last trade id
+    '''
+    def __init__(self):
+        self.sums = {}
+        self.last_ids = {}
+        # symbol -> (last trade id, prediction lines)
+        self.cache = {}
+
+    def add(self, trade, identifier):
+        if trade.symbol not in self.sums:
+            self.sums[trade.symbol] = TrendlineSums()
+        self.sums[trade.symbol].add(to_timestamp(trade.time), trade.price)
+        self.last_ids[trade.symbol] = identifier
+
+    def predict(self, symbol):
+        sums = self.sums.get(symbol)
+        # A trendline needs two trades at different times
+        if sums is None or sums.n < 2 or sums.last == sums.origin:
+            return None
+        last_id = self.last_ids[symbol]
+        cached = self.cache.get(symbol)
+        if cached and cached[0] == last_id:
+            return cached[1]
+        m, c, stDev, timeGap = sums.fit()
+        lines = prediction_lines(m, c, stDev, timeGap, sums.origin, sums.last)
+        self.cache[symbol] = (last_id, lines)
+        return lines
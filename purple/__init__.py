@@ -1,3 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from purple.app import App
+
+# Importing purple must stay cheap (main.py --help), the
+# analysis stack is only loaded once a command runs
+def App(args):
+    '''
+    Run the command given by parsed main.py arguments, see purple.app.App
+    '''
+    from purple.app import App
+    return App(args)
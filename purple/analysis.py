@@ -1,18 +1,39 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import time
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import deque
 
 import rethinkdb as r
 from rethinkdb.errors import RqlRuntimeError, RqlDriverError
 
 from purple import db
 from purple.realtime import NotificationManager
+from purple.finance import Trade, local_time
 from purple.anomalous_trade_finder import AnomalousTradeFinder
+from purple.sectors import SectorTracker
+from purple.counterparties import TraderIndex, WashTradeFinder
+from purple.profiling import StageTimers
+from purple.tracing import Tracer, monotonic
+from purple import metrics
 
 tz = pytz.timezone('Europe/London')
 
+# Trades shown around a trade when reviewing its alert
+CONTEXT_BEFORE = timedelta(minutes=30)
+CONTEXT_AFTER = timedelta(minutes=5)
+
+# Trade ids reserved at once
+ID_BLOCK = 1000
+
+# Symbols known to be in the db, loaded in advance by the daemon
+known_symbols = set()
+
+# Seconds between two updates of the trade count on screen
+PROGRESS_INTERVAL = 0.5
+
 # write to screen
 def stdout_write(s):
     sys.stdout.write(s)
@@ -25,20 +46,46 @@ def reset_line():
 
 
 class TradesAnalyser:
-    def __init__(self, tradeacc_limit=2500):
+    def __init__(self, tradeacc_limit=2500, robust=False, spill=None, archive=None):
         # hold symbols in memory
         self.notification_manager = NotificationManager()
-        self.symbols = set() # a set has better lookup performance (hashtable)
+        self.symbols = set(known_symbols) # a set has better lookup performance (hashtable)
         self.trades_objs = []
         self.tradecount = 0
         self.tradeacc = 0
         self.anomalies = 0
-        self.anomaly_identifier = AnomalousTradeFinder()
+        self.anomaly_identifier = AnomalousTradeFinder(robust=robust, spill=spill)
         self.tradeacc_limit = tradeacc_limit
+        # ArchiveWriter every trade is also appended to
+        self.archive = archive
+        # rolling sector aggregates, updated with every trade
+        self.sector_tracker = SectorTracker()
+        # trader ids and counters per trader and pair of traders
+        self.trader_index = TraderIndex()
+        self.wash_trade_finder = WashTradeFinder()
+        # sector and trader anomalies found while storing trades for later analysis
+        self.pending_anomalies = []
+        # time spent in add, save_load, detection, alert and commit
+        self.timers = StageTimers()
+        # latency of traced trades from receipt, and their checkpoints
+        # (trade id, symbol, checkpoints) until saved then committed
+        self.tracer = Tracer()
+        self.traced_unsaved = []
+        self.traced_saved = []
 
-        # get last item in db and start holding current id
-        last_item = db.session.query(db.TradeModel).order_by(db.TradeModel.id.desc()).first()
-        self.current_pk = getattr(last_item, 'id', 0)
+        # ids reserved for the next trades, taken ID_BLOCK at a time
+        self.free_pks = deque()
+        self.current_pk = None
+        # symbols with trades not yet published as committed
+        self.changed_symbols = set()
+        # symbols added to the symbols table or with new characteristics
+        self.listed_symbols = set()
+        # ImportModel of the file being read, and the byte offset after its
+        # last added line, written with every batch of trades saved
+        self.import_record = None
+        self.read_offset = 0
+        # last time the trade count was written on screen
+        self.progress_at = 0
 
         self.notification_manager.add(
             level = 'info',
@@ -47,10 +94,22 @@ class TradesAnalyser:
         )
 
     def add(self, t, sha1_hash, firstday, commit=False):
-        # increment current id
-        self.current_pk = self.current_pk + 1
+        started = time.time()
+        # trades read from a feed carry the time they were received
+        checkpoints = None
+        if t.received is not None:
+            checkpoints = {'received': t.received, 'parse': t.parsed, 'queue': monotonic()}
+        # take the next reserved id
+        if not self.free_pks:
+            self.free_pks.extend(db.reserve_trade_ids(ID_BLOCK))
+        self.current_pk = self.free_pks.popleft()
         # get symbol from memory or insert into db
-        symbol_name = self.get_symbol(t.symbol)
+        symbol_name = self.get_symbol(t.symbol, t.sector)
+        self.changed_symbols.add(symbol_name)
+        # dictionary encode counterparties
+        buyer_id = self.trader_index.get_id(t.buyer)
+        seller_id = self.trader_index.get_id(t.seller)
+        self.trader_index.add(buyer_id, seller_id, t.size)
 
         # use mappings instead of instances for improved performance
         trade = {
@@ -60,6 +119,8 @@ class TradesAnalyser:
             'ask': t.ask,
             'size': t.size,
             'symbol_name': symbol_name,
+            'buyer_id': buyer_id,
+            'seller_id': seller_id,
             'flagged': False,
             #Using default postgres date formatting of m/d/y
             'analysis_date': datetime.now().strftime('%m/%d/%Y'),
@@ -68,80 +129,190 @@ class TradesAnalyser:
         }
 
         self.trades_objs.append(trade)
+        if self.archive:
+            self.archive.add(t)
         self.tradecount = self.tradecount + 1
         self.tradeacc = self.tradeacc + 1
+        metrics.TRADES.inc()
 
         # If it's a csv file or we're on our firstday, store the trade for future analysis
         if firstday:
             self.anomaly_identifier.add(t, self.current_pk)
         # Otherwise analyse one trade individually
         else:
+            detection_started = time.time()
             anomalies = self.anomaly_identifier.calculate_anomalies_single_trade(t, self.current_pk)
+            self.timers.record('detection', time.time() - detection_started)
+            if checkpoints:
+                checkpoints['detection'] = monotonic()
             if anomalies:
                 for anomaly in anomalies:
                     self.alert(anomaly)
                     self.flag(anomaly)
-                db.session.commit()
+                if checkpoints:
+                    checkpoints['alert'] = monotonic()
+                self.commit_session()
 
-        # inform user
-        stdout_write('Trades: {} (Ctrl-C to stop)'.format(self.tradecount))
-        reset_line()
+        # Update sector aggregates and look for wash trades, these anomalies
+        # are alerted straight away on live data or kept until alert_stats otherwise
+        found = self.sector_tracker.add(t, self.current_pk)
+        found += self.wash_trade_finder.add(t, buyer_id, seller_id, self.current_pk)
+        if firstday:
+            self.pending_anomalies.extend(found)
+        elif found:
+            for anomaly in found:
+                self.alert(anomaly)
+                self.flag(anomaly)
+            if checkpoints:
+                checkpoints['alert'] = monotonic()
+            self.commit_session()
+        if checkpoints:
+            self.traced_unsaved.append((self.current_pk, symbol_name, checkpoints))
+
+        # inform user, a few times a second at most
+        if started - self.progress_at >= PROGRESS_INTERVAL:
+            self.progress_at = started
+            stdout_write('Trades: {} (Ctrl-C to stop)'.format(self.tradecount))
+            reset_line()
 
         # flush database at accumulator limit
         if self.tradeacc == self.tradeacc_limit:
             self.save_load()
             if commit:
-                db.session.commit()
+                self.commit_session()
+                self.publish_changes()
             else:
                 db.session.flush()
+        self.timers.record('add', time.time() - started)
+
+    def reload_file(self, sha1_hash):
+        '''
+        Read back the trades of a file committed by an
+        interrupted import, so the analysis covers them
+        '''
+        query = db.session.query(db.TradeModel).filter_by(csv_hash=sha1_hash).order_by(db.TradeModel.id)
+        for row in query.yield_per(5000):
+            t = Trade.from_values(
+                time=local_time(row.datetime), price=row.price, size=row.size,
+                symbol=row.symbol_name, bid=row.bid, ask=row.ask
+            )
+            self.anomaly_identifier.add(t, row.id)
+            self.symbols.add(row.symbol_name)
+            self.tradecount = self.tradecount + 1
 
     def force_commit(self):
         self.save_load()
+        self.commit_session()
+        self.publish_changes()
+        if self.archive:
+            self.archive.flush()
+
+    def publish_changes(self):
+        # the frontend drops what it cached about these symbols
+        db.publish_symbols(self.changed_symbols, self.listed_symbols)
+        self.changed_symbols = set()
+        self.listed_symbols = set()
+
+    def commit_session(self):
+        started = time.time()
         db.session.commit()
+        elapsed = time.time() - started
+        self.timers.record('commit', elapsed)
+        metrics.COMMIT_SECONDS.observe(elapsed)
+        if self.traced_saved:
+            committed = monotonic()
+            for trade_pk, symbol, checkpoints in self.traced_saved:
+                checkpoints['commit'] = committed
+                self.tracer.finish(checkpoints, trade_pk, symbol)
+            self.traced_saved = []
 
     def save_load(self):
         # bulk save for improved performance
         if len(self.trades_objs):
+            started = time.time()
             db.session.bulk_insert_mappings(db.TradeModel, self.trades_objs)
+            self.timers.record('save_load', time.time() - started)
+            metrics.BATCH_SIZE.observe(len(self.trades_objs))
+        # the checkpoint only moves with the trades it covers, both are
+        # committed together (symbols and traders commit on their own)
+        if self.import_record is not None:
+            self.import_record.offset = self.read_offset
         # reset instance variables
         self.trades_objs = []
         self.tradeacc = 0
+        # traced trades are committed with the next commit
+        self.traced_saved.extend(self.traced_unsaved)
+        self.traced_unsaved = []
 
-    def get_symbol(self, s):
+    def get_symbol(self, s, sector=None):
         # try and get from memory
         if not s in self.symbols:
             # query db or create
-            symbol = db.SymbolModel.get_or_create(s)
+            symbol = db.SymbolModel.get_or_create(s, sector)
             self.symbols.add(s)
+            self.listed_symbols.add(s)
         return s
 
     def flag(self, anomaly):
         #Sometimes our id is a date of the anomaly, rather than a trade id
         if isinstance(anomaly["id"], ( int, long )):
+            # The trade may still be waiting to be saved
+            if self.trades_objs and self.trades_objs[-1]['id'] == anomaly["id"]:
+                self.trades_objs[-1]['flagged'] = True
+                return
             db.session.query(db.TradeModel).filter_by(id=anomaly["id"]).update({"flagged": True})
 
     def alert(self, anomaly):
+        doc = {
+            'time': anomaly["time"],
+            'trade_pk': anomaly["id"],
+            'description': anomaly["description"],
+            'reviewed': False,
+            'error_code': anomaly["error_code"],
+            'severity': anomaly["severity"],
+            'symbol': anomaly["symbol"]
+        }
+        # Sector anomalies also carry their sector (and symbols when collapsed),
+        # hourly and daily ones the [from, to) range of their trades
+        for key in ('sector', 'symbols', 'from', 'to'):
+            if key in anomaly:
+                doc[key] = anomaly[key]
+        # Trades around a single trade are shown with it when reviewing
+        if 'from' not in doc and isinstance(anomaly['time'], datetime):
+            doc['from'] = anomaly['time'] - CONTEXT_BEFORE
+            doc['to'] = anomaly['time'] + CONTEXT_AFTER
+
+        started = time.time()
         with db.get_reql_connection(db=True) as conn:
-            r.table('alerts').insert([{
-                'time': anomaly["time"],
-                'trade_pk': anomaly["id"],
-                'description': anomaly["description"],
-                'reviewed': False,
-                'error_code': anomaly["error_code"],
-                'severity': anomaly["severity"],
-                'symbol': anomaly["symbol"]
-            }]).run(conn, durability='soft')
+            r.table('alerts').insert([doc]).run(conn, durability='soft')
+            db.count_alerts(conn, [doc])
+        elapsed = time.time() - started
+        self.timers.record('alert', elapsed)
+        metrics.ALERT_SECONDS.observe(elapsed)
+        metrics.ANOMALIES.inc(code=anomaly['error_code'], severity=anomaly['severity'])
 
     def alert_stats(self, firstday, csv):
+        started = time.time()
         if firstday or csv:
             anomalies = self.anomaly_identifier.calculate_anomalies_first_day(csv)
         else:
             anomalies = self.anomaly_identifier.calculate_anomalies_end_of_day(datetime.now().strftime('%Y-%m-%d'))
 
+        self.timers.record('detection', time.time() - started)
+        anomalies = anomalies + self.pending_anomalies
+        self.pending_anomalies = []
+
+        # Every trade is flagged, but the same anomaly on many
+        # symbols of a sector is alerted only once
         for anomaly in anomalies:
-            self.alert(anomaly)
             self.flag(anomaly)
+        for anomaly in self.sector_tracker.collapse(anomalies):
+            self.alert(anomaly)
 
-        db.session.commit()
+        self.commit_session()
+        # Flags and characteristics of every analysed symbol changed
+        self.changed_symbols.update(self.anomaly_identifier.stats)
+        self.listed_symbols.update(self.anomaly_identifier.stats)
+        self.publish_changes()
 
         print 'Found ' + str(len(anomalies)) + ' anomalies'
@@ -9,6 +9,8 @@ from numpy import std, mean
 # For date management
 from datetime import datetime, timedelta
 from purple import db
+from purple.sketches import QuantileSketch, SKETCH_FIELDS, robust_centre_scale
+from purple.sectors import RunningStats
 
 # Used for square roots
 import math
@@ -19,10 +21,27 @@ import pytz
 # Set our timezone
 tz = pytz.timezone('Europe/London')
 
+# Values added to a sketch before its robust centre and scale are recalculated,
+# also the trades of a symbol seen before its first day trades are checked
+ROBUST_REFRESH = 100
+
 class AnomalousTradeFinder:
-    def __init__(self):
+    def __init__(self, robust=False, persist=True, spill=None):
+        # Spill trades to disk (SymbolSpill) instead of keeping them in trade_history,
+        # unused when robust as the trades aren't kept at all
+        self.spill = spill
+        # Write symbol characteristics to the db (off for backtests)
+        self.persist = persist
+        # Use median and MAD from quantile sketches instead of mean and stdev
+        self.robust = robust
+        # Stores a quantile sketch per symbol for every field in SKETCH_FIELDS
+        self.sketches = {}
+        # Stores (count, centre, scale) per (symbol, field) last calculated from the sketches
+        self.robust_bounds = {}
         # Stores all trades for first day or csv
         self.trade_history = {}
+        # Stores running first day statistics per symbol when robust, instead of trade_history
+        self.first_day = {}
         # A list of anomalies found in the data
         self.anomalous_trades = []
         # Stores statistics about each symbol
@@ -34,154 +53,279 @@ class AnomalousTradeFinder:
 
     # Stores relevant information about trades in a dictionary of a list of dictionaries
     def add(self, trade, identifier):
-        # Add our trade into memory
-        if trade.symbol not in self.trade_history:
-            self.trade_history[trade.symbol] = [{
-                'time': trade.time,
-                'id': identifier,
-                'price': trade.price,
-                'price_delta': 0,
-                'volume': trade.size,
-                'bid_ask_spread': trade.ask - trade.bid
-            }]
+        if self.robust:
+            self._add_robust(trade, identifier)
+            return
+        row = {
+            'time': trade.time,
+            'id': identifier,
+            'price': trade.price,
+            'price_delta': 0,
+            'volume': trade.size,
+            'bid_ask_spread': trade.ask - trade.bid
+        }
+        last_price = self._last_price(trade.symbol)
+        if last_price is not None:
+            # Round to stop float errors
+            row['price_delta'] = round(trade.price - last_price, 3)
+
+        # Add our trade into memory, or to disk when spilling
+        if self.spill:
+            self.spill.append(trade.symbol, row)
+        elif trade.symbol not in self.trade_history:
+            self.trade_history[trade.symbol] = [row]
         else:
-            price_delta = trade.price - self.trade_history[trade.symbol][-1]["price"]
-            self.trade_history[trade.symbol].append({
-                'time': trade.time,
-                'id': identifier,
-                'price': trade.price,
-                # Round to stop float errors
-                'price_delta': round(price_delta,3),
-                'volume': trade.size,
-                'bid_ask_spread': trade.ask - trade.bid
-            })
+            self.trade_history[trade.symbol].append(row)
         # Add appropriate stats into memory
         if trade.symbol not in self.stats:
-            self.stats[trade.symbol] = {
-                'trade_count_per_min': 1,
-                'minutes': 1,
-                'prev_minutes_total_trades': 0,
-                'current_minute': trade.time.strftime("%M"),
-                'current_hour': trade.time.strftime("%H"),
-                'hourly_vol': [0],
-                'hourly_max_change':[0],
-                'hourly_max': trade.price,
-                'hourly_min': trade.price
-            }
+            self.stats[trade.symbol] = self._initial_stats(trade)
         else:
             self.stats[trade.symbol]["trade_count_per_min"] += 1
 
+    # Stats of a symbol after its first trade
+    def _initial_stats(self, trade):
+        return {
+            'trade_count_per_min': 1,
+            'minutes': 1,
+            'prev_minutes_total_trades': 0,
+            'current_minute': trade.time.strftime("%M"),
+            'current_hour': trade.time.strftime("%H"),
+            'hourly_vol': [0],
+            'hourly_max_change':[0],
+            'hourly_max': trade.price,
+            'hourly_min': trade.price
+        }
+
+    # Counters of the walk through a symbol's first day in _first_day_trade
+    def _first_day_state(self):
+        return {
+            # Trades in the current minute
+            'trade_count': 1,
+            # Index of the current hour in hourly_vol
+            'hour': 0,
+            # Hourly max and min start again with the next trade
+            'reset_prices': False
+        }
+
+    # Robust first day: statistics are kept up to date as trades come and
+    # fat fingers are checked against the sketches of the trades seen so
+    # far, so the first day holds no trades
+    def _add_robust(self, trade, identifier):
+        key = trade.symbol
+        if key not in self.stats:
+            self.stats[key] = self._initial_stats(trade)
+            self.stats[key]['hour_starts'] = [trade.time.replace(minute=0, second=0, microsecond=0)]
+            self.first_day[key] = dict(self._first_day_state(), **{
+                'deltas': RunningStats(),
+                'volumes': RunningStats(),
+                'total_volume': 0,
+                'first_price': trade.price,
+                'before_last_price': trade.price
+            })
+        state = self.first_day[key]
+
+        last_price = self.prev_trades.get(key)
+        price_delta = 0
+        if last_price is not None:
+            # Round to stop float errors
+            price_delta = round(trade.price - last_price, 3)
+            state['before_last_price'] = last_price
+        self.prev_trades[key] = trade.price
+
+        state['deltas'].add(price_delta)
+        state['volumes'].add(trade.size)
+        state['total_volume'] += trade.size
+        self._update_sketches(key, price_delta, trade.size)
+        self._first_day_trade(key, state, trade.time, trade.size, trade.price)
+
+        # Check for bid ask spread errors
+        if trade.ask - trade.bid < 0:
+            description = 'Negative bid ask spread for ' + key
+            self.add_anomaly(identifier, trade.time, description, 'NBAS', 1, key)
+
+        # The centre and scale of a handful of trades would flag most of the next ones
+        if state['volumes'].count >= ROBUST_REFRESH:
+            delta_centre, delta_scale = self._robust_bounds(key, 'price_delta', state['deltas'].stdev())
+            vol_centre, vol_scale = self._robust_bounds(key, 'volume', state['volumes'].stdev())
+            self._fat_finger_price(price_delta, delta_centre, delta_scale, identifier, trade.time, key)
+            self._fat_finger_volume(trade.size, vol_centre, vol_scale, identifier, trade.time, key)
+
     # This calculates the values after a CSV or the first day of stream data
     def calculate_anomalies_first_day(self, csv):
-        self.anomalous_trades = []
+        if self.robust:
+            # Fat fingers and spread errors were found as the trades came
+            for key in self.first_day.keys():
+                self._finish_robust_first_day(key)
+            return self.anomalous_trades
 
-        # Iterate through the all the data
-        for key in self.trade_history:
-            volumes = [x["volume"] for x in self.trade_history[key]]
-            deltas = [x["price_delta"] for x in self.trade_history[key]]
-            ids = [x["id"] for x in self.trade_history[key]]
-            times = [x["time"] for x in self.trade_history[key]]
-            prices = [x["price"] for x in self.trade_history[key]]
-
-            # Get the price of the last added trade for that symbol
-            self.prev_trades[key] = self.trade_history[key][-1]["price"]
-
-            # Update stats with correctly calculated values
-            self.stats[key] = {
-                # Number of trades per min for symbol
-                'trade_count_per_min': self.stats[key]["trade_count_per_min"],
-                # Used for average trades per min calculations
-                'minutes': self.stats[key]["minutes"],
-                # Used for average trades per min calculations
-                'prev_minutes_total_trades': self.stats[key]["prev_minutes_total_trades"],
-                # Used for average trades per min calculations
-                'current_minute': self.stats[key]["current_minute"],
-                # Used for volume spike and pump and dump/bear raid detection
-                'current_hour': self.stats[key]["current_hour"],
-                # List of hourly volumes for each hour
-                'hourly_vol': self.stats[key]["hourly_vol"],
-                # List of highest hourly price changes for each hour
-                'hourly_max_change': self.stats[key]["hourly_max_change"],
-                # Highest price in an hour
-                'hourly_max': self.stats[key]["hourly_max"],
-                # Lowest price in an hour
-                'hourly_min': self.stats[key]["hourly_min"],
-                # Average price change
-                'delta_mean': mean(deltas),
-                # Standard deviation of price change
-                'delta_stdev': std(deltas),
-                # Average volume
-                'vol_mean': mean(volumes),
-                # Standard deviation of volume
-                'vol_stdev': std(volumes),
-                # The count of trades
-                'trade_count': len(volumes),
-                # Daily total volume standard deviation
-                'total_vol_stdev': 0,
-                # Daily total volume mean
-                'total_vol_mean': sum(volumes),
-                # Mean open to close change price for day
-                'day_price_change_mean': self.trade_history[key][-1]["price"] - self.trade_history[key][0]["price"],
-                # Standard deviation of open to close price change for day
-                'day_price_change_stdev': 0,
-                # Number of days analysed
-                'day_count': 1,
-                # Percentage price change between final trades
-                'price_change_percentage': (self.trade_history[key][-1]["price"] / float(self.trade_history[key][-2]["price"]))
-            }
-
-            # Check for fat finger errors in the day's data
-            self.calculate_fat_finger(volumes, deltas, ids, times, key)
-            trade_count = 1
-
-            # Keep track of index in array of hourly volume sums
-            index_pointer = 0
-            # Count of trades we've iterated through
-            vol_counter = 0
-
-            # Iterate through the day of trades
-            for time in times:
-                # Calculate statistics for db table
-                if self._calculate_trades_per_min(time, trade_count, key):
-                    trade_count = 0
-                trade_count += 1
-
-                # Calculate volumes for every hour, get max change in price for that hour
-                if self.stats[key]["current_hour"] != time.strftime("%H"):
-                    self.stats[key]["current_hour"] = time.strftime("%H")
-                    self.stats[key]["hourly_vol"].append(0)
-                    self.stats[key]["hourly_max_change"][index_pointer] = self.stats[key]["hourly_max"] - self.stats[key]["hourly_min"]
-                    self.stats[key]["hourly_max_change"].append(0)
-                    # Reset current min and max with first trade of new hour
-                    self.stats[key]["hourly_max"] = prices[vol_counter + 1]
-                    self.stats[key]["hourly_min"] = prices[vol_counter + 1]
-                    index_pointer += 1
-                else:
-                    self.stats[key]["hourly_vol"][index_pointer] += volumes[vol_counter]
-                    if prices[vol_counter] > self.stats[key]["hourly_max"]:
-                        self.stats[key]["hourly_max"] = prices[vol_counter]
-                    if prices[vol_counter] < self.stats[key]["hourly_min"]:
-                        self.stats[key]["hourly_min"] = prices[vol_counter]
-
-                # Check for bid ask spread errors
-                if self.trade_history[key][vol_counter]["bid_ask_spread"] < 0:
-                    description = 'Negative bid ask spread for ' + key
-                    self.add_anomaly(ids[vol_counter], times[vol_counter], description, 'NBAS', 1, key)
-                    
-                vol_counter += 1
-
-            # Check for volume spikes
-            self._calculate_vol_spikes(key)
-            # Update statsistics
-            self.update_characteristics(key)
+        self.anomalous_trades = []
 
-            db.session.commit()
+        if self.spill:
+            # Only one symbol is held in memory at a time
+            for key in self.spill.symbols():
+                self.trade_history[key] = self.spill.load(key)
+                self._analyse_first_day(key)
+                del self.trade_history[key]
+            self.spill.close()
+            self.spill = None
+        else:
+            # Iterate through the all the data
+            for key in self.trade_history:
+                self._analyse_first_day(key)
 
         # We don't need the trades anymore
         self.trade_history = {}
 
         return self.anomalous_trades
 
+    # Calculates stats and anomalies of one symbol from its trades in trade_history
+    def _analyse_first_day(self, key):
+        volumes = [x["volume"] for x in self.trade_history[key]]
+        deltas = [x["price_delta"] for x in self.trade_history[key]]
+        ids = [x["id"] for x in self.trade_history[key]]
+        times = [x["time"] for x in self.trade_history[key]]
+        prices = [x["price"] for x in self.trade_history[key]]
+
+        # Get the price of the last added trade for that symbol
+        self.prev_trades[key] = self.trade_history[key][-1]["price"]
+
+        # Update stats with correctly calculated values
+        self.stats[key] = {
+            # Number of trades per min for symbol
+            'trade_count_per_min': self.stats[key]["trade_count_per_min"],
+            # Used for average trades per min calculations
+            'minutes': self.stats[key]["minutes"],
+            # Used for average trades per min calculations
+            'prev_minutes_total_trades': self.stats[key]["prev_minutes_total_trades"],
+            # Used for average trades per min calculations
+            'current_minute': self.stats[key]["current_minute"],
+            # Used for volume spike and pump and dump/bear raid detection
+            'current_hour': self.stats[key]["current_hour"],
+            # List of hourly volumes for each hour
+            'hourly_vol': self.stats[key]["hourly_vol"],
+            # Start of every hour in hourly_vol
+            'hour_starts': [times[0].replace(minute=0, second=0, microsecond=0)],
+            # List of highest hourly price changes for each hour
+            'hourly_max_change': self.stats[key]["hourly_max_change"],
+            # Highest price in an hour
+            'hourly_max': self.stats[key]["hourly_max"],
+            # Lowest price in an hour
+            'hourly_min': self.stats[key]["hourly_min"],
+            # Average price change
+            'delta_mean': mean(deltas),
+            # Standard deviation of price change
+            'delta_stdev': std(deltas),
+            # Average volume
+            'vol_mean': mean(volumes),
+            # Standard deviation of volume
+            'vol_stdev': std(volumes),
+            # The count of trades
+            'trade_count': len(volumes),
+            # Daily total volume standard deviation
+            'total_vol_stdev': 0,
+            # Daily total volume mean
+            'total_vol_mean': sum(volumes),
+            # Mean open to close change price for day
+            'day_price_change_mean': self.trade_history[key][-1]["price"] - self.trade_history[key][0]["price"],
+            # Standard deviation of open to close price change for day
+            'day_price_change_stdev': 0,
+            # Number of days analysed
+            'day_count': 1,
+            # Percentage price change between final trades
+            'price_change_percentage': (self.trade_history[key][-1]["price"] / float(self.trade_history[key][-2]["price"]))
+        }
+
+        # Check for fat finger errors in the day's data
+        self.calculate_fat_finger(volumes, deltas, ids, times, key)
+
+        # Iterate through the day of trades
+        state = self._first_day_state()
+        for counter in range(len(times)):
+            self._first_day_trade(key, state, times[counter], volumes[counter], prices[counter])
+
+            # Check for bid ask spread errors
+            if self.trade_history[key][counter]["bid_ask_spread"] < 0:
+                description = 'Negative bid ask spread for ' + key
+                self.add_anomaly(ids[counter], times[counter], description, 'NBAS', 1, key)
+
+        self._finish_first_day(key, state, prices[-1])
+
+    # Stats and anomalies of a robust first day, from the counters kept by _add_robust
+    def _finish_robust_first_day(self, key):
+        state = self.first_day.pop(key)
+        last_price = self.prev_trades[key]
+        # Trades per minute are only averaged once a minute is over
+        if self.stats[key]["minutes"] == 1:
+            self.stats[key]["trade_count_per_min"] = state['volumes'].count
+        self.stats[key].update({
+            'delta_mean': state['deltas'].mean,
+            'delta_stdev': state['deltas'].stdev(),
+            'vol_mean': state['volumes'].mean,
+            'vol_stdev': state['volumes'].stdev(),
+            'trade_count': state['volumes'].count,
+            'total_vol_stdev': 0,
+            'total_vol_mean': state['total_volume'],
+            'day_price_change_mean': last_price - state['first_price'],
+            'day_price_change_stdev': 0,
+            'day_count': 1,
+            'price_change_percentage': last_price / float(state['before_last_price'])
+        })
+        self._finish_first_day(key, state, last_price)
+
+    # Hourly and per minute stats of a first day, one trade at a time
+    def _first_day_trade(self, key, state, time, volume, price):
+        stats = self.stats[key]
+        # First trade of a new hour
+        if state['reset_prices']:
+            stats["hourly_max"] = price
+            stats["hourly_min"] = price
+            state['reset_prices'] = False
+
+        # Calculate statistics for db table
+        if self._calculate_trades_per_min(time, state['trade_count'], key):
+            state['trade_count'] = 0
+        state['trade_count'] += 1
+
+        # Calculate volumes for every hour, get max change in price for that hour
+        if stats["current_hour"] != time.strftime("%H"):
+            stats["current_hour"] = time.strftime("%H")
+            stats["hourly_vol"].append(0)
+            stats["hour_starts"].append(time.replace(minute=0, second=0, microsecond=0))
+            stats["hourly_max_change"][state['hour']] = stats["hourly_max"] - stats["hourly_min"]
+            stats["hourly_max_change"].append(0)
+            # Reset current min and max with the next trade
+            state['reset_prices'] = True
+            state['hour'] += 1
+        else:
+            stats["hourly_vol"][state['hour']] += volume
+            if price > stats["hourly_max"]:
+                stats["hourly_max"] = price
+            if price < stats["hourly_min"]:
+                stats["hourly_min"] = price
+
+    # Volume spikes and characteristics once every trade of a first day was seen
+    def _finish_first_day(self, key, state, last_price):
+        # There is no trade after the last one to start its hour with
+        if state['reset_prices']:
+            self.stats[key]["hourly_max"] = last_price
+            self.stats[key]["hourly_min"] = last_price
+
+        # Check for volume spikes
+        self._calculate_vol_spikes(key)
+        # Update statsistics
+        self.update_characteristics(key)
+
+        if self.persist:
+            db.session.commit()
+
+    # Price of the last trade added for a symbol, None if it's the first one
+    def _last_price(self, symbol):
+        if self.spill:
+            return self.spill.last_price(symbol)
+        if symbol in self.trade_history:
+            return self.trade_history[symbol][-1]["price"]
+        return None
+
     # Calculates the average trades per minute per symbol
     def _calculate_trades_per_min(self, time, trade_count, key):
         if time.strftime("%M") != self.stats[key]["current_minute"]:
@@ -213,31 +357,39 @@ class AnomalousTradeFinder:
 
         # Check to see if the volumes are outside of the range of 3, 4, 5 standard deviations and give appropriate severity
         for volume in self.stats[key]["hourly_vol"]:
+            window = self._hour_window(key, index)
             if volume >= mean_vol + 5 * vol_stdev:
                 spike = True
                 description = 'Hourly volume spike from ' + str(index + 1) + ' to ' + str(index + 2) + ' for ' + key
-                self.add_anomaly(-1, index + 1, description, 'VS', 1, key)
+                self.add_anomaly(-1, index + 1, description, 'VS', 1, key, window)
                 sev = 1
             elif volume >= mean_vol + 4 * vol_stdev:
                 spike = True
                 description = 'Hourly volume spike from ' + str(index + 1) + ' to ' + str(index + 2) + ' for ' + key
-                self.add_anomaly(-1, index + 1, description, 'VS', 2, key)
+                self.add_anomaly(-1, index + 1, description, 'VS', 2, key, window)
                 sev = 2
             elif volume >= mean_vol + 3 * vol_stdev:
                 spike = True
                 description = 'Hourly volume spike from ' + str(index + 1) + ' to ' + str(index + 2) + ' for ' + key
-                self.add_anomaly(-1, index + 1, description, 'VS', 3, key)
+                self.add_anomaly(-1, index + 1, description, 'VS', 3, key, window)
                 sev = 3
             # If there's a spike, look for pump and dump/bear raid too
             if spike:
                 self._calculate_pump_bear(key, index, mean_max_price_change, max_price_change_stdev, sev)
             index += 1
 
+    # Trades of the hour at `index` of hourly_vol, as [from, to)
+    def _hour_window(self, key, index):
+        starts = self.stats[key].get("hour_starts", [])
+        if index >= len(starts):
+            return None
+        return (starts[index], starts[index] + timedelta(hours=1))
+
     # Check for pump and dump/bear raid by looking to see if the max hourly change was outside of 2 standard deviations
     def _calculate_pump_bear(self, key, hour, mean, stdev, sev):
         if self.stats[key]["hourly_max_change"][hour] > mean +  2 * stdev:
             description = 'Hourly pump and dump/bear raid from ' + str(hour + 1) + ' to ' + str(hour + 2) + ' for ' + key
-            self.add_anomaly(-1, hour + 1, description, 'PDBR', sev, key)
+            self.add_anomaly(-1, hour + 1, description, 'PDBR', sev, key, self._hour_window(key, hour))
             
 
     # We call this when analysing a trade from the stream that isn't from the first day
@@ -256,29 +408,37 @@ class AnomalousTradeFinder:
 
         # Calculate new stdev for price deltas using Welford's method
         delta_values = self.welford(trade_count, price_delta_stdev, price_delta_mean, new_delta_to_add)
+        # Recalculate new mean and standard deviation of volumes
+        vol_values = self.welford(trade_count, vol_stdev, vol_mean, new_vol_to_add)
+
+        # Pick the centre and scale the thresholds are built from
+        if self.robust:
+            self._update_sketches(trade.symbol, new_delta_to_add, new_vol_to_add)
+            delta_centre, delta_scale = self._robust_bounds(trade.symbol, 'price_delta', delta_values["stdev"])
+            vol_centre, vol_scale = self._robust_bounds(trade.symbol, 'volume', vol_values["stdev"])
+        else:
+            delta_centre, delta_scale = delta_values["mean"], delta_values["stdev"]
+            vol_centre, vol_scale = vol_values["mean"], vol_values["stdev"]
 
         # Check to see if new standard deviation indicates fat finger error, categorise by severity
-        if new_delta_to_add >= delta_values["stdev"] * 7 + delta_values["mean"]:
+        if new_delta_to_add >= delta_scale * 7 + delta_centre:
             description = 'Fat finger error on price for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFP', 1, trade.symbol)
-        elif new_delta_to_add >= delta_values["stdev"] * 6 + delta_values["mean"]:
+        elif new_delta_to_add >= delta_scale * 6 + delta_centre:
             description = 'Fat finger error on price for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFP', 2, trade.symbol)
-        elif new_delta_to_add >= delta_values["stdev"] * 5 + delta_values["mean"]:
+        elif new_delta_to_add >= delta_scale * 5 + delta_centre:
             description = 'Fat finger error on price for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFP', 3, trade.symbol)
 
-        # Recalculate new mean and standard deviation of volumes
-        vol_values = self.welford(trade_count, vol_stdev, vol_mean, new_vol_to_add)
-
         # Check if new stdev indicates fat finger error, categorise by severity
-        if new_vol_to_add >= vol_values["stdev"] * 7 + vol_values["mean"]:
+        if new_vol_to_add >= vol_scale * 7 + vol_centre:
             description = 'Fat finger error on volume for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFV', 1, trade.symbol)
-        elif new_vol_to_add >= vol_values["stdev"] * 6 + vol_values["mean"]:
+        elif new_vol_to_add >= vol_scale * 6 + vol_centre:
             description = 'Fat finger error on volume for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFV', 2, trade.symbol)
-        elif new_vol_to_add >= vol_values["stdev"] * 5 + vol_values["mean"]:
+        elif new_vol_to_add >= vol_scale * 5 + vol_centre:
             description = 'Fat finger error on volume for ' + trade.symbol
             self.add_anomaly(identifier, trade.time, description, 'FFV', 3, trade.symbol)
 
@@ -297,7 +457,7 @@ class AnomalousTradeFinder:
         self.update_characteristics_count += 1
 
         # If we've seen enough trades, update characteristics
-        if self.update_characteristics_count == 50:
+        if self.update_characteristics_count == 50 and self.persist:
             db.session.commit()
             self.update_characteristics_count = 0
 
@@ -342,6 +502,8 @@ class AnomalousTradeFinder:
             day_price_change_stdev = self.stats[key]["day_price_change_stdev"]
 
             to_add = volume.fetchone()[0]
+            day_start = tz.localize(datetime.strptime(date, '%Y-%m-%d'))
+            window = (day_start, day_start + timedelta(days=1))
 
             # Calculate new mean and standard deviation for day's volume
             new_vol_stdev_mean = self.welford(day_count, total_vol_stdev, total_vol_mean, float(to_add))
@@ -359,28 +521,28 @@ class AnomalousTradeFinder:
             if to_add >= new_vol_stdev_mean["mean"] + 7 * new_vol_stdev_mean["stdev"]:
                 spike = True
                 description = 'Volume spike over past day for ' + key
-                self.add_anomaly(date, -1, description, 'VS', 1, key)
+                self.add_anomaly(date, -1, description, 'VS', 1, key, window)
             elif to_add >= new_vol_stdev_mean["mean"] + 6 * new_vol_stdev_mean["stdev"]:
                 spike = True
                 description = 'Volume spike over past day for ' + key
-                self.add_anomaly(date, -1, description, 'VS', 2, key)
+                self.add_anomaly(date, -1, description, 'VS', 2, key, window)
             elif to_add >= new_vol_stdev_mean["mean"] + 5 * new_vol_stdev_mean["stdev"]:
                 spike = True
                 description = 'Volume spike over past day for ' + key
-                self.add_anomaly(date, -1, description, 'VS', 3, key)
+                self.add_anomaly(date, -1, description, 'VS', 3, key, window)
 
             # If there's a volume spike, check for a pump and dump
             if spike:
                 # Pump and dump if price change is outside of n * stdev + mean, where n decides severity
                 if price_change_to_add >= new_day_change_mean_stdev["mean"] + 7 * new_day_change_mean_stdev["stdev"]:
                     description = 'Pump and dump/bear raid over past day for ' + key
-                    self.add_anomaly(date, -1, description, 'PDBR', 1, key)
+                    self.add_anomaly(date, -1, description, 'PDBR', 1, key, window)
                 elif price_change_to_add >= new_day_change_mean_stdev["mean"] + 6 * new_day_change_mean_stdev["stdev"]:
                     description = 'Pump and dump/bear raid over past day for ' + key
-                    self.add_anomaly(date, -1, description, 'PDBR', 2, key)
+                    self.add_anomaly(date, -1, description, 'PDBR', 2, key, window)
                 elif price_change_to_add >= new_day_change_mean_stdev["mean"] + 5 * new_day_change_mean_stdev["stdev"]:
                     description = 'Pump and dump/bear raid over past day for ' + key
-                    self.add_anomaly(date, -1, description, 'PDBR', 3, key)
+                    self.add_anomaly(date, -1, description, 'PDBR', 3, key, window)
 
             # Update stats with new total vol stdev and mean, and new count of days
             self.stats[key]['total_vol_stdev'] = new_vol_stdev_mean['stdev']
@@ -397,34 +559,81 @@ class AnomalousTradeFinder:
 
     # Calculate fat finger errors on volume and price, add every one to anomalous_trades
     def calculate_fat_finger(self, volumes, deltas, ids, times, key):
-        counter = 0
-        # Categorise based on severity
-        for value in deltas:
-            if value >= self.stats[key]["delta_mean"] + 7 * self.stats[key]["delta_stdev"] or value <= (self.stats[key]["delta_mean"] - 7 * self.stats[key]["delta_stdev"]):
-                description = 'Fat finger error on price for ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFP', 1, key)
-            elif value >= self.stats[key]["delta_mean"] + 6 * self.stats[key]["delta_stdev"] or value <= (self.stats[key]["delta_mean"] - 6 * self.stats[key]["delta_stdev"]):
-                description = 'Fat finger error on price for ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFP', 2, key)
-            elif value >= self.stats[key]["delta_mean"] + 5 * self.stats[key]["delta_stdev"] or value <= (self.stats[key]["delta_mean"] - 5 * self.stats[key]["delta_stdev"]):
-                description = 'Fat finger error on price for ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFP', 3, key)
-            counter += 1
-        counter = 0
-        for volume in volumes:
-            if volume >= self.stats[key]["vol_mean"] + 7 * self.stats[key]["vol_stdev"]:
-                description = 'Fat finger error on volume ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFV', 1, key)
-            elif volume >= self.stats[key]["vol_mean"] + 6 * self.stats[key]["vol_stdev"]:
-                description = 'Fat finger error on volume ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFV', 2, key)
-            elif volume >= self.stats[key]["vol_mean"] + 5 * self.stats[key]["vol_stdev"]:
-                description = 'Fat finger error on volume ' + key
-                self.add_anomaly(ids[counter], times[counter], description, 'FFV', 3, key)
-            counter += 1
+        # Centre and scale of thresholds, robust ones come from the sketches
+        if self.robust and key in self.sketches:
+            delta_centre, delta_scale = self._robust_bounds(key, 'price_delta', self.stats[key]["delta_stdev"])
+            vol_centre, vol_scale = self._robust_bounds(key, 'volume', self.stats[key]["vol_stdev"])
+        else:
+            delta_centre, delta_scale = self.stats[key]["delta_mean"], self.stats[key]["delta_stdev"]
+            vol_centre, vol_scale = self.stats[key]["vol_mean"], self.stats[key]["vol_stdev"]
+
+        for counter in range(len(deltas)):
+            self._fat_finger_price(deltas[counter], delta_centre, delta_scale, ids[counter], times[counter], key)
+        for counter in range(len(volumes)):
+            self._fat_finger_volume(volumes[counter], vol_centre, vol_scale, ids[counter], times[counter], key)
+
+    # Add a fat finger anomaly on price if value is too far from the centre, categorise based on severity
+    def _fat_finger_price(self, value, centre, scale, identifier, time, key):
+        if value >= centre + 7 * scale or value <= (centre - 7 * scale):
+            description = 'Fat finger error on price for ' + key
+            self.add_anomaly(identifier, time, description, 'FFP', 1, key)
+        elif value >= centre + 6 * scale or value <= (centre - 6 * scale):
+            description = 'Fat finger error on price for ' + key
+            self.add_anomaly(identifier, time, description, 'FFP', 2, key)
+        elif value >= centre + 5 * scale or value <= (centre - 5 * scale):
+            description = 'Fat finger error on price for ' + key
+            self.add_anomaly(identifier, time, description, 'FFP', 3, key)
+
+    # Add a fat finger anomaly on volume if it's too far above the centre, categorise based on severity
+    def _fat_finger_volume(self, volume, centre, scale, identifier, time, key):
+        if volume >= centre + 7 * scale:
+            description = 'Fat finger error on volume ' + key
+            self.add_anomaly(identifier, time, description, 'FFV', 1, key)
+        elif volume >= centre + 6 * scale:
+            description = 'Fat finger error on volume ' + key
+            self.add_anomaly(identifier, time, description, 'FFV', 2, key)
+        elif volume >= centre + 5 * scale:
+            description = 'Fat finger error on volume ' + key
+            self.add_anomaly(identifier, time, description, 'FFV', 3, key)
+
+    # Add a trade's values to the quantile sketches of its symbol
+    def _update_sketches(self, symbol, price_delta, volume):
+        if symbol not in self.sketches:
+            self.sketches[symbol] = dict((field, QuantileSketch()) for field in SKETCH_FIELDS)
+        self.sketches[symbol]['price_delta'].add(price_delta)
+        self.sketches[symbol]['volume'].add(volume)
+
+    # Median and scaled MAD of a field, falls back to the stdev when the MAD is 0
+    # (e.g. a quiet symbol where most price deltas are 0). Only recalculated
+    # every ROBUST_REFRESH values added, they barely move between
+    def _robust_bounds(self, symbol, field, stdev):
+        sketch = self.sketches[symbol][field]
+        cached = self.robust_bounds.get((symbol, field))
+        if cached is None or sketch.count - cached[0] >= ROBUST_REFRESH:
+            cached = (sketch.count,) + robust_centre_scale(sketch)
+            self.robust_bounds[(symbol, field)] = cached
+        _, centre, scale = cached
+        if not scale:
+            scale = stdev
+        return centre, scale
+
+    # Merge the sketches of another finder (e.g. one per shard) into this one
+    def merge_sketches(self, other):
+        for symbol in other.sketches:
+            if symbol not in self.sketches:
+                self.sketches[symbol] = dict((field, QuantileSketch()) for field in SKETCH_FIELDS)
+            for field in SKETCH_FIELDS:
+                self.sketches[symbol][field].merge(other.sketches[symbol][field])
+                self.robust_bounds.pop((symbol, field), None)
+
+    # Median, MAD and high percentiles of every field for a symbol
+    def sketch_summary(self, symbol):
+        return dict((field, self.sketches[symbol][field].summary()) for field in SKETCH_FIELDS)
 
     # Insert already calculate characteristics in the db
     def update_characteristics(self, symbol):
+        if not self.persist:
+            return
         to_insert = {
             'average_volume': self.stats[symbol]["vol_mean"],
             'average_daily_volume': self.stats[symbol]["total_vol_mean"],
@@ -436,16 +645,20 @@ class AnomalousTradeFinder:
         }
         db.session.query(db.SymbolModel).filter_by(name=symbol).update(to_insert)
 
-    # Add an anomaly to our list of anomalies to be written to db
-    def add_anomaly(self, identifier, time, description, error_code, severity, symbol):
-        self.anomalous_trades.append({
+    # Add an anomaly to our list of anomalies to be written to db,
+    # window is the [from, to) time range of the trades it's about
+    def add_anomaly(self, identifier, time, description, error_code, severity, symbol, window=None):
+        anomaly = {
             'id': identifier,
             'time': time,
             'description': description,
             'error_code': error_code,
             'severity': severity,
             'symbol': symbol
-        })
+        }
+        if window:
+            anomaly['from'], anomaly['to'] = window
+        self.anomalous_trades.append(anomaly)
         return True
         
 
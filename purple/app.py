@@ -13,31 +13,67 @@ import signal
 import socket
 # Used to generate hash of csv
 import hashlib
+# Used to hash files without reading them in python
+import mmap
 # Used for exit handling
 import atexit
 # Used for time handling
 import time
+# Used to read many feeds next to the analysis
+import threading
 # Used for datetime handling
-from datetime import datetime, timedelta
-# rethinkDB
-import rethinkdb as r
+from datetime import datetime, timedelta, date
 
 # PostgreSQL
 from purple import db
-from purple.realtime import NotificationManager, TaskManager
+from purple.realtime import NotificationManager, TaskManager, OutageLog
 from purple.finance import Trade
-from purple.analysis import TradesAnalyser
+from purple.feeds import Feed, FeedMultiplexer, open_feed, parse_feed
+from purple.pipeline import OverflowQueue, Stage, StreamReader, pipeline_metrics, BLOCK, SHED, SPILL, QUEUE_SIZE
+from purple.scheduler import MAX_RUNNING
+from purple.profiling import profiled, profile_path
+from purple.metrics import PARSE_ERRORS, QUEUE_DEPTH, registry, serve_metrics, MetricsWriter
+from purple.tracing import monotonic
+# The analysis (numpy) and multiprocess modules are imported by
+# the commands using them, --init-db and --reset-db don't load them
 
 # Set our timezone
 tz = pytz.timezone('Europe/London')
 
+# Seconds without data before the stream is considered down
+READ_TIMEOUT = 3
+# Seconds between pipeline metrics stored on the task
+METRICS_INTERVAL = 10
+
 # process globals
 TASK_PK = None
 TASK_ENDED = False
 FILE_HANDLE = None
+EXIT_HANDLERS = False
 notification_manager = NotificationManager()
 task_manager = TaskManager()
 
+# SHA1 of a whole file, read through a memory map
+def file_hash(f):
+    sha1 = hashlib.sha1()
+    if os.fstat(f.fileno()).st_size:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            sha1.update(mapped)
+        finally:
+            mapped.close()
+    return sha1.hexdigest()
+
+# Parse stage of a stream, bad lines are dropped
+def parse_line(item):
+    received, line = item
+    t = Trade(line)
+    if not t.parse_err:
+        t.received = received
+        t.parsed = monotonic()
+        return t
+    PARSE_ERRORS.inc()
+
 # Handles process ending
 def before_exit(signum=None, frame=None):
     '''
@@ -64,9 +100,13 @@ def before_exit(signum=None, frame=None):
     if signum:
         sys.exit(0)
 
-# register exit handlers
-atexit.register(before_exit)
-signal.signal(signal.SIGTERM, before_exit)
+# register exit handlers, once a command runs (not on import)
+def register_exit_handlers():
+    global EXIT_HANDLERS
+    if not EXIT_HANDLERS:
+        atexit.register(before_exit)
+        signal.signal(signal.SIGTERM, before_exit)
+        EXIT_HANDLERS = True
 
 
 class App:
@@ -77,41 +117,155 @@ class App:
         --reset-db                 -> delete tables and data
         -f trades.csv              -> import trades from file
         -s cs261.dcs.warwick.ac.uk -p 80  -> import trades from live stream
+        --robust                   -> use median/MAD thresholds from quantile sketches
+        --backtest 2017-03-01 2017-03-31  -> re-run detection on stored trades
+        --out-of-core              -> spill trades of a file to disk while reading it
+        --archive archive/         -> also append trades to a compressed archive
+        --feeds host:80 host2:8080 -> import trades from many live streams
+        -s ... --workers 4         -> split a stream by symbol over 4 processes
+        -s ... --workers 4 --relay 9000  -> serve partition k of a stream on port 9000 + k
+        -s ... --overload shed     -> drop lines while analysis can't keep up
+        -f ... --profile sampling  -> write a profile of the analysis for snakeviz
+        -s ... --metrics-port 9100 -> serve Prometheus metrics while analysing
         '''
         global TASK_ENDED
         global TASK_PK
 
+        register_exit_handlers()
+
+        # Robust (quantile sketch based) thresholds for detection
+        self.robust = getattr(args, 'robust', False)
+        # Keep trades of files on disk rather than in memory
+        self.out_of_core = getattr(args, 'out_of_core', False)
+        # Directory of the on-disk trade archive
+        self.archive_dir = getattr(args, 'archive', None)
+        # Bound and overload policy of the queue of lines read from a stream
+        self.queue_size = getattr(args, 'queue_size', None) or QUEUE_SIZE
+        self.overload = getattr(args, 'overload', None) or SPILL
+        # Profiler (cprofile or sampling) and its output file
+        self.profile = getattr(args, 'profile', None)
+        self.profile_out = getattr(args, 'profile_out', None)
+        # Prometheus metrics, served on a port and/or written to a file
+        self.start_metrics(getattr(args, 'metrics_port', None), getattr(args, 'metrics_file', None))
+
         # Drop or initialise the PostgreSQL db as necessary
         if args.reset_db:
             db.drop_tables()
         if args.init_db:
             db.create_tables()
 
-        # Check whether there is no analysis happening currently
-        if args.file or args.stream_url:
-            with db.get_reql_connection(db=True) as conn:
-                task_count = r.table('tasks').filter(r.row['terminated'] == False).count().run(conn)
-                if task_count:
-                    notification_manager.add(
-                        level = 'warning',
-                        title = 'Cannot launch task',
-                        message = 'End current task before you can start new analysis',
-                        datetime = tz.localize(datetime.now())
-                    )
-                    return
+        # Task queued for this job by the scheduler of the daemon, if any
+        self.task_id = getattr(args, 'task_id', None)
+        self.started = time.time()
+
+        # Jobs started outside the daemon aren't queued, refuse them
+        # while as many tasks as allowed are already running
+        backtest = getattr(args, 'backtest', None)
+        feeds = getattr(args, 'feeds', None)
+        max_tasks = getattr(args, 'max_tasks', None) or MAX_RUNNING
+        if (args.file or args.stream_url or backtest or feeds) and not self.task_id:
+            if task_manager.running_count() >= max_tasks:
+                notification_manager.add(
+                    level = 'warning',
+                    title = 'Cannot launch task',
+                    message = 'End a running task before you can start new analysis',
+                    datetime = tz.localize(datetime.now())
+                )
+                return
 
         # Analyse a file
         if args.file:
-            TASK_PK = task_manager.store(task='analysis', type='file')
-            self.from_file(args.file)
+            TASK_PK = self.start_task(task='analysis', type='file')
+            self.run_profiled('file', self.from_file, args.file)
         # Analyse a stream
         if args.stream_url:
             port = args.port or 80
-            TASK_PK = task_manager.store(task='analysis', type='stream')
-            self.from_stream(url=args.stream_url, port=port)
+            workers = getattr(args, 'workers', None) or 1
+            relay = getattr(args, 'relay', None)
+            if relay:
+                TASK_PK = self.start_task(task='analysis', type='stream', relay=relay, workers=workers)
+                self.relay_stream(url=args.stream_url, port=port, relay_port=relay, partitions=workers)
+            elif workers > 1:
+                TASK_PK = self.start_task(task='analysis', type='stream', workers=workers)
+                self.from_stream_partitioned(url=args.stream_url, port=port, workers=workers)
+            else:
+                TASK_PK = self.start_task(task='analysis', type='stream')
+                self.run_profiled('stream', self.from_stream, url=args.stream_url, port=port)
+        # Analyse many streams in this process
+        if feeds:
+            TASK_PK = self.start_task(task='analysis', type='stream', feeds=feeds)
+            self.from_feeds(feeds)
+        # Re-run analysis over stored trades
+        if backtest:
+            date_from, date_to = backtest
+            TASK_PK = self.start_task(task='backtest', type='backtest', date_from=date_from, date_to=date_to)
+            self.from_backtest(date_from, date_to, processes=getattr(args, 'workers', None))
 
         # Task will be ended before_exit
 
+    def start_task(self, **kwargs):
+        '''
+        Mark the task queued for this job as running,
+        or store a new one, and return its id
+        '''
+        self.started = time.time()
+        if self.task_id:
+            task_manager.start(self.task_id, **kwargs)
+            return self.task_id
+        return task_manager.store(**kwargs)
+
+    def start_metrics(self, port=None, path=None):
+        '''
+        Expose the metrics of this process for Prometheus
+        '''
+        if port:
+            try:
+                serve_metrics(port)
+                print "Metrics served on http://localhost:{}/metrics".format(port)
+            except socket.error, e:
+                print "Cannot serve metrics on port {}: {}".format(port, e)
+        if path:
+            writer = MetricsWriter(path)
+            writer.start()
+            # The last values are written on exit
+            atexit.register(writer.stop)
+
+    def run_profiled(self, name, function, *args, **kwargs):
+        '''
+        Run a command, under a profiler with --profile
+        '''
+        if not self.profile:
+            return function(*args, **kwargs)
+        path = self.profile_out or profile_path(name)
+        return profiled(self.profile, path, function, *args, **kwargs)
+
+    def report_stages(self, trades_analyser):
+        '''
+        Print the time spent in every stage and the latency of
+        traced trades, and store them on the task
+        '''
+        print '\n' + trades_analyser.timers.summary()
+        tracer = trades_analyser.tracer
+        if tracer.histograms['commit'].count:
+            print '\n' + tracer.summary()
+        task_manager.update(TASK_PK, stages=trades_analyser.timers.metrics(), latency=tracer.metrics())
+
+    def record_throughput(self, trades, **kwargs):
+        '''
+        Store the trades handled so far and their rate on the task
+        '''
+        elapsed = max(time.time() - self.started, 1e-6)
+        task_manager.update(TASK_PK, trades=trades, throughput=trades / elapsed, **kwargs)
+
+    def get_archive(self):
+        '''
+        Writer for the trade archive, if one was asked for
+        '''
+        if self.archive_dir:
+            from purple.archive import ArchiveWriter
+            return ArchiveWriter(self.archive_dir)
+        return None
+
     def from_file(self, f):
         '''
         Read file containing trading data.
@@ -123,6 +277,9 @@ class App:
         Cancelling command will store some trades
         in DB but wont perform analysis
         '''
+        from purple.analysis import TradesAnalyser
+        from purple.spill import SymbolSpill
+
         global FILE_HANDLE
         FILE_HANDLE = f
 
@@ -131,39 +288,72 @@ class App:
         flag = fcntl.fcntl(fd, fcntl.F_GETFD)
         fcntl.fcntl(fd, fcntl.F_SETFL, flag |  os.O_NONBLOCK)
 
-        # The blocksize we are using reading into our hash buffer
-        BLOCKSIZE = 65536
-
-        # Take a SHA1 hash of our file
-        file_buff = f.read(BLOCKSIZE)
-
-        while len(file_buff) > 0:
-            hashlib.sha1().update(file_buff)
-            file_buff = f.read(BLOCKSIZE)
-
-        sha1_hash = hashlib.sha1().hexdigest()
-
-        # Return to beginning of file (after header)
-        f.seek(1)
+        # Take a SHA1 hash of our file, known files are skipped
+        # and interrupted imports carry on where they stopped
+        sha1_hash = file_hash(f)
+        record = db.ImportModel.get_or_create(sha1_hash, getattr(f, 'name', None))
+        if record.completed:
+            print "File has already been analysed"
+            notification_manager.add(
+                level = 'warning',
+                title = 'File already analysed',
+                message = 'This file has already been imported and analysed',
+                datetime = tz.localize(datetime.now())
+            )
+            return
 
         # Tested this with less trades to store before commiting
         # (tradeacc_limit) but havent found a big difference in
         # the time it takes.
 
-        trades_analyser = TradesAnalyser(tradeacc_limit=1000)
-        # Read line by line
-        print "Adding lines for analysis"
-        for line in f:
-            # Continue if row is parsed correctly
-            t = Trade(line)
-            if not t.parse_err:
-                trades_analyser.add(t, sha1_hash, True, commit=True)
+        # Files larger than memory are spilled to temporary column files,
+        # robust analysis doesn't keep the trades in the first place
+        spill = SymbolSpill() if self.out_of_core and not self.robust else None
+        try:
+            trades_analyser = TradesAnalyser(tradeacc_limit=1000, robust=self.robust, spill=spill, archive=self.get_archive())
+
+            if record.offset:
+                # Trades committed before the interruption are read back for the analysis
+                print "Resuming import from byte {}".format(record.offset)
+                trades_analyser.reload_file(sha1_hash)
+                f.seek(record.offset)
+                offset = record.offset
+            else:
+                # Skip header
+                f.seek(0)
+                offset = len(f.readline())
+            # The analyser writes the checkpoint when it saves a batch
+            trades_analyser.import_record = record
+            trades_analyser.read_offset = offset
+
+            # Read line by line
+            print "Adding lines for analysis"
+            for line in iter(f.readline, ''):
+                offset += len(line)
+                trades_analyser.read_offset = offset
+                # Continue if row is parsed correctly
+                started = time.time()
+                t = Trade(line)
+                trades_analyser.timers.record('parse', time.time() - started)
+                if not t.parse_err:
+                    trades_analyser.add(t, sha1_hash, True, commit=True)
+                else:
+                    PARSE_ERRORS.inc()
 
-        trades_analyser.force_commit()
-        print "Lines added to memory, beginning anomaly detection"
+            trades_analyser.force_commit()
+            print "Lines added to memory, beginning anomaly detection"
 
-        # Calculate stats once all trades added
-        trades_analyser.alert_stats(True, True)
+            # Calculate stats once all trades added
+            trades_analyser.alert_stats(True, True)
+            self.record_throughput(trades_analyser.tradecount)
+            self.report_stages(trades_analyser)
+        finally:
+            # Interrupted imports don't leave their columns on disk
+            if spill:
+                spill.close()
+
+        record.completed = True
+        db.session.commit()
 
         # Close the file
         try:
@@ -179,14 +369,23 @@ class App:
         Unlike from_file, trades are
         commited every 50 trades
         for better live statistics.
+
+        When the feed drops, reconnecting is retried
+        with exponential backoff and jitter. Every
+        outage is stored on the task and a single
+        notification is kept up to date about them.
+
+        Lines waiting while analysis falls behind are
+        kept, dropped or spilled to disk depending on
+        the overload policy (--overload).
         '''
+        from purple.analysis import TradesAnalyser
+
         firstday = True
 
         # Open socket with given paramaters
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(3)
-            sock.connect((url, port))
+            sock = open_feed(url, port, read_timeout=READ_TIMEOUT)
         except socket.error, e:
             # Oopsy, couldn't connect
             print e
@@ -200,57 +399,166 @@ class App:
             )
             return
 
-        line = ''
-        firstline = True
-        trades_analyser = TradesAnalyser(tradeacc_limit=50)
+        trades_analyser = TradesAnalyser(tradeacc_limit=50, robust=self.robust, archive=self.get_archive())
+        outages = OutageLog(TASK_PK, notification_manager, task_manager)
+
+        # Reading, parsing and analysis (with the db writes) run in their
+        # own threads, so a slow commit never stops the socket being read:
+        # reader -> lines -> parser -> trades -> analysis (this thread)
+        lines = OverflowQueue(self.queue_size, policy=self.overload)
+        trades = OverflowQueue(self.queue_size, policy=BLOCK)
+        reader = StreamReader(url, port, lines, sock=sock, outages=outages, read_timeout=READ_TIMEOUT)
+        parser = Stage('parse', lines, parse_line, trades)
+        analysis = Stage('analysis', trades, lambda t: trades_analyser.add(t, None, firstday, commit=True))
+        # Lines are parsed in the parse stage thread, which times them
+        trades_analyser.timers.add('parse', parser.timer)
+        reader.start()
+        parser.start()
+
+        def queue_depths():
+            QUEUE_DEPTH.set(lines.depth(), queue='lines')
+            QUEUE_DEPTH.set(trades.depth(), queue='trades')
+        registry.on_collect(queue_depths)
+
+        day = date.today()
+        metrics_at = time.time()
+        try:
+            while 1:
+                analysis.step()
+                # Analyse the day once it is over
+                if date.today() != day:
+                    print "Beginning analysis"
+                    trades_analyser.force_commit()
+                    trades_analyser.alert_stats(firstday, False)
+                    firstday = False
+                    day = date.today()
+                # Queue depths and stage latencies for the frontend
+                now = time.time()
+                if now - metrics_at >= METRICS_INTERVAL:
+                    metrics = pipeline_metrics(reader, [('lines', lines), ('trades', trades)], [parser, analysis])
+                    self.record_throughput(
+                        trades_analyser.tradecount, pipeline=metrics, latency=trades_analyser.tracer.metrics()
+                    )
+                    metrics_at = now
+        finally:
+            reader.stop()
+            parser.stop()
+            trades_analyser.force_commit()
+            lines.close()
+            registry.remove_hook(queue_depths)
+            self.report_stages(trades_analyser)
+
+    def from_feeds(self, feeds, metrics_interval=10):
+        '''
+        Read many live streams ('host:port') at once.
 
-        # Read character by character until new line '\n'
-        # is found. Parse line at that time and continue.
-        while 1:
-            # Read character
-            try:
-                char = sock.recv(1)
-                if char == '\n':
-                    if firstline:
-                        firstline = False
-                    else:
-                        t = Trade(line)
-                        if not t.parse_err:
-                            # Add trade if it is correct
-                            trades_analyser.add(t, None, firstday, commit=True)
-                    line = ''
-                else:
-                    line = line + char
-            # The feed is down, we've got to analyse then reconnect
-            except socket.timeout:
-                print "Connection lost, attempting to reconnect"
-                disconnected = True
-                # Only analyse if the day of trades is over
-                if datetime.now().strftime('%H') == '00':
+        Every feed has its own non-blocking socket and
+        reconnects on its own, while all of them share
+        one analyser (and db session). Per feed metrics
+        are stored on the task every `metrics_interval`
+        seconds.
+
+        Feeds are read in their own thread and their
+        trades queued for the analysis (this thread), so
+        a slow commit doesn't stop any feed being read.
+        '''
+        from purple.analysis import TradesAnalyser
+
+        trades_analyser = TradesAnalyser(tradeacc_limit=50, robust=self.robust, archive=self.get_archive())
+        firstday = True
+
+        # Trades can't be spilled to disk, they wait for room in the queue instead
+        trades = OverflowQueue(self.queue_size, policy=SHED if self.overload == SHED else BLOCK)
+        analysis = Stage('analysis', trades, lambda t: trades_analyser.add(t, None, firstday, commit=True))
+        multiplexer = FeedMultiplexer([Feed(*parse_feed(f)) for f in feeds], lambda t, feed: trades.put(t))
+        reader = threading.Thread(target=multiplexer.run, name='feeds')
+        reader.daemon = True
+        reader.start()
+
+        def queue_depths():
+            QUEUE_DEPTH.set(trades.depth(), queue='trades')
+        registry.on_collect(queue_depths)
+
+        day = date.today()
+        metrics_at = time.time()
+        try:
+            while 1:
+                analysis.step()
+                # Analyse the day once it is over
+                if date.today() != day:
                     print "Beginning analysis"
+                    trades_analyser.force_commit()
                     trades_analyser.alert_stats(firstday, False)
                     firstday = False
-                    # Wait for 5 minutes until the feed is accepting connections again
-                    time.sleep(300)
-                else:
-                    # Feed has gone down, notify front end and reconnect
-                    print "Feed appears to be down"
-                    notification_manager.add(
-                        level = 'error',
-                        title = 'Feed appears to be down',
-                        message = (
-                            'The data feed that we are trying to connect to is currently down. Attempting to reconnect.'
-                        ),
-                        datetime = tz.localize(datetime.now())
+                    day = date.today()
+                now = time.time()
+                if now - metrics_at >= metrics_interval:
+                    self.record_throughput(
+                        trades_analyser.tradecount, feeds=multiplexer.metrics(),
+                        pipeline={'queues': {'trades': trades.metrics()}, 'stages': {'analysis': analysis.metrics()}},
+                        latency=trades_analyser.tracer.metrics()
                     )
+                    metrics_at = now
+        finally:
+            multiplexer.stop()
+            trades.close()
+            trades_analyser.force_commit()
+            registry.remove_hook(queue_depths)
+            self.report_stages(trades_analyser)
+
+    def from_stream_partitioned(self, url, port=80, workers=2):
+        '''
+        Read a live stream once and split its trades by
+        symbol over `workers` processes, each analysing
+        and storing its own set of symbols.
+        '''
+        from purple.splitter import run_partitioned
 
-                # Attempt to reconnect
-                while disconnected:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    try:
-                        sock.connect((url,port))
-                        sock.settimeout(3)
-                        disconnected  = False
-                        print "Reconnected to the feed!"
-                    except:
-                        pass
+        lines = run_partitioned(url, port, workers, robust=self.robust, archive_dir=self.archive_dir)
+        self.record_throughput(sum(lines), partition_lines=lines)
+
+    def relay_stream(self, url, port=80, relay_port=9000, partitions=1):
+        '''
+        Read a live stream once and serve the trades of
+        partition k on `relay_port + k`, for consumers on
+        other machines reading it as a stream (-s).
+        '''
+        from purple.splitter import run_relay
+
+        lines = run_relay(url, port, relay_port, partitions)
+        task_manager.update(TASK_PK, partition_lines=lines)
+
+    def from_backtest(self, date_from, date_to, processes=None):
+        '''
+        Re-run detection over the trades already stored
+        in Postgres between two dates (inclusive).
+
+        Days and symbols are analysed independently over
+        a pool of processes. Alerts are written to the
+        backtest_alerts table tagged with the task id, so
+        they never mix with the live alerts.
+        '''
+        from purple.backtest import run_backtest
+
+        try:
+            start = datetime.strptime(date_from, '%Y-%m-%d')
+            end = datetime.strptime(date_to, '%Y-%m-%d')
+        except ValueError:
+            print "Dates must be given as YYYY-MM-DD"
+            return
+
+        print "Backtesting trades from {} to {}".format(date_from, date_to)
+        started = time.time()
+        summary = run_backtest(TASK_PK, start, end, processes=processes, robust=self.robust)
+        elapsed = time.time() - started
+
+        print 'Analysed {} trades over {} jobs in {:.1f}s, found {} anomalies ({} failed jobs)'.format(
+            summary['trades'], summary['jobs'], elapsed, summary['anomalies'], summary['errors']
+        )
+        self.record_throughput(summary['trades'], backtest=summary)
+        notification_manager.add(
+            level = 'info',
+            title = 'Backtest complete',
+            message = 'Found {} anomalies in {} trades'.format(summary['anomalies'], summary['trades']),
+            datetime = tz.localize(datetime.now())
+        )
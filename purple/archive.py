@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+###############################################
+# Append-only, compressed on-disk trade store #
+###############################################
+
+# Layout of an archive directory:
+#   2017-03-08.seg  blocks of trades of that day, appended one after the other
+#   2017-03-08.idx  one JSON line per block: symbol, first and last time,
+#                   offset and length of the block in the .seg file
+#
+# A block holds up to `block_rows` trades of a single symbol, stored column
+# by column and compressed with zlib. Reading a time range only opens the
+# segments of the days in the range and only decompresses the blocks whose
+# symbol and time span match, using the index.
+
+import os
+import json
+import time
+import zlib
+import struct
+import calendar
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+from purple.finance import Trade
+
+# Set our timezone
+tz = pytz.timezone('Europe/London')
+
+# Block header: magic and compressed length
+BLOCK_HEADER = struct.Struct('<4sI')
+BLOCK_MAGIC = 'PTB1'
+
+# Numeric columns and their array typecodes, time is in microseconds since epoch
+NUMERIC_COLUMNS = (
+    ('time', 'l'),
+    ('price', 'd'),
+    ('size', 'l'),
+    ('bid', 'd'),
+    ('ask', 'd')
+)
+# Text columns, stored newline separated
+TEXT_COLUMNS = ('buyer', 'seller', 'currency', 'sector')
+
+# Trades per block
+BLOCK_ROWS = 4096
+# Seconds a partly filled block waits in memory before being written
+FLUSH_INTERVAL = 60
+
+
+def to_micros(t):
+    return calendar.timegm(t.utctimetuple()) * 1000000 + t.microsecond
+
+
+def from_micros(micros):
+    return datetime.fromtimestamp(micros // 1000000, tz).replace(microsecond=micros % 1000000)
+
+
+def encode_block(trades):
+    '''
+    Columnar, compressed bytes for a list of trades of one symbol
+    '''
+    parts = []
+    for column, code in NUMERIC_COLUMNS:
+        if column == 'time':
+            values = array(code, [to_micros(t.time) for t in trades])
+        else:
+            values = array(code, [getattr(t, column) for t in trades])
+        parts.append(values.tostring())
+    for column in TEXT_COLUMNS:
+        parts.append('\n'.join([getattr(t, column) or '' for t in trades]))
+
+    # Length of every part so they can be split again
+    lengths = struct.pack('<I' + 'I' * len(parts), len(trades), *[len(p) for p in parts])
+    payload = zlib.compress(lengths + ''.join(parts), 6)
+    return BLOCK_HEADER.pack(BLOCK_MAGIC, len(payload)) + payload
+
+
+def decode_block(data, symbol):
+    '''
+    List of trades from the bytes of a block
+    '''
+    magic, length = BLOCK_HEADER.unpack_from(data)
+    if magic != BLOCK_MAGIC:
+        raise ValueError('Not a trade block')
+    raw = zlib.decompress(data[BLOCK_HEADER.size:BLOCK_HEADER.size + length])
+
+    parts_count = len(NUMERIC_COLUMNS) + len(TEXT_COLUMNS)
+    lengths_format = '<I' + 'I' * parts_count
+    lengths = struct.unpack_from(lengths_format, raw)
+    rows = lengths[0]
+    position = struct.calcsize(lengths_format)
+
+    columns = {}
+    for (column, code), size in zip(NUMERIC_COLUMNS, lengths[1:]):
+        values = array(code)
+        values.fromstring(raw[position:position + size])
+        columns[column] = values
+        position += size
+    for column, size in zip(TEXT_COLUMNS, lengths[1 + len(NUMERIC_COLUMNS):]):
+        text = raw[position:position + size]
+        columns[column] = text.split('\n') if rows else []
+        position += size
+
+    trades = []
+    for i in range(rows):
+        trades.append(Trade.from_values(
+            time=from_micros(columns['time'][i]),
+            price=columns['price'][i],
+            size=columns['size'][i],
+            symbol=symbol,
+            bid=columns['bid'][i],
+            ask=columns['ask'][i],
+            buyer=columns['buyer'][i] or None,
+            seller=columns['seller'][i] or None,
+            currency=columns['currency'][i] or None,
+            sector=columns['sector'][i] or None
+        ))
+    return trades
+
+
+class ArchiveWriter:
+    '''
+    Appends trades to the day segments of an archive directory
+    '''
+    def __init__(self, root, block_rows=BLOCK_ROWS, flush_interval=FLUSH_INTERVAL):
+        self.root = root
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        # (day, symbol) -> list of trades waiting to be written
+        self.buffers = {}
+        self.last_flush = time.time()
+
+    def add(self, trade):
+        key = (trade.time.strftime('%Y-%m-%d'), trade.symbol)
+        if key not in self.buffers:
+            self.buffers[key] = []
+        self.buffers[key].append(trade)
+        if len(self.buffers[key]) >= self.block_rows:
+            self._write(key)
+        elif time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def _write(self, key):
+        day, symbol = key
+        trades = self.buffers.pop(key)
+        block = encode_block(trades)
+
+        path = os.path.join(self.root, day)
+        with open(path + '.seg', 'ab') as seg:
+            seg.seek(0, os.SEEK_END)
+            offset = seg.tell()
+            seg.write(block)
+        # The index is written after the block, a block without
+        # an index line (crash in between) is simply never read
+        with open(path + '.idx', 'a') as idx:
+            idx.write(json.dumps({
+                'symbol': symbol,
+                'start': to_micros(trades[0].time),
+                'end': to_micros(trades[-1].time),
+                'offset': offset,
+                'length': len(block),
+                'rows': len(trades)
+            }) + '\n')
+
+    def flush(self):
+        '''
+        Write every partly filled block
+        '''
+        for key in list(self.buffers):
+            self._write(key)
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+
+class ArchiveReader:
+    '''
+    Reads trades of a time range back from an archive directory
+    '''
+    def __init__(self, root):
+        self.root = root
+
+    def days(self):
+        return sorted(name[:-4] for name in os.listdir(self.root) if name.endswith('.seg'))
+
+    def index(self, day):
+        path = os.path.join(self.root, day + '.idx')
+        if not os.path.exists(path):
+            return []
+        with open(path) as idx:
+            return [json.loads(line) for line in idx if line.strip()]
+
+    def read(self, start, end, symbols=None):
+        '''
+        Yield trades with start <= time < end (timezone aware
+        datetimes), optionally only for some symbols. Trades come
+        block by block: in time order for each symbol, but symbols
+        are not interleaved.
+        '''
+        start_micros, end_micros = to_micros(start), to_micros(end)
+        symbols = set(symbols) if symbols else None
+
+        day = start.date()
+        while day <= end.date():
+            name = day.strftime('%Y-%m-%d')
+            blocks = [
+                b for b in self.index(name)
+                if b['end'] >= start_micros and b['start'] < end_micros
+                and (symbols is None or b['symbol'] in symbols)
+            ]
+            if blocks:
+                with open(os.path.join(self.root, name + '.seg'), 'rb') as seg:
+                    for block in blocks:
+                        seg.seek(block['offset'])
+                        for trade in decode_block(seg.read(block['length']), block['symbol']):
+                            if start <= trade.time < end:
+                                yield trade
+            day += timedelta(days=1)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+##########################################
+# Re-run detection over trades in the db #
+##########################################
+
+# Used to fan out jobs over processes
+import multiprocessing
+# For date management
+from datetime import datetime, timedelta
+
+import rethinkdb as r
+from sqlalchemy import text
+
+from purple import db
+from purple.finance import Trade, local_time
+from purple.anomalous_trade_finder import AnomalousTradeFinder
+
+# Table holding the alerts of every backtest run
+BACKTEST_TABLE = 'backtest_alerts'
+
+# Rows fetched at once from the server side cursor
+FETCH_SIZE = 5000
+
+# Alerts written to rethink at once
+ALERT_BATCH = 1000
+
+# (day, symbol) pairs with enough trades to be analysed
+JOBS_QUERY = text(
+    'SELECT symbol_name, CAST(datetime AS DATE) AS day, COUNT(*) AS n '
+    'FROM trades WHERE datetime >= :date_from AND datetime < :date_to '
+    'GROUP BY symbol_name, CAST(datetime AS DATE) '
+    'HAVING COUNT(*) > 1 ORDER BY day, symbol_name'
+)
+
+# Trades of one symbol on one day, uses ix_trades_symbol_datetime
+TRADES_QUERY = text(
+    'SELECT id, datetime, price, size, bid, ask FROM trades '
+    'WHERE symbol_name = :symbol AND datetime >= :start AND datetime < :end '
+    'ORDER BY datetime, id'
+)
+
+
+def _init_worker():
+    # Connections inherited from the parent can't be shared, open new ones
+    db.engine.dispose()
+
+
+def analyse_day(job):
+    '''
+    Run first day analysis on the trades of one symbol for one day.
+    Returns (day, symbol, trade count, anomalies, error)
+    '''
+    day, symbol, robust = job
+    start = datetime.strptime(day, '%Y-%m-%d')
+    end = start + timedelta(days=1)
+
+    finder = AnomalousTradeFinder(robust=robust, persist=False)
+    count = 0
+    try:
+        # Stream the rows with a server side cursor rather than loading them
+        conn = db.engine.connect().execution_options(stream_results=True)
+        try:
+            result = conn.execute(TRADES_QUERY, symbol=symbol, start=start, end=end)
+            rows = result.fetchmany(FETCH_SIZE)
+            while rows:
+                for row in rows:
+                    t = Trade.from_values(
+                        time=local_time(row.datetime), price=row.price, size=row.size,
+                        symbol=symbol, bid=row.bid, ask=row.ask
+                    )
+                    finder.add(t, row.id)
+                    count += 1
+                rows = result.fetchmany(FETCH_SIZE)
+        finally:
+            conn.close()
+
+        anomalies = finder.calculate_anomalies_first_day(True)
+    except Exception, e:
+        return day, symbol, count, [], str(e)
+
+    return day, symbol, count, anomalies, None
+
+
+def find_jobs(date_from, date_to):
+    '''
+    List (day, symbol) pairs holding trades in [date_from, date_to]
+    '''
+    rows = db.engine.execute(
+        JOBS_QUERY,
+        date_from=date_from,
+        date_to=date_to + timedelta(days=1)
+    )
+    return [(row.day.strftime('%Y-%m-%d'), row.symbol_name) for row in rows]
+
+
+def plan_jobs(pairs, robust=False):
+    '''
+    One job per (day, symbol): every trade of a symbol on a day is
+    analysed by the same worker, as the first day analysis needs them all
+    '''
+    return [(day, symbol, robust) for day, symbol in sorted(set(pairs))]
+
+
+def store_alerts(run, day, anomalies):
+    '''
+    Write the anomalies of a backtest run, tagged with the run id
+    '''
+    docs = alert_docs(run, day, anomalies)
+    with db.get_reql_connection(db=True) as conn:
+        for i in range(0, len(docs), ALERT_BATCH):
+            r.table(BACKTEST_TABLE).insert(docs[i:i + ALERT_BATCH]).run(conn, durability='soft')
+
+
+def alert_docs(run, day, anomalies):
+    '''
+    Rows of BACKTEST_TABLE for the anomalies of a day of a run
+    '''
+    docs = []
+    for anomaly in anomalies:
+        docs.append({
+            'run': run,
+            'day': day,
+            'time': anomaly["time"],
+            'trade_pk': anomaly["id"],
+            'description': anomaly["description"],
+            'reviewed': False,
+            'error_code': anomaly["error_code"],
+            'severity': anomaly["severity"],
+            'symbol': anomaly["symbol"]
+        })
+    return docs
+
+
+def run_backtest(run, date_from, date_to, processes=None, robust=False):
+    '''
+    Analyse every (day, symbol) between date_from and date_to (inclusive)
+    over a pool of processes. Returns a summary of the run.
+    '''
+    db.ensure_reql_table(BACKTEST_TABLE, indexes=('run',))
+
+    jobs = plan_jobs(find_jobs(date_from, date_to), robust)
+    summary = {'jobs': len(jobs), 'trades': 0, 'anomalies': 0, 'errors': 0}
+    if not jobs:
+        return summary
+
+    # Don't keep the parent's connections open while forking
+    db.session.close()
+    db.engine.dispose()
+
+    pool = multiprocessing.Pool(processes=processes, initializer=_init_worker)
+    try:
+        # Results are written as soon as any job finishes
+        for day, symbol, count, anomalies, error in pool.imap_unordered(analyse_day, jobs):
+            summary['trades'] += count
+            if error:
+                summary['errors'] += 1
+                print 'Backtest of {} on {} failed: {}'.format(symbol, day, error)
+                continue
+            summary['anomalies'] += len(anomalies)
+            if anomalies:
+                store_alerts(run, day, anomalies)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return summary
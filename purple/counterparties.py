@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+######################################################
+# Counterparty index and wash/circular trade finding #
+######################################################
+
+from collections import deque
+
+from sqlalchemy import text
+
+from purple import db
+
+# Large prime used for hashing counter keys
+PRIME = 2147483647
+
+# Seconds within which trades are linked into round trips or cycles
+WASH_WINDOW = 300
+# Largest relative size difference for trades to be linked
+SIZE_TOLERANCE = 0.1
+# Recent outgoing trades kept per (symbol, trader)
+RECENT_EDGES = 8
+
+
+class CountMinSketch:
+    '''
+    Approximate counters in fixed memory.
+
+    Every key is hashed into one cell per row and the smallest
+    of its cells is returned, which never underestimates. Updates
+    and lookups cost `depth` operations whatever the number of keys.
+    '''
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.depth = depth
+        self.rows = [[0] * width for _ in range(depth)]
+        # Fixed seeds so sketches of different processes can be merged
+        self.seeds = [(2 * i + 1) * 40503 for i in range(depth)]
+
+    def _cells(self, key):
+        for i in range(self.depth):
+            yield i, ((self.seeds[i] * key + i) % PRIME) % self.width
+
+    def add(self, key, value=1):
+        for i, cell in self._cells(key):
+            self.rows[i][cell] += value
+
+    def estimate(self, key):
+        return min(self.rows[i][cell] for i, cell in self._cells(key))
+
+    def merge(self, other):
+        for i in range(self.depth):
+            row, other_row = self.rows[i], other.rows[i]
+            for j in range(self.width):
+                row[j] += other_row[j]
+
+
+# Single integer key for a (buyer, seller) pair
+def pair_key(buyer_id, seller_id):
+    return buyer_id * 1000003 + seller_id
+
+
+class TraderIndex:
+    '''
+    Dictionary encodes trader emails into integer ids (stored in
+    the traders table) and counts trades and volume per trader and
+    per (buyer, seller) pair in count-min sketches.
+    '''
+    def __init__(self):
+        # email -> id, ids are only looked up in the db once
+        self.ids = {}
+        self.trader_trades = CountMinSketch()
+        self.trader_volume = CountMinSketch()
+        self.pair_trades = CountMinSketch()
+        self.pair_volume = CountMinSketch()
+
+    def get_id(self, email):
+        # Missing counterparties (empty fields) aren't traders
+        if not email:
+            return None
+        if email not in self.ids:
+            self.ids[email] = db.TraderModel.get_or_create(email).id
+        return self.ids[email]
+
+    def add(self, buyer_id, seller_id, size):
+        if buyer_id is None or seller_id is None:
+            return
+        self.trader_trades.add(buyer_id)
+        self.trader_trades.add(seller_id)
+        self.trader_volume.add(buyer_id, size)
+        self.trader_volume.add(seller_id, size)
+        key = pair_key(buyer_id, seller_id)
+        self.pair_trades.add(key)
+        self.pair_volume.add(key, size)
+
+    def trader_stats(self, trader_id):
+        return {
+            'trades': self.trader_trades.estimate(trader_id),
+            'volume': self.trader_volume.estimate(trader_id)
+        }
+
+    def pair_stats(self, buyer_id, seller_id):
+        key = pair_key(buyer_id, seller_id)
+        return {
+            'trades': self.pair_trades.estimate(key),
+            'volume': self.pair_volume.estimate(key)
+        }
+
+
+# Traders involved in the most flagged trades, as (email, flagged trades)
+FLAGGED_TRADERS_QUERY = text(
+    'SELECT traders.email, COUNT(*) AS flagged FROM trades '
+    'JOIN traders ON traders.id IN (trades.buyer_id, trades.seller_id) '
+    'WHERE trades.flagged GROUP BY traders.email '
+    'ORDER BY flagged DESC LIMIT :limit'
+)
+
+
+def flagged_traders(limit=20):
+    return [(row.email, row.flagged) for row in db.engine.execute(FLAGGED_TRADERS_QUERY, limit=limit)]
+
+
+class WashTradeFinder:
+    '''
+    Finds, trade by trade:
+    - self trades, where buyer and seller are the same (WT)
+    - round trips, shares going back to their seller shortly after (WT)
+    - cycles of three traders passing shares round (CT)
+
+    Only the last RECENT_EDGES trades sold by each trader in each
+    symbol are kept, so the cost per trade does not depend on the
+    number of counterparties.
+    '''
+    def __init__(self, window=WASH_WINDOW, tolerance=SIZE_TOLERANCE):
+        self.window = window
+        self.tolerance = tolerance
+        # (symbol, seller id) -> deque of (buyer id, time, size)
+        self.sold = {}
+
+    def _similar(self, size, other):
+        return abs(size - other) <= self.tolerance * max(size, other)
+
+    def _recent(self, symbol, seller_id, time):
+        edges = self.sold.get((symbol, seller_id))
+        if not edges:
+            return []
+        return [e for e in edges if (time - e[1]).total_seconds() <= self.window]
+
+    def add(self, trade, buyer_id, seller_id, identifier):
+        # Nothing links a trade missing a counterparty to others
+        if buyer_id is None or seller_id is None:
+            return []
+        anomalies = []
+        symbol = trade.symbol
+
+        if buyer_id == seller_id:
+            description = 'Wash trade (self trade) on ' + symbol
+            anomalies.append(self._anomaly(identifier, trade, description, 'WT', 1))
+        else:
+            # Did the buyer recently sell the same amount to the seller?
+            for to_id, _, size in self._recent(symbol, buyer_id, trade.time):
+                if to_id == seller_id and self._similar(size, trade.size):
+                    description = 'Wash trade (round trip) on ' + symbol
+                    anomalies.append(self._anomaly(identifier, trade, description, 'WT', 2))
+                    break
+            else:
+                # Did the buyer sell to someone who then sold to the seller?
+                for middle_id, _, size in self._recent(symbol, buyer_id, trade.time):
+                    if not self._similar(size, trade.size):
+                        continue
+                    for to_id, _, other in self._recent(symbol, middle_id, trade.time):
+                        if to_id == seller_id and self._similar(other, trade.size):
+                            description = 'Circular trading on ' + symbol
+                            anomalies.append(self._anomaly(identifier, trade, description, 'CT', 2))
+                            break
+                    if anomalies:
+                        break
+
+        key = (symbol, seller_id)
+        if key not in self.sold:
+            self.sold[key] = deque(maxlen=RECENT_EDGES)
+        self.sold[key].append((buyer_id, trade.time, trade.size))
+        return anomalies
+
+    @staticmethod
+    def _anomaly(identifier, trade, description, error_code, severity):
+        return {
+            'id': identifier,
+            'time': trade.time,
+            'description': description,
+            'error_code': error_code,
+            'severity': severity,
+            'symbol': trade.symbol
+        }
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+###############################################
+# Long running process starting analysis jobs #
+###############################################
+
+# Started once with `main.py --daemon`, it keeps every module imported and
+# the symbols loaded. A job is the command line main.py would be given, sent
+# as one JSON line to a local port:
+#
+#   {"args": ["-f", "/path/trades.csv"]}            -> {"success": true, "pid": 123}
+#   {"args": ["--reset-db", "--init-db"], "wait": true}
+#                                                   -> {"success": true, "pid": 124, "code": 0}
+#
+# Every job runs in a forked child, so it starts in milliseconds but still
+# has its own pid (tasks are killed by pid) and can't break the daemon.
+# File, stream and backtest jobs are queued by a JobScheduler and only a
+# few run at once, streams first.
+
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import signal
+import traceback
+
+from purple.scheduler import JobScheduler, MAX_RUNNING
+
+# Local port jobs are sent to
+DAEMON_PORT = 8282
+# Longest wait for a job before finished children are collected
+ACCEPT_TIMEOUT = 1.0
+
+
+def preload():
+    '''
+    Import the modules of every kind of job once, in the daemon,
+    (main.py itself only imports them when a job needs them)
+    '''
+    from purple import app, analysis, backtest, splitter, spill, archive
+
+
+def warm():
+    '''
+    Load what every job would otherwise load on its own
+    '''
+    from sqlalchemy.exc import SQLAlchemyError
+    from purple import db, analysis
+
+    analysis.known_symbols.clear()
+    try:
+        names = [name for (name,) in db.session.query(db.SymbolModel.name)]
+        analysis.known_symbols.update(names)
+    except SQLAlchemyError:
+        # Tables don't exist yet (before --init-db)
+        db.session.rollback()
+    # Children must not share connections with the daemon
+    db.session.close()
+    db.engine.dispose()
+
+
+def run_job(parser, argv):
+    '''
+    Body of a forked child: run main.py with `argv` and exit
+    '''
+    from purple import app
+
+    code = 0
+    try:
+        signal.signal(signal.SIGTERM, app.before_exit)
+        args = parser.parse_args(argv)
+        app.App(args)
+    except SystemExit, e:
+        code = e.code if isinstance(e.code, int) else 1
+    except:
+        traceback.print_exc()
+        code = 1
+    finally:
+        app.before_exit()
+        sys.stdout.flush()
+    # Never return into the daemon loop
+    os._exit(code)
+
+
+class AnalysisDaemon:
+    def __init__(self, parser, port=DAEMON_PORT, host='127.0.0.1', max_running=MAX_RUNNING):
+        self.parser = parser
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(16)
+        self.server.settimeout(ACCEPT_TIMEOUT)
+        self.port = self.server.getsockname()[1]
+        self.scheduler = JobScheduler(self.start_job, max_running)
+        # id of a job -> connection waiting for it to end
+        self.waiting = {}
+        # connection of the request being handled
+        self.conn = None
+        self.jobs = 0
+        self.running = True
+        preload()
+
+    def start_job(self, argv):
+        '''
+        Fork a child running the job, returns its pid
+        '''
+        warm()
+        pid = os.fork()
+        if pid == 0:
+            # Sockets stay open as long as any process holds them,
+            # the child must let go of the daemon's
+            self.server.close()
+            for conn in self.waiting.values() + [self.conn]:
+                if conn:
+                    conn.close()
+            run_job(self.parser, argv)
+        self.jobs += 1
+        return pid
+
+    def handle(self, conn):
+        started = time.time()
+        conn.settimeout(ACCEPT_TIMEOUT)
+        try:
+            request = json.loads(conn.makefile().readline())
+            argv = [str(arg) for arg in request['args']]
+        except (socket.error, ValueError, KeyError, TypeError):
+            self.reply(conn, {'success': False, 'error': 'Bad request'})
+            return
+
+        self.conn = conn
+        try:
+            job = self.scheduler.submit(argv)
+        finally:
+            self.conn = None
+        if job['pid']:
+            print 'Started job {} ({}) in {:.1f}ms'.format(job['pid'], ' '.join(argv), (time.time() - started) * 1000)
+        else:
+            print 'Queued job ({})'.format(' '.join(argv))
+
+        if request.get('wait'):
+            self.waiting[id(job)] = conn
+        else:
+            self.reply(conn, {
+                'success': True,
+                'pid': job['pid'],
+                'task': job['task'],
+                'state': 'running' if job['pid'] else 'queued'
+            })
+
+    def reply(self, conn, response):
+        try:
+            conn.sendall(json.dumps(response) + '\n')
+        except socket.error:
+            pass
+        conn.close()
+
+    def reap(self):
+        '''
+        Collect finished children, answer those waited
+        for and start queued jobs in their place
+        '''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+            job = self.scheduler.done(pid, code)
+            conn = self.waiting.pop(id(job), None) if job else None
+            if conn:
+                self.reply(conn, {'success': True, 'pid': pid, 'task': job['task'], 'code': code})
+
+    def serve(self):
+        print 'Analysis daemon listening on port {}, running up to {} tasks at once'.format(
+            self.port, self.scheduler.max_running
+        )
+        while self.running:
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                conn = None
+            except socket.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                conn = None
+            if conn:
+                self.handle(conn)
+            self.reap()
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+
+def serve(parser, port=DAEMON_PORT, max_running=MAX_RUNNING):
+    daemon = AnalysisDaemon(parser, port, max_running=max_running)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server.close()
@@ -20,19 +20,52 @@ from sqlalchemy import (
     ForeignKey,
     Date,
     DateTime,
-    Binary
+    Binary,
+    Index,
+    text
 )
 
 # Base for tables for PostgreSQL
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.engine.url import URL
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy.exc import IntegrityError
 
 # rethinkDB connection info
 RDB_HOST = 'localhost'
 RDB_PORT = '28015'
 PURPLE_DB = 'purple'
 
+# Secondary indexes of the alerts table, fields or (name, function, multi)
+ALERT_INDEXES = (
+    'severity',
+    ('symbol_time', lambda alert: [alert['symbol'], alert['time']], False),
+    ('error_code_time', lambda alert: [alert['error_code'], alert['time']], False),
+    ('reviewed_time', lambda alert: [alert['reviewed'], alert['time']], False),
+    # Every word of the description, for search in order of severity
+    ('severity_tokens', lambda alert: alert['description'].downcase().split().distinct().map(
+        lambda token: [alert['severity'], token, alert['time']]), True),
+)
+# Number of alerts per severity, symbol and review state, updated by
+# whatever writes an alert (count_alerts here, the frontend server for
+# reviews and deletions)
+ALERT_COUNTS_TABLE = 'alert_counts'
+# One document per symbol, updated whenever trades or characteristics of
+# the symbol are committed, the frontend drops its cached responses on change
+SYMBOL_VERSIONS_TABLE = 'symbol_versions'
+
+# Schema changes create_all doesn't make to tables of older dbs,
+# every statement can be run again on an up to date db
+POSTGRES_UPGRADES = (
+    'ALTER TABLE symbols ADD COLUMN IF NOT EXISTS sector VARCHAR',
+    'ALTER TABLE trades ADD COLUMN IF NOT EXISTS buyer_id INTEGER REFERENCES traders (id)',
+    'ALTER TABLE trades ADD COLUMN IF NOT EXISTS seller_id INTEGER REFERENCES traders (id)',
+    'CREATE INDEX IF NOT EXISTS ix_trades_buyer_id ON trades (buyer_id)',
+    'CREATE INDEX IF NOT EXISTS ix_trades_seller_id ON trades (seller_id)',
+    'CREATE INDEX IF NOT EXISTS ix_trades_symbol_datetime ON trades (symbol_name, datetime)',
+    'CREATE INDEX IF NOT EXISTS ix_trades_csv_hash ON trades (csv_hash)',
+)
+
 # PostgreSQL connection info
 DATABASE_SETTINGS = {
     'drivername': 'postgres',
@@ -43,11 +76,36 @@ DATABASE_SETTINGS = {
     'database': 'cs261'
 }
 
-# Create database engine and setup session
-engine = create_engine(URL(**DATABASE_SETTINGS))
-Base = declarative_base(bind=engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+
+class LazyEngine(object):
+    '''
+    Stands for the engine, which (with the database driver)
+    is only created the first time it's used
+    '''
+    def __init__(self, url):
+        self.url = url
+        self.engine = None
+
+    def get(self):
+        if self.engine is None:
+            self.engine = create_engine(self.url)
+        return self.engine
+
+    def dispose(self):
+        # Nothing to let go of before the first use
+        if self.engine is not None:
+            self.engine.dispose()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+# Database engine and session, both created on first use
+engine = LazyEngine(URL(**DATABASE_SETTINGS))
+Base = declarative_base()
+Session = sessionmaker()
+# One session shared by every thread of the process, like a plain Session()
+session = scoped_session(lambda: Session(bind=engine.get()), scopefunc=lambda: None)
 
 
 @contextmanager
@@ -83,7 +141,11 @@ def create_tables():
     Create all tables
     '''
     # Postgres
-    Base.metadata.create_all(engine)
+    Base.metadata.create_all(engine.get())
+    # Also adds the columns and indexes missing from older dbs
+    with engine.begin() as conn:
+        for statement in POSTGRES_UPGRADES:
+            conn.execute(text(statement))
 
     # Rethinkdb
     with get_reql_connection() as conn:
@@ -95,16 +157,123 @@ def create_tables():
             r.db(PURPLE_DB).table_create('notifications').run(conn) # holds realtime notifications
             r.db(PURPLE_DB).table_create('settings').run(conn) # holds webapp settings
             r.db(PURPLE_DB).table_create('tasks').run(conn) # holds current bg tasks
+            r.db(PURPLE_DB).table_create('backtest_alerts').run(conn) # holds alerts of backtest runs
             # Create indices
             r.db(PURPLE_DB).table('tasks').index_create('pid').run(conn)
-            r.db(PURPLE_DB).table('alerts').index_create('severity').run(conn)
+            r.db(PURPLE_DB).table('backtest_alerts').index_create('run').run(conn)
             # default settings
             set_default_settings()
         except RqlRuntimeError:
             # Fail silently
             pass
-        finally:
-            print 'Rethinkdb setup complete.'
+
+    # Also adds the indexes and tables missing from older dbs
+    ensure_reql_table('alerts', ALERT_INDEXES)
+    ensure_reql_table(ALERT_COUNTS_TABLE)
+    ensure_reql_table(SYMBOL_VERSIONS_TABLE)
+    # Counters start from the alerts of dbs older than them
+    with get_reql_connection(db=True) as conn:
+        if r.table(ALERT_COUNTS_TABLE).is_empty().run(conn):
+            rebuild_alert_counts(conn)
+    print 'Rethinkdb setup complete.'
+
+# Create a rethink table and its indices if they don't exist yet
+def ensure_reql_table(name, indexes=()):
+    '''
+    Used for tables added after a db was first initialised.
+    An index is a field name or a (name, function, multi) tuple
+    '''
+    with get_reql_connection(db=True) as conn:
+        if not r.table_list().contains(name).run(conn):
+            r.table_create(name).run(conn)
+        existing = r.table(name).index_list().run(conn)
+        for index in indexes:
+            if isinstance(index, basestring):
+                index = (index, None, False)
+            index_name, function, multi = index
+            if index_name in existing:
+                continue
+            if function is None:
+                r.table(name).index_create(index_name, multi=multi).run(conn)
+            else:
+                r.table(name).index_create(index_name, function, multi=multi).run(conn)
+        r.table(name).index_wait().run(conn)
+
+# Counters of ALERT_COUNTS_TABLE an alert is part of
+def alert_count_keys(alert):
+    return [
+        'total',
+        'reviewed:{}'.format('true' if alert.get('reviewed') else 'false'),
+        'severity:{}'.format(alert['severity']),
+        'symbol:{}'.format(alert['symbol'])
+    ]
+
+# Add alerts to their counters (delta=-1 takes them off)
+def count_alerts(conn, alerts, delta=1):
+    deltas = {}
+    for alert in alerts:
+        for key in alert_count_keys(alert):
+            deltas[key] = deltas.get(key, 0) + delta
+    changes = [{'id': key, 'count': count} for key, count in deltas.items() if count]
+    if not changes:
+        return
+    r.expr(changes).for_each(lambda change:
+        r.table(ALERT_COUNTS_TABLE).get(change['id']).replace(lambda row:
+            r.branch(row.eq(None), change, row.merge({'count': row['count'] + change['count']}))
+        )
+    ).run(conn, durability='soft')
+
+# Count every alert again, only when setting a db up
+def rebuild_alert_counts(conn):
+    counts = {'total': r.table('alerts').count().run(conn)}
+    for field in ('reviewed', 'severity', 'symbol'):
+        for value, count in r.table('alerts').group(field).count().run(conn).items():
+            if field == 'reviewed':
+                value = 'true' if value else 'false'
+            counts['{}:{}'.format(field, value)] = count
+    r.table(ALERT_COUNTS_TABLE).delete().run(conn)
+    if counts['total']:
+        r.table(ALERT_COUNTS_TABLE).insert(
+            [{'id': key, 'count': count} for key, count in counts.items()]
+        ).run(conn)
+
+# Trade ids are taken from the trades sequence, rows inserted
+# with explicit ids by older versions don't advance it
+SYNC_TRADE_IDS = text(
+    'SELECT setval(\'trades_id_seq\', (SELECT MAX(id) FROM trades)) '
+    'WHERE (SELECT MAX(id) FROM trades) > ('
+    'SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM trades_id_seq)'
+)
+RESERVE_TRADE_IDS = text('SELECT nextval(\'trades_id_seq\') FROM generate_series(1, :n)')
+
+# Reserve ids for trades
+def reserve_trade_ids(n):
+    '''
+    Take n unused trade ids, tasks running at
+    the same time never get the same ones
+    '''
+    with engine.begin() as conn:
+        conn.execute(SYNC_TRADE_IDS)
+        return [row[0] for row in conn.execute(RESERVE_TRADE_IDS, n=n)]
+
+# Signal committed changes
+def publish_symbols(symbols, listed=()):
+    '''
+    Tell readers of the db that data of these symbols was committed,
+    listed ones were added to the symbols table or got new characteristics
+    '''
+    symbols = set(symbols) | set(listed)
+    if not symbols:
+        return
+    docs = []
+    for symbol in symbols:
+        doc = {'id': symbol, 'updated_at': r.now()}
+        if symbol in listed:
+            doc['listed_at'] = r.now()
+        docs.append(doc)
+    with get_reql_connection(db=True) as conn:
+        # listed_at is kept while only trades change
+        r.table(SYMBOL_VERSIONS_TABLE).insert(docs, conflict='update').run(conn, durability='soft')
 
 # Reset our databases
 def drop_tables():
@@ -112,7 +281,7 @@ def drop_tables():
     Delete all data in the tables (destroy databases)
     '''
     # Postgres
-    Base.metadata.drop_all(engine)
+    Base.metadata.drop_all(engine.get())
 
     # Rethinkdb
     with get_reql_connection() as conn:
@@ -151,6 +320,7 @@ class BaseModel(Base):
 class SymbolModel(Base):
     __tablename__ = 'symbols'
     name = Column(String, primary_key=True)
+    sector = Column(String)
     average_volume = Column(BigInteger)
     average_daily_volume = Column(BigInteger)
     average_price_change_daily = Column(Float(precision=7))
@@ -163,16 +333,66 @@ class SymbolModel(Base):
 
     # Checks whether symbol is already in db
     @classmethod
-    def get_or_create(cls, name):
+    def get_or_create(cls, name, sector=None):
         # retrieve symbol or create a new one and return
         obj = session.query(cls).filter_by(name=name).one_or_none()
         if not obj:
-            obj = cls(name=name)
+            # Tasks running at the same time may insert the same symbol
+            try:
+                with session.begin_nested():
+                    obj = cls(name=name, sector=sector)
+                    session.add(obj)
+                session.commit()
+            except IntegrityError:
+                obj = session.query(cls).filter_by(name=name).one()
+        elif sector and obj.sector != sector:
+            obj.sector = sector
+            session.commit()
+        return obj
+
+
+# Files imported (or being imported), keyed by their SHA1
+class ImportModel(Base):
+    __tablename__ = 'imports'
+    csv_hash = Column(String, primary_key=True)
+    filename = Column(String)
+    # Byte offset right after the last committed line
+    offset = Column(BigInteger, default=0)
+    completed = Column(Boolean, default=False)
+
+    # Checks whether file is already in db
+    @classmethod
+    def get_or_create(cls, csv_hash, filename=None):
+        obj = session.query(cls).filter_by(csv_hash=csv_hash).one_or_none()
+        if not obj:
+            obj = cls(csv_hash=csv_hash, filename=filename, offset=0, completed=False)
             session.add(obj)
             session.commit()
         return obj
 
 
+# Dictionary of trader emails, trades refer to traders by id
+class TraderModel(BaseModel):
+    __tablename__ = 'traders'
+    email = Column(String, unique=True, index=True)
+
+    # Checks whether trader is already in db
+    @classmethod
+    def get_or_create(cls, email):
+        obj = session.query(cls).filter_by(email=email).one_or_none()
+        if not obj:
+            # Tasks running at the same time may insert the same
+            # trader, only roll back to a savepoint if one does
+            try:
+                with session.begin_nested():
+                    obj = cls(email=email)
+                    session.add(obj)
+                session.commit()
+            except IntegrityError:
+                obj = session.query(cls).filter_by(email=email).one()
+        return obj
+
+
 class TradeModel(BaseModel):
     '''
     Table that holds data from each trade.
@@ -186,11 +406,19 @@ class TradeModel(BaseModel):
     size = Column(BigInteger)
     flagged = Column(Boolean, default=False)
     symbol_name = Column(String, ForeignKey('symbols.name'))
+    buyer_id = Column(Integer, ForeignKey('traders.id'), index=True)
+    seller_id = Column(Integer, ForeignKey('traders.id'), index=True)
     analysis_date = Column(Date)
-    csv_hash = Column(Binary, default=None)
+    csv_hash = Column(Binary, default=None, index=True)
     datetime = Column(DateTime)
 
     symbol = relationship('SymbolModel', back_populates='trades')
+
+    # Trades are nearly always read by symbol over a time range
+    __table_args__ = (
+        Index('ix_trades_symbol_datetime', 'symbol_name', 'datetime'),
+    )
+
     # Set's a trade as flagged
     def flag(self, truth_value):
         self.flagged = truth_value
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+###############################################
+# Many live feeds read in a single process    #
+###############################################
+
+# Used to wait on many sockets at once
+import select
+import socket
+import errno
+import time
+import random
+
+from purple.finance import Trade
+from purple.metrics import PARSE_ERRORS, RECONNECTS
+from purple.tracing import monotonic
+
+# Bytes read from a socket at once
+RECV_SIZE = 65536
+# Longest wait for a socket before checking reconnects and metrics
+POLL_TIMEOUT = 1.0
+# Seconds before a connection attempt is given up
+CONNECT_TIMEOUT = 5.0
+# Delay before reconnecting, doubled after each failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+# Part of a reconnect delay randomised, so clients don't retry all at once
+RETRY_JITTER = 0.5
+# Seconds without data after which a connected feed is considered down
+IDLE_TIMEOUT = 30.0
+
+
+# Split 'host:port' into (host, port)
+def parse_feed(s, default_port=80):
+    host, _, port = s.rpartition(':')
+    if not host:
+        return s, default_port
+    return host, int(port)
+
+
+# Blocking connection to a feed, giving up after `timeout` seconds
+def open_feed(host, port, timeout=CONNECT_TIMEOUT, read_timeout=None):
+    sock = socket.create_connection((host, port), timeout)
+    sock.settimeout(read_timeout)
+    return sock
+
+
+class Backoff:
+    '''
+    Delays between reconnection attempts: doubled after every
+    failure up to `cap`, with part of every delay randomised
+    '''
+    def __init__(self, base=RETRY_DELAY, cap=MAX_RETRY_DELAY, jitter=RETRY_JITTER):
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.base * 2 ** self.attempts, self.cap)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Feed:
+    '''
+    One non-blocking connection to a feed, with its own
+    buffer, reconnect schedule and metrics
+    '''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = '{}:{}'.format(host, port)
+        self.sock = None
+        self.connecting = False
+        self.connect_started = 0
+        self.pending = ''
+        self.firstline = True
+        self.backoff = Backoff()
+        self.next_attempt = 0
+        self.last_data = 0
+        # metrics
+        self.trades = 0
+        self.parse_errors = 0
+        self.bytes = 0
+        self.reconnects = 0
+        self.connected = False
+
+    def connect(self, now):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.host, self.port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.disconnect(now)
+            return
+        self.connecting = True
+        self.connect_started = now
+
+    def connected_check(self, now):
+        # A non-blocking connect is over when the socket is writable
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.connecting = False
+        if err:
+            self.disconnect(now)
+            return
+        self.connected = True
+        self.firstline = True
+        self.pending = ''
+        self.last_data = now
+        self.backoff.reset()
+        print 'Connected to feed {}'.format(self.name)
+
+    def disconnect(self, now):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        if self.connected:
+            print 'Lost connection to feed {}'.format(self.name)
+        self.sock = None
+        self.connecting = False
+        self.connected = False
+        self.reconnects += 1
+        RECONNECTS.inc()
+        # Retry later, waiting longer after every failure
+        self.next_attempt = now + self.backoff.next()
+
+    def read(self, now):
+        '''
+        Read what is available, returns the complete lines
+        '''
+        try:
+            block = self.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            self.disconnect(now)
+            return []
+        if not block:
+            self.disconnect(now)
+            return []
+
+        self.bytes += len(block)
+        self.last_data = now
+        lines = (self.pending + block).split('\n')
+        self.pending = lines.pop()
+        if self.firstline and lines:
+            # Header
+            lines.pop(0)
+            self.firstline = False
+        return lines
+
+    def metrics(self):
+        return {
+            'feed': self.name,
+            'connected': self.connected,
+            'trades': self.trades,
+            'parse_errors': self.parse_errors,
+            'bytes': self.bytes,
+            'reconnects': self.reconnects
+        }
+
+
+class FeedMultiplexer:
+    '''
+    Reads many feeds from one thread with select and hands
+    every parsed trade to a single callback, so all feeds share
+    the same analysis and db writer. The callback runs between
+    reads of every feed, it should only queue the trade
+    '''
+    def __init__(self, feeds, on_trade, on_tick=None):
+        self.feeds = feeds
+        self.on_trade = on_trade
+        # Called about every POLL_TIMEOUT seconds (metrics, end of day...)
+        self.on_tick = on_tick
+        self.running = True
+
+    def metrics(self):
+        return [feed.metrics() for feed in self.feeds]
+
+    def _schedule(self, now):
+        # (Re)connect feeds and drop those that went quiet
+        for feed in self.feeds:
+            if feed.sock is None and now >= feed.next_attempt:
+                feed.connect(now)
+            elif feed.connecting and now - feed.connect_started > CONNECT_TIMEOUT:
+                feed.disconnect(now)
+            elif feed.connected and now - feed.last_data > IDLE_TIMEOUT:
+                feed.disconnect(now)
+
+    def run(self):
+        last_tick = time.time()
+        while self.running:
+            now = time.time()
+            self._schedule(now)
+
+            readers = dict((f.sock, f) for f in self.feeds if f.connected)
+            writers = dict((f.sock, f) for f in self.feeds if f.connecting)
+            if readers or writers:
+                readable, writable, _ = select.select(list(readers), list(writers), [], POLL_TIMEOUT)
+            else:
+                # Nothing to wait on until the next reconnect
+                time.sleep(POLL_TIMEOUT)
+                readable, writable = [], []
+
+            now = time.time()
+            for sock in writable:
+                writers[sock].connected_check(now)
+            for sock in readable:
+                feed = readers[sock]
+                received = monotonic()
+                for line in feed.read(now):
+                    t = Trade(line)
+                    if t.parse_err:
+                        feed.parse_errors += 1
+                        PARSE_ERRORS.inc()
+                        continue
+                    t.received = received
+                    t.parsed = monotonic()
+                    feed.trades += 1
+                    self.on_trade(t, feed)
+
+            if self.on_tick and now - last_tick >= POLL_TIMEOUT:
+                self.on_tick(now)
+                last_tick = now
+
+    def stop(self):
+        self.running = False
+        for feed in self.feeds:
+            if feed.sock:
+                feed.sock.close()
@@ -7,13 +7,22 @@
 import pytz
 from datetime import datetime
 
-import rethinkdb as r
-from rethinkdb.errors import RqlRuntimeError, RqlDriverError
-
 # Set our timezone
 tz = pytz.timezone('Europe/London')
 
+# trades.datetime is a DateTime without time zone holding London times,
+# make one of its values aware again. Aware values (e.g. from a column
+# changed to timestamptz) are converted rather than failing in localize
+def local_time(value):
+    if value.tzinfo is None:
+        return tz.localize(value)
+    return value.astimezone(tz)
+
 class Trade:
+    # Monotonic times (purple.tracing) the line was read and parsed, if traced
+    received = None
+    parsed = None
+
     def __init__(self, row):
         self.parse_err = False
 
@@ -34,3 +43,20 @@ class Trade:
             self.ask = float(split_row[9])
         except:
             self.parse_err = True
+
+    # Build a trade from already parsed values (e.g. a row from the db)
+    @classmethod
+    def from_values(cls, time, price, size, symbol, bid, ask, buyer=None, seller=None, currency=None, sector=None):
+        t = cls(None)
+        t.parse_err = False
+        t.time = time
+        t.buyer = buyer
+        t.seller = seller
+        t.price = price
+        t.size = size
+        t.currency = currency
+        t.symbol = symbol
+        t.sector = sector
+        t.bid = bid
+        t.ask = ask
+        return t
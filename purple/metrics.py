@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+###########################################
+# Metrics of the backend, Prometheus text #
+###########################################
+
+# Counters, gauges and histograms updated while trades are analysed and
+# rendered in the Prometheus text format, either served over HTTP
+# (--metrics-port, scrape http://host:PORT/metrics) or written to a file
+# every few seconds (--metrics-file, for node_exporter's textfile
+# collector). Updating a metric is a lock and an addition.
+
+import os
+import time
+import bisect
+import resource
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+# Upper bounds in seconds of latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper bounds of trades per saved batch
+BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+# Seconds between two writes of the metrics file
+WRITE_INTERVAL = 5
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        # label values -> value
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _labels(self.labels, key), repr(float(value))))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # counts per bucket (the last one is +Inf), sum
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else repr(float(bound))
+                    lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labels, key, [('le', le)]), cumulative))
+                lines.append('{}_sum{} {}'.format(self.name, _labels(self.labels, key), repr(total)))
+                lines.append('{}_count{} {}'.format(self.name, _labels(self.labels, key), cumulative))
+        return lines
+
+
+class Registry:
+    '''
+    Every metric of the process, and functions setting
+    gauges just before they are rendered
+    '''
+    def __init__(self):
+        self.metrics = []
+        self.hooks = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self.add(Histogram(name, help, buckets, labels))
+
+    def on_collect(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def render(self):
+        for hook in self.hooks:
+            hook()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+TRADES = registry.counter('purple_trades_total', 'Trades analysed.')
+TRADES_PER_SECOND = registry.gauge('purple_trades_per_second', 'Trades analysed per second since the last collection.')
+PARSE_ERRORS = registry.counter('purple_parse_errors_total', 'Lines that could not be parsed as trades.')
+QUEUE_DEPTH = registry.gauge('purple_queue_depth', 'Items waiting in a queue of the stream pipeline.', ['queue'])
+BATCH_SIZE = registry.histogram('purple_batch_trades', 'Trades saved per batch.', BATCH_BUCKETS)
+COMMIT_SECONDS = registry.histogram('purple_commit_seconds', 'Time to commit the db session.')
+ALERT_SECONDS = registry.histogram('purple_alert_seconds', 'Time to write an alert to rethinkdb.')
+ANOMALIES = registry.counter('purple_anomalies_total', 'Anomalies alerted.', ['code', 'severity'])
+RECONNECTS = registry.counter('purple_feed_reconnects_total', 'Times a feed connection was lost.')
+MEMORY = registry.gauge('purple_memory_bytes', 'Memory of the process.', ['kind'])
+
+
+def _rate():
+    # Trades per second between two collections
+    now = time.time()
+    trades = TRADES.value()
+    previous = getattr(_rate, 'previous', None)
+    if previous and now > previous[0]:
+        TRADES_PER_SECOND.set((trades - previous[1]) / (now - previous[0]))
+    _rate.previous = (now, trades)
+
+
+def _memory():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        MEMORY.set(pages * resource.getpagesize(), kind='resident')
+    except (IOError, ValueError, IndexError):
+        pass
+    # kilobytes on Linux
+    MEMORY.set(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024, kind='max_resident')
+
+registry.on_collect(_rate)
+registry.on_collect(_memory)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes aren't worth a line on stdout
+        pass
+
+
+def serve_metrics(port, host='', registry=registry):
+    '''
+    Serve the metrics over HTTP from a daemon thread, returns the server
+    '''
+    server = HTTPServer((host, port), MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def write_metrics(path, registry=registry):
+    '''
+    Replace the metrics file at once, readers never see half of it
+    '''
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'w') as f:
+        f.write(registry.render())
+    os.rename(temporary, path)
+
+
+class MetricsWriter(threading.Thread):
+    '''
+    Writes the metrics file every `interval` seconds
+    '''
+    def __init__(self, path, interval=WRITE_INTERVAL, registry=registry):
+        threading.Thread.__init__(self, name='metrics')
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            write_metrics(self.path, self.registry)
+
+    def stop(self):
+        self.stopped.set()
+        write_metrics(self.path, self.registry)
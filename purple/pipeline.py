@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+###################################################
+# Stages of ingestion connected by bounded queues #
+###################################################
+
+# A live stream is read, parsed and analysed by separate threads:
+#
+#   StreamReader -> lines queue -> parse Stage -> trades queue -> analysis Stage
+#
+# Lines are queued with the monotonic time they were received at
+# (purple.tracing), to follow the latency of their trades.
+#
+# Queues are bounded. When the lines queue is full the reader does not wait
+# (unless the policy is BLOCK): it drops the line (SHED) or appends it to a
+# file on disk that is read back, in order, once the queue drains (SPILL).
+# A slow commit then never stops the socket from being read.
+
+import time
+import socket
+import tempfile
+import threading
+from collections import deque
+from datetime import datetime
+
+from purple.feeds import Backoff, open_feed
+from purple.metrics import RECONNECTS
+from purple.tracing import monotonic
+
+# What a full queue does with a new item
+BLOCK = 'block'
+SHED = 'shed'
+SPILL = 'spill'
+POLICIES = (BLOCK, SHED, SPILL)
+
+# Items held in memory by a queue
+QUEUE_SIZE = 10000
+# Longest wait for an item before a stage checks whether it should stop
+POLL_TIMEOUT = 1.0
+# Weight of the last item in the moving average of a stage latency
+LATENCY_ALPHA = 0.01
+# Bytes read from the feed at once
+RECV_SIZE = 65536
+
+
+class OverflowQueue:
+    '''
+    Bounded FIFO queue shared by threads, with a
+    policy for items put while it is full
+    '''
+    def __init__(self, maxsize=QUEUE_SIZE, policy=BLOCK, directory=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overload policy: {}'.format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.directory = directory
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        # Spilled items, only used with SPILL (items must be one line
+        # strings, or (received, line) pairs of lines without tabs)
+        self.spill = None
+        self.spill_pending = 0
+        self.read_pos = 0
+        # metrics
+        self.puts = 0
+        self.shed = 0
+        self.spilled = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        '''
+        Add an item, returns False if it was shed
+        '''
+        with self.cond:
+            self.puts += 1
+            # Once spilling, items go to disk until it is drained to keep their order
+            if self.spill_pending or len(self.items) >= self.maxsize:
+                if self.policy == SHED:
+                    self.shed += 1
+                    return False
+                if self.policy == SPILL:
+                    self._spill(item)
+                    return True
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.cond.wait(POLL_TIMEOUT)
+            self.items.append(item)
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.cond.notify_all()
+            return True
+
+    def get(self, timeout=POLL_TIMEOUT):
+        '''
+        Oldest item, or None if there is none after `timeout` seconds
+        '''
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                if not self.items and self.spill_pending:
+                    self._refill()
+                if self.items:
+                    item = self.items.popleft()
+                    self.cond.notify_all()
+                    return item
+                remaining = deadline - time.time()
+                if self.closed or remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def _spill(self, item):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(prefix='purple-queue-', dir=self.directory)
+        self.spill.seek(0, 2)
+        if isinstance(item, tuple):
+            item = '{!r}\t{}'.format(*item)
+        self.spill.write(item + '\n')
+        self.spill_pending += 1
+        self.spilled += 1
+        self.max_depth = max(self.max_depth, self.depth())
+
+    def _refill(self):
+        # Move spilled items back to memory, oldest first
+        self.spill.seek(self.read_pos)
+        while self.spill_pending and len(self.items) < self.maxsize:
+            item = self.spill.readline()[:-1]
+            if '\t' in item:
+                received, line = item.split('\t', 1)
+                item = (float(received), line)
+            self.items.append(item)
+            self.spill_pending -= 1
+        self.read_pos = self.spill.tell()
+        if not self.spill_pending:
+            self.spill.seek(0)
+            self.spill.truncate()
+            self.read_pos = 0
+
+    def depth(self):
+        return len(self.items) + self.spill_pending
+
+    def metrics(self):
+        with self.cond:
+            return {
+                'depth': self.depth(),
+                'in_memory': len(self.items),
+                'on_disk': self.spill_pending,
+                'max_depth': self.max_depth,
+                'items': self.puts,
+                'shed': self.shed,
+                'spilled': self.spilled
+            }
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            if self.spill:
+                self.spill.close()
+                self.spill = None
+                self.spill_pending = 0
+
+
+class StageTimer:
+    '''
+    Count, average and worst time of the items of a stage
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.average = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.count == 1:
+            self.average = seconds
+        else:
+            self.average += LATENCY_ALPHA * (seconds - self.average)
+        self.max = max(self.max, seconds)
+
+    def metrics(self):
+        return {
+            'items': self.count,
+            'busy_seconds': self.total,
+            'average_ms': self.average * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+class Stage(threading.Thread):
+    '''
+    Takes items from `inbox`, hands them to `handler` and puts
+    its results (unless None) into `outbox`. Runs in its own
+    thread once started, or one item at a time with step()
+    '''
+    def __init__(self, name, inbox, handler, outbox=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.inbox = inbox
+        self.handler = handler
+        self.outbox = outbox
+        self.timer = StageTimer()
+        self.running = True
+
+    def step(self, timeout=POLL_TIMEOUT):
+        item = self.inbox.get(timeout)
+        if item is None:
+            return False
+        started = time.time()
+        result = self.handler(item)
+        self.timer.record(time.time() - started)
+        if result is not None and self.outbox is not None:
+            self.outbox.put(result)
+        return True
+
+    def run(self):
+        while self.running:
+            self.step()
+
+    def stop(self):
+        self.running = False
+
+    def metrics(self):
+        return self.timer.metrics()
+
+
+class StreamReader(threading.Thread):
+    '''
+    Reads the lines of a feed into `outbox`, as (received, line)
+    pairs, and reconnects on its own with backoff, recording
+    outages in `outages`
+    '''
+    def __init__(self, host, port, outbox, sock=None, outages=None, read_timeout=3):
+        threading.Thread.__init__(self, name='read')
+        self.daemon = True
+        self.host = host
+        self.port = port
+        self.outbox = outbox
+        self.outages = outages
+        self.read_timeout = read_timeout
+        self.backoff = Backoff()
+        self.running = True
+        self.sock = None
+        # metrics
+        self.lines = 0
+        self.bytes = 0
+        self.reconnects = 0
+        if sock:
+            self._connected(sock)
+
+    def _connected(self, sock):
+        self.sock = sock
+        self.backoff.reset()
+        self.connected_at = time.time()
+        self.received = 0
+        # A new connection starts with a header
+        self.pending = ''
+        self.firstline = True
+
+    def _down(self):
+        self.sock.close()
+        self.sock = None
+        self.reconnects += 1
+        RECONNECTS.inc()
+        print "Connection lost, attempting to reconnect"
+        if self.outages:
+            # Used to estimate the trades missed during the outage
+            rate = self.received / max(time.time() - self.connected_at, 1.0)
+            # The feed goes down every night, that one isn't worth a notification
+            self.outages.begin(rate, notify=datetime.now().strftime('%H') != '00')
+
+    def _reconnect(self):
+        time.sleep(self.backoff.next())
+        if self.outages:
+            self.outages.attempt()
+        try:
+            sock = open_feed(self.host, self.port, read_timeout=self.read_timeout)
+        except socket.error:
+            return
+        self._connected(sock)
+        if self.outages and self.outages.down:
+            outage = self.outages.end()
+            print "Reconnected to the feed after {:.0f}s!".format(outage['seconds'])
+
+    def run(self):
+        while self.running:
+            if self.sock is None:
+                self._reconnect()
+                continue
+            try:
+                block = self.sock.recv(RECV_SIZE)
+                if not block:
+                    raise socket.error('Connection closed by the feed')
+            except socket.error:
+                # stop() closed the socket, the feed didn't go down
+                if not self.running:
+                    return
+                self._down()
+                continue
+
+            received = monotonic()
+            self.bytes += len(block)
+            lines = (self.pending + block).split('\n')
+            self.pending = lines.pop()
+            if self.firstline and lines:
+                # Header
+                lines.pop(0)
+                self.firstline = False
+            for line in lines:
+                self.outbox.put((received, line))
+            self.lines += len(lines)
+            self.received += len(lines)
+
+    def stop(self):
+        self.running = False
+        if self.sock:
+            self.sock.close()
+
+    def metrics(self):
+        return {
+            'connected': self.sock is not None,
+            'lines': self.lines,
+            'bytes': self.bytes,
+            'reconnects': self.reconnects
+        }
+
+
+def pipeline_metrics(reader, queues, stages):
+    '''
+    Queue depths and stage latencies, as stored on the task
+    '''
+    return {
+        'read': reader.metrics(),
+        'queues': dict((name, queue.metrics()) for name, queue in queues),
+        'stages': dict((stage.name, stage.metrics()) for stage in stages)
+    }
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+##########################################
+# Stage timers and profilers (--profile) #
+##########################################
+
+# Stage timers are always on: a couple of time.time() calls around parse,
+# TradesAnalyser.add, save_load, detection, alert and commit, summarised
+# at the end of a task and stored on it.
+#
+# --profile wraps a whole command in a profiler and writes a .prof file
+# (pstats format) to open with `snakeviz <file>`:
+#   cprofile  deterministic, every call is counted (slower)
+#   sampling  the stacks of every thread are sampled every few ms of
+#             cpu time, cheap enough for a live stream
+
+import os
+import sys
+import signal
+import marshal
+import cProfile
+
+from purple.pipeline import StageTimer
+
+CPROFILE = 'cprofile'
+SAMPLING = 'sampling'
+PROFILERS = (CPROFILE, SAMPLING)
+# Seconds of cpu time between two samples
+SAMPLE_INTERVAL = 0.005
+
+
+class StageTimers:
+    '''
+    Named StageTimers, created when first recorded
+    '''
+    def __init__(self):
+        self.timers = {}
+
+    def record(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = StageTimer()
+        timer.record(seconds)
+
+    def add(self, name, timer):
+        '''
+        Include a StageTimer kept elsewhere (e.g. by a pipeline Stage)
+        '''
+        self.timers[name] = timer
+
+    def metrics(self):
+        return dict((name, timer.metrics()) for name, timer in self.timers.items())
+
+    def summary(self):
+        '''
+        Table of the stages, most time spent first
+        '''
+        lines = ['{:<12} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'items', 'total s', 'avg ms', 'max ms')]
+        for name, timer in sorted(self.timers.items(), key=lambda item: -item[1].total):
+            lines.append('{:<12} {:>10} {:>10.2f} {:>10.3f} {:>10.3f}'.format(
+                name, timer.count, timer.total, timer.average * 1000, timer.max * 1000
+            ))
+        return '\n'.join(lines)
+
+
+def _label(code):
+    # Function key used by pstats
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of every thread on SIGPROF and
+    writes them as pstats, like cProfile would
+    '''
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        # function -> [samples on top of the stack, samples anywhere in it]
+        self.functions = {}
+        # (caller, callee) -> samples
+        self.calls = {}
+        self.samples = 0
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        handler = sys._getframe()
+        for thread_frame in sys._current_frames().values():
+            # The interrupted thread is found running this handler
+            if thread_frame is handler:
+                thread_frame = frame
+            stack = []
+            while thread_frame is not None:
+                stack.append(_label(thread_frame.f_code))
+                thread_frame = thread_frame.f_back
+            if not stack:
+                continue
+            self.functions.setdefault(stack[0], [0, 0])[0] += 1
+            # Recursive functions are counted once per sample
+            for function in set(stack):
+                self.functions.setdefault(function, [0, 0])[1] += 1
+            for callee, caller in set(zip(stack, stack[1:])):
+                self.calls[(caller, callee)] = self.calls.get((caller, callee), 0) + 1
+
+    def enable(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        # Blocking reads (sockets, files) carry on rather than fail with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def stats(self):
+        '''
+        Samples as the dict pstats reads:
+        function -> (calls, primitive calls, own time, cumulative time, callers)
+        '''
+        callers = {}
+        for (caller, callee), count in self.calls.items():
+            seconds = count * self.interval
+            callers.setdefault(callee, {})[caller] = (count, count, seconds, seconds)
+        stats = {}
+        for function, (own, cumulative) in self.functions.items():
+            stats[function] = (
+                cumulative, cumulative, own * self.interval,
+                cumulative * self.interval, callers.get(function, {})
+            )
+        return stats
+
+    def dump_stats(self, path):
+        with open(path, 'wb') as f:
+            marshal.dump(self.stats(), f)
+
+
+def profile_path(name):
+    return os.path.abspath('purple-{}-{}.prof'.format(name, os.getpid()))
+
+
+def profiled(kind, path, function, *args, **kwargs):
+    '''
+    Run function under a profiler and write its stats to path
+    '''
+    if kind not in PROFILERS:
+        raise ValueError('Unknown profiler: {}'.format(kind))
+    profiler = cProfile.Profile() if kind == CPROFILE else SamplingProfiler()
+    profiler.enable()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print '\nProfile written to {} (snakeviz {})'.format(path, path)
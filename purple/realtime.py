@@ -14,11 +14,18 @@ tz = pytz.timezone('Europe/London')
 
 # Manage notifications for frontend
 class NotificationManager:
+    # Store a notification, returns its id
     def add(self, **kwargs):
         with get_reql_connection(db=True) as conn:
-            r.table('notifications').insert([
+            res = r.table('notifications').insert([
                 kwargs
             ]).run(conn, durability='soft')
+            return res['generated_keys'][0]
+
+    # Change a notification already shown
+    def update(self, pk, **kwargs):
+        with get_reql_connection(db=True) as conn:
+            r.table('notifications').get(pk).update(kwargs).run(conn, durability='soft')
 
 # Manage alerts for frontend
 class AlertManager:
@@ -28,23 +35,144 @@ class AlertManager:
 
 # Manage tasks for frontend
 class TaskManager:
-    # Store a task
+    # Store a task, running in this process
     @staticmethod
     def store(**kwargs):
         params = kwargs.copy()
         params['pid'] = os.getpid()
         params['created_at'] = tz.localize(datetime.now())
+        params['started_at'] = params['created_at']
+        params['state'] = 'running'
         params['terminated'] = False
 
         with get_reql_connection(db=True) as conn:
             res = r.table('tasks').insert(params).run(conn)
             return res['generated_keys'][0]
 
+    @staticmethod
+    # Store a task waiting to be started by the scheduler
+    def queue(**kwargs):
+        params = kwargs.copy()
+        params['created_at'] = tz.localize(datetime.now())
+        params['state'] = 'queued'
+        params['terminated'] = False
+
+        with get_reql_connection(db=True) as conn:
+            res = r.table('tasks').insert(params).run(conn)
+            return res['generated_keys'][0]
+
+    @staticmethod
+    # A queued task starts running in this process
+    def start(pk, **kwargs):
+        params = kwargs.copy()
+        params['pid'] = os.getpid()
+        params['started_at'] = tz.localize(datetime.now())
+        params['state'] = 'running'
+        with get_reql_connection(db=True) as conn:
+            r.table('tasks').get(pk).update(params).run(conn)
+
+    @staticmethod
+    # Store extra information on a task
+    def update(pk, **kwargs):
+        with get_reql_connection(db=True) as conn:
+            r.table('tasks').get(pk).update(kwargs).run(conn)
+
+    @staticmethod
+    def get(pk):
+        with get_reql_connection(db=True) as conn:
+            return r.table('tasks').get(pk).run(conn)
+
+    @staticmethod
+    # Tasks started and not ended yet
+    def running_count():
+        with get_reql_connection(db=True) as conn:
+            return r.table('tasks').filter(
+                (r.row['terminated'] == False) & (r.row['state'].default('running') == 'running')
+            ).count().run(conn)
+
     @staticmethod
     # End a task
-    def end(pk):
+    def end(pk, state='finished'):
         with get_reql_connection(db=True) as conn:
             r.table('tasks').get(pk).update({
                 'ended_at': tz.localize(datetime.now()),
+                'state': state,
                 'terminated': True
             }).run(conn)
+
+
+# Outages of a live feed
+class OutageLog:
+    '''
+    Records every outage window of a feed on its task and
+    keeps a single notification about them up to date,
+    instead of adding one on every failed read
+    '''
+    def __init__(self, task_pk, notification_manager=None, task_manager=None):
+        self.task_pk = task_pk
+        self.notification_manager = notification_manager or NotificationManager()
+        self.task_manager = task_manager or TaskManager()
+        self.notification_pk = None
+        self.outages = []
+        # Outage in progress
+        self.start = None
+        self.rate = 0
+        self.attempts = 0
+
+    @property
+    def down(self):
+        return self.start is not None
+
+    def begin(self, rate, notify=True):
+        '''
+        The feed went down while receiving `rate` trades per second
+        '''
+        self.start = tz.localize(datetime.now())
+        self.rate = rate
+        self.attempts = 0
+        if notify:
+            self.notify(
+                level='error',
+                title='Feed appears to be down',
+                message='The data feed has been down since {}. Attempting to reconnect.'.format(
+                    self.start.strftime('%H:%M:%S')
+                )
+            )
+
+    def attempt(self):
+        self.attempts += 1
+
+    def end(self):
+        '''
+        The feed is back, store the outage window on the task
+        '''
+        end = tz.localize(datetime.now())
+        seconds = (end - self.start).total_seconds()
+        outage = {
+            'start': self.start,
+            'end': end,
+            'seconds': seconds,
+            'attempts': self.attempts,
+            'missed_trades': int(round(self.rate * seconds))
+        }
+        self.outages.append(outage)
+        self.start = None
+        if self.task_pk:
+            self.task_manager.update(self.task_pk, outages=self.outages)
+        if self.notification_pk:
+            self.notify(
+                level='info',
+                title='Feed reconnected',
+                message=(
+                    'The data feed was down for {:.0f}s, about {} trades were missed '
+                    '({} outages so far).'.format(seconds, outage['missed_trades'], len(self.outages))
+                )
+            )
+        return outage
+
+    def notify(self, **kwargs):
+        kwargs['datetime'] = tz.localize(datetime.now())
+        if self.notification_pk:
+            self.notification_manager.update(self.notification_pk, **kwargs)
+        else:
+            self.notification_pk = self.notification_manager.add(**kwargs)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#############################################
+# Queue of analysis jobs run a few at once #
+#############################################
+
+# Jobs are main.py command lines. File, stream and backtest jobs get a task
+# in the `tasks` table as soon as they are submitted (state 'queued') and
+# wait for one of `max_running` slots; the task turns 'running' once the job
+# starts and 'finished' (or 'failed', 'cancelled') when it ends. Other jobs
+# (--init-db, --reset-db) start straight away.
+
+import heapq
+import itertools
+
+# Lower runs first: live data must not wait behind files
+PRIORITIES = {
+    'stream': 0,
+    'file': 1,
+    'backtest': 2
+}
+
+# Jobs running at once
+MAX_RUNNING = 2
+
+
+def job_type(argv):
+    '''
+    Kind of task a main.py command line starts, None if it starts none
+    '''
+    for arg in argv:
+        if arg in ('-s', '--stream-url', '--feeds'):
+            return 'stream'
+        if arg in ('-f', '--file'):
+            return 'file'
+        if arg == '--backtest':
+            return 'backtest'
+    return None
+
+
+class JobScheduler:
+    '''
+    Starts queued jobs by priority (then submission order)
+    while fewer than `max_running` are running. `launch`
+    starts a job's command line and returns its pid.
+    '''
+    def __init__(self, launch, max_running=MAX_RUNNING, task_manager=None):
+        self.launch = launch
+        self.max_running = max_running
+        if task_manager is None:
+            # Only the daemon needs the db, importing the scheduler is cheap
+            from purple.realtime import TaskManager
+            task_manager = TaskManager()
+        self.task_manager = task_manager
+        self.queue = []
+        self.order = itertools.count()
+        # pid -> job
+        self.running = {}
+        # metrics
+        self.submitted = 0
+        self.finished = 0
+
+    def submit(self, argv):
+        '''
+        Queue (or start) a job, returns it as a dict
+        '''
+        self.submitted += 1
+        kind = job_type(argv)
+        job = {'args': argv, 'type': kind, 'task': None, 'pid': None}
+        if kind is None:
+            job['pid'] = self.launch(argv)
+            self.running[job['pid']] = job
+            return job
+
+        task = 'backtest' if kind == 'backtest' else 'analysis'
+        job['task'] = self.task_manager.queue(task=task, type=kind, priority=PRIORITIES[kind])
+        heapq.heappush(self.queue, (PRIORITIES[kind], next(self.order), job))
+        self.dispatch()
+        return job
+
+    def slots(self):
+        # Jobs without a task don't take a slot
+        return self.max_running - len([job for job in self.running.values() if job['task']])
+
+    def dispatch(self):
+        '''
+        Start queued jobs while there are free slots
+        '''
+        while self.queue and self.slots() > 0:
+            _, _, job = heapq.heappop(self.queue)
+            # Cancelled from the frontend while queued
+            task = self.task_manager.get(job['task'])
+            if not task or task['terminated']:
+                continue
+            job['pid'] = self.launch(job['args'] + ['--task-id', job['task']])
+            self.running[job['pid']] = job
+
+    def done(self, pid, code):
+        '''
+        A job process ended, returns its job (None if unknown)
+        '''
+        job = self.running.pop(pid, None)
+        if job is None:
+            return None
+        self.finished += 1
+        if job['task']:
+            # Jobs killed outright never ended their task
+            task = self.task_manager.get(job['task'])
+            if task and not task['terminated']:
+                self.task_manager.end(job['task'], state='failed' if code else 'finished')
+        self.dispatch()
+        return job
+
+    def metrics(self):
+        return {
+            'queued': len(self.queue),
+            'running': len(self.running),
+            'submitted': self.submitted,
+            'finished': self.finished
+        }
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+#################################################
+# Rolling sector aggregates and sector anomalies #
+#################################################
+
+# Used for log returns
+import math
+# Used for epoch minutes
+import calendar
+from collections import deque
+
+# Number of minutes in the rolling windows
+WINDOW_MINUTES = 60
+# Completed minutes needed before sector spikes are looked for
+WARMUP_MINUTES = 30
+# Symbols needed in a sector to compare a symbol with its sector
+# and to collapse per-symbol alerts into one sector alert
+MIN_SECTOR_SYMBOLS = 3
+
+# Lowest spread of returns across a sector (0.1%), stops quiet sectors
+# from turning tiny moves of one symbol into large deviations
+MIN_RETURN_STDEV = 0.001
+
+# Number of standard deviations for severities 1, 2 and 3
+THRESHOLDS = ((7, 1), (6, 2), (5, 3))
+
+
+# Minutes since epoch, used as bucket key
+def epoch_minute(time):
+    return calendar.timegm(time.utctimetuple()) // 60
+
+
+# Most severe severity for which value is outside mean +/- n * stdev
+def severity_of(value, mean, stdev, two_sided=False):
+    if not stdev:
+        return None
+    for n, severity in THRESHOLDS:
+        if value >= mean + n * stdev or (two_sided and value <= mean - n * stdev):
+            return severity
+    return None
+
+
+class RollingWindow:
+    '''
+    Volume, log return and trade count over the last `size` minutes.
+
+    Trades are summed into one bucket per minute. Totals are kept
+    up to date by adding each trade and subtracting buckets as they
+    expire, so an update is O(1) amortised and never rescans trades.
+    '''
+    def __init__(self, size=WINDOW_MINUTES):
+        self.size = size
+        # [minute, volume, log return, trades]
+        self.buckets = deque()
+        self.volume = 0
+        self.log_return = 0.0
+        self.trades = 0
+
+    def add(self, minute, volume, log_return):
+        '''
+        Add a trade, returns the bucket completed by
+        this trade if it's the first of a new minute
+        '''
+        completed = None
+        if not self.buckets or self.buckets[-1][0] != minute:
+            if self.buckets:
+                completed = tuple(self.buckets[-1])
+            self.buckets.append([minute, 0, 0.0, 0])
+
+        bucket = self.buckets[-1]
+        bucket[1] += volume
+        bucket[2] += log_return
+        bucket[3] += 1
+        self.volume += volume
+        self.log_return += log_return
+        self.trades += 1
+
+        # Expire buckets that fell out of the window
+        while self.buckets[0][0] <= minute - self.size:
+            _, old_volume, old_return, old_trades = self.buckets.popleft()
+            self.volume -= old_volume
+            self.log_return -= old_return
+            self.trades -= old_trades
+
+        return completed
+
+    def trade_rate(self):
+        # Trades per minute over the window
+        return self.trades / float(len(self.buckets))
+
+
+class RunningStats:
+    '''
+    Running mean and standard deviation (Welford's method)
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        change = value - self.mean
+        self.mean += change / float(self.count)
+        self.m2 += change * (value - self.mean)
+
+    def stdev(self):
+        if not self.count:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+
+class SectorTracker:
+    '''
+    Keeps rolling aggregates for every sector and symbol
+    while trades are ingested, and uses them to find:
+    - symbols whose return deviates from the rest of their sector (SD)
+    - minutes of abnormal sector wide volume (SVS) or trade rate (STR)
+    '''
+    def __init__(self, window=WINDOW_MINUTES, warmup=WARMUP_MINUTES, min_symbols=MIN_SECTOR_SYMBOLS):
+        self.window = window
+        self.warmup = warmup
+        self.min_symbols = min_symbols
+        # symbol -> sector
+        self.symbol_sector = {}
+        # symbol -> last price, used for log returns
+        self.last_price = {}
+        # symbol -> RollingWindow
+        self.symbol_windows = {}
+        # sector -> RollingWindow
+        self.sector_windows = {}
+        # sector -> {'sum', 'sumsq', 'returns': {symbol: window log return}}
+        # Cross sectional sums of symbol returns, updated by replacing
+        # the value of the symbol that just traded
+        self.sector_returns = {}
+        # sector -> {'volume': RunningStats, 'trades': RunningStats} of completed minutes
+        self.sector_minutes = {}
+        # symbol -> severity of the last deviation alert, until it goes back to normal
+        self.deviating = {}
+
+    def add(self, trade, identifier):
+        '''
+        Update aggregates with a trade, returns a list
+        of anomalies in the same format as AnomalousTradeFinder
+        '''
+        anomalies = []
+        symbol = trade.symbol
+        sector = trade.sector
+        if not sector:
+            return anomalies
+
+        if symbol not in self.symbol_sector:
+            self.symbol_sector[symbol] = sector
+            self.symbol_windows[symbol] = RollingWindow(self.window)
+        if sector not in self.sector_windows:
+            self.sector_windows[sector] = RollingWindow(self.window)
+            self.sector_returns[sector] = {'sum': 0.0, 'sumsq': 0.0, 'returns': {}}
+            self.sector_minutes[sector] = {'volume': RunningStats(), 'trades': RunningStats()}
+
+        # Log returns add up over the window: their sum is log(last / first)
+        last = self.last_price.get(symbol)
+        log_return = math.log(trade.price / last) if last and trade.price > 0 else 0.0
+        self.last_price[symbol] = trade.price
+
+        minute = epoch_minute(trade.time)
+        self.symbol_windows[symbol].add(minute, trade.size, log_return)
+        completed = self.sector_windows[sector].add(minute, trade.size, log_return)
+
+        # A minute of the sector is over, check it for spikes
+        if completed:
+            anomalies.extend(self._check_sector_minute(sector, completed, trade))
+
+        anomalies.extend(self._check_deviation(sector, symbol, trade, identifier))
+        return anomalies
+
+    def _check_sector_minute(self, sector, bucket, trade):
+        anomalies = []
+        _, volume, _, trades = bucket
+        minutes = self.sector_minutes[sector]
+        for field, value, code, name in (
+            ('volume', volume, 'SVS', 'volume'),
+            ('trades', trades, 'STR', 'trade rate')
+        ):
+            stats = minutes[field]
+            if stats.count >= self.warmup:
+                severity = severity_of(value, stats.mean, stats.stdev())
+                if severity:
+                    description = 'Sector wide {} spike for {}'.format(name, sector)
+                    anomalies.append(self._anomaly(-1, trade.time, description, code, severity, sector, sector))
+            stats.add(value)
+        return anomalies
+
+    def _check_deviation(self, sector, symbol, trade, identifier):
+        # Replace this symbol's window return in the cross sectional sums
+        returns = self.sector_returns[sector]
+        new = self.symbol_windows[symbol].log_return
+        old = returns['returns'].get(symbol, 0.0)
+        returns['sum'] += new - old
+        returns['sumsq'] += new * new - old * old
+        returns['returns'][symbol] = new
+
+        n = len(returns['returns'])
+        if n < self.min_symbols:
+            return []
+
+        # Compare with the other symbols of the sector
+        others = n - 1
+        mean = (returns['sum'] - new) / others
+        variance = (returns['sumsq'] - new * new) / others - mean * mean
+        stdev = max(math.sqrt(variance) if variance > 0 else 0.0, MIN_RETURN_STDEV)
+        severity = severity_of(new, mean, stdev, two_sided=True)
+
+        # Only alert when a symbol starts deviating or gets worse
+        previous = self.deviating.get(symbol)
+        if not severity:
+            self.deviating.pop(symbol, None)
+            return []
+        if previous and previous <= severity:
+            return []
+        self.deviating[symbol] = severity
+
+        description = '{} deviating from {} sector'.format(symbol, sector)
+        return [self._anomaly(identifier, trade.time, description, 'SD', severity, symbol, sector)]
+
+    def sector_stats(self, sector):
+        '''
+        Current rolling aggregates of a sector
+        '''
+        window = self.sector_windows[sector]
+        returns = self.sector_returns[sector]
+        return {
+            'volume': window.volume,
+            'trades': window.trades,
+            'trade_rate': window.trade_rate(),
+            'return': math.exp(returns['sum'] / len(returns['returns'])) - 1,
+            'symbols': len(returns['returns'])
+        }
+
+    def collapse(self, anomalies):
+        '''
+        Replace per-symbol anomalies of the same type and period
+        raised on many symbols of a sector by one sector anomaly
+        '''
+        groups = {}
+        order = []
+        for anomaly in anomalies:
+            sector = self.symbol_sector.get(anomaly["symbol"])
+            key = (sector, anomaly["error_code"], self._period(anomaly))
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(anomaly)
+
+        collapsed = []
+        for key in order:
+            group = groups[key]
+            sector, error_code, _ = key
+            symbols = sorted(set(a["symbol"] for a in group))
+            if sector is None or len(symbols) < self.min_symbols:
+                collapsed.extend(group)
+                continue
+            # Description of the first anomaly without its symbol
+            kind = group[0]["description"].rsplit(group[0]["symbol"], 1)[0].strip()
+            if kind.endswith(' for'):
+                kind = kind[:-4]
+            description = '{} on {} {} symbols: {}'.format(kind, len(symbols), sector, ', '.join(symbols))
+            anomaly = self._anomaly(-1, group[0]["time"], description, error_code + '-S',
+                                    min(a["severity"] for a in group), sector, sector)
+            anomaly['symbols'] = symbols
+            # Trades of the window, for the context shown with the alert
+            for field in ('from', 'to'):
+                if field in group[0]:
+                    anomaly[field] = group[0][field]
+            collapsed.append(anomaly)
+        return collapsed
+
+    @staticmethod
+    def _period(anomaly):
+        # Hourly and daily anomalies happen together when their windows
+        # start at the same time, their "time" only counts hours from the
+        # first trade of their own symbol
+        if 'from' in anomaly:
+            return epoch_minute(anomaly['from'])
+        if hasattr(anomaly["time"], 'utctimetuple'):
+            return epoch_minute(anomaly["time"])
+        # Hour index without a window, never the period of another symbol
+        return (anomaly["symbol"], anomaly["time"])
+
+    @staticmethod
+    def _anomaly(identifier, time, description, error_code, severity, symbol, sector):
+        return {
+            'id': identifier,
+            'time': time,
+            'description': description,
+            'error_code': error_code,
+            'severity': severity,
+            'symbol': symbol,
+            'sector': sector
+        }
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+##############################################
+# Fixed memory streaming quantile estimation #
+##############################################
+
+# Used for merging sorted centroid lists
+import heapq
+# Used for finding the knots around a value
+import bisect
+
+# Scale factor turning a median absolute deviation into a stdev estimate
+# for normally distributed data
+MAD_TO_STDEV = 1.4826
+
+# Fields of a trade we keep a sketch for
+SKETCH_FIELDS = ('price_delta', 'volume')
+
+
+class QuantileSketch:
+    '''
+    Merging t-digest style quantile sketch.
+
+    Values are summarised into at most a few times `compression`
+    centroids (mean, weight). Centroids near the median are allowed
+    to grow large while those at the tails stay small, so extreme
+    percentiles stay accurate. Two sketches can be merged, which
+    lets shards summarise their own trades and be combined later.
+    '''
+    def __init__(self, compression=100):
+        self.compression = compression
+        # Sorted list of (mean, weight) tuples
+        self.centroids = []
+        # Unsorted values waiting to be merged into the centroids
+        self.buffer = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        value = float(value)
+        self.buffer.append((value, weight))
+        self.count += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        # Keep memory bounded by compressing once the buffer is full
+        if len(self.buffer) >= self.compression * 5:
+            self._compress()
+
+    def merge(self, other):
+        '''
+        Merge another sketch into this one (in place)
+        '''
+        if not other.count:
+            return self
+        self.buffer.extend(other.centroids)
+        self.buffer.extend(other.buffer)
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._compress()
+        return self
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = heapq.merge(self.centroids, sorted(self.buffer))
+        self.buffer = []
+        total = float(self.count)
+
+        merged = []
+        cumulative = 0.0
+        cur_mean, cur_weight = next(points)
+        for mean, weight in points:
+            # Largest weight allowed for a centroid at this quantile
+            q = (cumulative + (cur_weight + weight) / 2.0) / total
+            limit = 4 * total * q * (1 - q) / self.compression
+            if cur_weight + weight <= limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / float(cur_weight)
+            else:
+                merged.append((cur_mean, cur_weight))
+                cumulative += cur_weight
+                cur_mean, cur_weight = mean, weight
+        merged.append((cur_mean, cur_weight))
+        self.centroids = merged
+
+    def _knots(self):
+        # Piecewise linear CDF going through the min, the centre
+        # of every centroid and the max
+        self._compress()
+        knots = [(self.min, 0.0)]
+        cumulative = 0.0
+        for mean, weight in self.centroids:
+            knots.append((mean, cumulative + weight / 2.0))
+            cumulative += weight
+        knots.append((self.max, cumulative))
+        return knots
+
+    def quantile(self, q):
+        '''
+        Estimated value at quantile q (0 <= q <= 1)
+        '''
+        if not self.count:
+            return 0.0
+        knots = self._knots()
+        target = q * self.count
+        for i in range(1, len(knots)):
+            value, position = knots[i]
+            if target <= position:
+                prev_value, prev_position = knots[i - 1]
+                if position == prev_position:
+                    return value
+                ratio = (target - prev_position) / (position - prev_position)
+                return prev_value + (value - prev_value) * ratio
+        return self.max
+
+    def cdf(self, x):
+        '''
+        Estimated fraction of values lower or equal to x
+        '''
+        if not self.count or x < self.min:
+            return 0.0
+        if x >= self.max:
+            return 1.0
+        knots = self._knots()
+        for i in range(1, len(knots)):
+            value, position = knots[i]
+            if x < value:
+                prev_value, prev_position = knots[i - 1]
+                ratio = (x - prev_value) / (value - prev_value)
+                return (prev_position + (position - prev_position) * ratio) / self.count
+        return 1.0
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def mad(self):
+        '''
+        Median absolute deviation: the distance around the median
+        holding half of the values, in one walk over the knots
+        '''
+        if not self.count:
+            return 0.0
+        median = self.median()
+        knots = self._knots()
+        values = [value for value, _ in knots]
+
+        # Values at or below x on the piecewise linear CDF
+        def rank(x):
+            i = bisect.bisect_right(values, x)
+            if i == 0:
+                return 0.0
+            if i == len(knots):
+                return float(self.count)
+            prev_value, prev_position = knots[i - 1]
+            value, position = knots[i]
+            return prev_position + (position - prev_position) * (x - prev_value) / (value - prev_value)
+
+        # Values held around the median grow linearly between the
+        # distances of the knots to it, interpolate in the first segment
+        # reaching half of them
+        target = self.count / 2.0
+        right = [value - median for value in values if value > median]
+        left = [median - value for value in reversed(values) if value < median]
+        prev_distance, prev_held = 0.0, 0.0
+        for distance in heapq.merge(left, right):
+            held = rank(median + distance) - rank(median - distance)
+            if held >= target:
+                if held == prev_held:
+                    return distance
+                return prev_distance + (distance - prev_distance) * (target - prev_held) / (held - prev_held)
+            prev_distance, prev_held = distance, held
+        return prev_distance
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'median': self.median(),
+            'mad': self.mad(),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'p999': self.quantile(0.999)
+        }
+
+    def to_dict(self):
+        # Serialisable form so sketches can be shipped between processes
+        self._compress()
+        return {
+            'compression': self.compression,
+            'centroids': self.centroids,
+            'count': self.count,
+            'min': self.min,
+            'max': self.max
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(compression=d['compression'])
+        sketch.centroids = [tuple(c) for c in d['centroids']]
+        sketch.count = d['count']
+        sketch.min = d['min']
+        sketch.max = d['max']
+        return sketch
+
+
+# Robust centre and scale (median and scaled MAD) for a sketch
+def robust_centre_scale(sketch):
+    return sketch.median(), MAD_TO_STDEV * sketch.mad()
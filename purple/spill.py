@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#####################################################
+# Per symbol on-disk columns for out-of-core files  #
+#####################################################
+
+import os
+import shutil
+import calendar
+import tempfile
+from array import array
+from datetime import datetime
+
+import pytz
+
+# Set our timezone
+tz = pytz.timezone('Europe/London')
+
+# Columns written for every trade and their array typecodes
+COLUMNS = (
+    ('time', 'd'),
+    ('id', 'l'),
+    ('price', 'd'),
+    ('price_delta', 'd'),
+    ('volume', 'l'),
+    ('bid_ask_spread', 'd')
+)
+
+# Rows buffered in memory (over all symbols) before writing to disk
+BUFFER_ROWS = 100000
+
+
+class SymbolSpill:
+    '''
+    Spills the trades of every symbol to one file per column in a
+    temporary directory while a file is being read. Columns are read
+    back one symbol at a time, so only the largest symbol has to fit
+    in memory.
+    '''
+    def __init__(self, directory=None, buffer_rows=BUFFER_ROWS):
+        self.directory = tempfile.mkdtemp(prefix='purple-spill-', dir=directory)
+        self.buffer_rows = buffer_rows
+        self.buffered = 0
+        # symbol -> {column: array}
+        self.buffers = {}
+        # symbol -> file prefix, symbols are numbered to keep file names safe
+        self.prefixes = {}
+        # symbol -> price of its last trade, needed for price deltas
+        self.last_prices = {}
+
+    def _path(self, symbol, column):
+        return os.path.join(self.directory, '{}.{}'.format(self.prefixes[symbol], column))
+
+    def append(self, symbol, row):
+        if symbol not in self.prefixes:
+            self.prefixes[symbol] = len(self.prefixes)
+        if symbol not in self.buffers:
+            self.buffers[symbol] = dict((column, array(code)) for column, code in COLUMNS)
+
+        buff = self.buffers[symbol]
+        buff['time'].append(calendar.timegm(row['time'].utctimetuple()) + row['time'].microsecond / 1e6)
+        for column, _ in COLUMNS[1:]:
+            buff[column].append(row[column])
+
+        self.last_prices[symbol] = row['price']
+        self.buffered += 1
+        if self.buffered >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        '''
+        Append every buffered column to its file
+        '''
+        for symbol, buff in self.buffers.items():
+            for column, _ in COLUMNS:
+                with open(self._path(symbol, column), 'ab') as f:
+                    buff[column].tofile(f)
+        self.buffers = {}
+        self.buffered = 0
+
+    def last_price(self, symbol):
+        return self.last_prices.get(symbol)
+
+    def symbols(self):
+        return list(self.prefixes)
+
+    def load(self, symbol):
+        '''
+        Read back the trades of a symbol, in the same
+        format as AnomalousTradeFinder.trade_history
+        '''
+        self.flush()
+        # Every row becomes a dict, so the columns are read
+        # straight into arrays rather than mapped
+        columns = []
+        for column, code in COLUMNS:
+            path = self._path(symbol, column)
+            values = array(code)
+            with open(path, 'rb') as f:
+                values.fromfile(f, os.path.getsize(path) // values.itemsize)
+            columns.append(values)
+
+        rows = []
+        for time, identifier, price, price_delta, volume, spread in zip(*columns):
+            rows.append({
+                'time': datetime.fromtimestamp(time, tz),
+                'id': identifier,
+                'price': price,
+                'price_delta': price_delta,
+                'volume': volume,
+                'bid_ask_spread': spread
+            })
+        return rows
+
+    def close(self):
+        '''
+        Delete the spilled files
+        '''
+        self.buffers = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+################################################
+# One feed split by symbol over many analysers #
+################################################
+
+# The splitter reads the feed socket once and sends every line to the
+# partition owning its symbol. Partitions are either worker processes on
+# this machine (over pipes) or consumers on other machines (over a local
+# TCP relay, which looks like the original feed to them). A symbol always
+# lands on the same partition, so every partition has its own disjoint
+# set of symbols, its own AnomalousTradeFinder and its own db writer.
+
+import os
+import zlib
+import time
+import signal
+import socket
+import threading
+import multiprocessing
+from datetime import date
+
+from purple import db
+from purple.finance import Trade
+from purple.analysis import TradesAnalyser
+from purple.archive import ArchiveWriter
+from purple.feeds import Backoff, CONNECT_TIMEOUT
+from purple.pipeline import OverflowQueue, SHED
+
+# Column of the symbol in a feed line
+SYMBOL_COLUMN = 6
+# Bytes read from the feed at once
+RECV_SIZE = 65536
+# Lines sent to a partition at once
+BATCH_LINES = 500
+# Longest time in seconds lines wait before being sent
+BATCH_INTERVAL = 0.2
+# Seconds a worker waits for lines before checking the day
+POLL_TIMEOUT = 1.0
+# Batches of a relay partition waiting for its consumer, newer ones are shed
+RELAY_QUEUE = 1000
+# Seconds a closing relay waits for its queued batches to be sent
+RELAY_CLOSE_TIMEOUT = 5.0
+# First line sent to relay consumers, skipped by them like a feed header
+RELAY_HEADER = 'time,buyer,seller,price,size,currency,symbol,sector,bid,ask'
+
+
+def symbol_of(line):
+    parts = line.split(',', SYMBOL_COLUMN + 1)
+    if len(parts) <= SYMBOL_COLUMN:
+        return ''
+    return parts[SYMBOL_COLUMN]
+
+
+def partition_of(symbol, partitions):
+    '''
+    Partition owning a symbol, stable across processes and
+    machines (unlike hash(), which may be randomised)
+    '''
+    return (zlib.crc32(symbol) & 0xffffffff) % partitions
+
+
+class PipeSink:
+    '''
+    Sends batches of lines to a local worker process
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+
+    def send(self, lines):
+        self.conn.send_bytes('\n'.join(lines))
+
+    def close(self):
+        # An empty message tells the worker the feed is over
+        try:
+            self.conn.send_bytes('')
+        except (IOError, OSError):
+            pass
+        self.conn.close()
+
+
+class RelaySink:
+    '''
+    Serves the lines of one partition on a TCP port. The consumer
+    reads it like a feed: a header line then one trade per line.
+    A thread of its own accepts the consumer and sends it the
+    batches, so a partition without a (fast enough) consumer never
+    holds up the others: its batches wait in a bounded queue, and
+    are shed once it is full.
+    '''
+    def __init__(self, port, host='', queue_size=RELAY_QUEUE):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(1)
+        # Accepting times out to notice the sink was closed
+        self.server.settimeout(POLL_TIMEOUT)
+        self.port = self.server.getsockname()[1]
+        self.conn = None
+        self.queue = OverflowQueue(maxsize=queue_size, policy=SHED)
+        self.thread = threading.Thread(target=self._run, name='relay-{}'.format(self.port))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept(self):
+        try:
+            conn, address = self.server.accept()
+        except socket.timeout:
+            return
+        conn.settimeout(None)
+        try:
+            conn.sendall(RELAY_HEADER + '\n')
+        except socket.error:
+            conn.close()
+            return
+        self.conn = conn
+        print 'Consumer {} connected on port {}'.format(address[0], self.port)
+
+    def _run(self):
+        print 'Waiting for a consumer on port {}'.format(self.port)
+        while not (self.queue.closed and not self.queue.depth()):
+            if self.conn is None:
+                if self.queue.closed:
+                    # Nobody to hand the rest to
+                    return
+                self._accept()
+                continue
+            data = self.queue.get()
+            if data is None:
+                continue
+            try:
+                self.conn.sendall(data)
+            except socket.error:
+                # The consumer went away, wait for it to reconnect
+                print 'Consumer left port {}'.format(self.port)
+                self.conn.close()
+                self.conn = None
+
+    def send(self, lines):
+        self.queue.put('\n'.join(lines) + '\n')
+
+    def close(self):
+        # Batches already queued are still sent to a connected consumer
+        self.queue.close()
+        self.thread.join(RELAY_CLOSE_TIMEOUT)
+        if self.queue.shed:
+            print 'Shed {} batches of port {} while its consumer was away'.format(self.queue.shed, self.port)
+        if self.conn:
+            self.conn.close()
+        self.server.close()
+
+
+class FeedSplitter:
+    '''
+    Reads a feed and hands its lines, batched, to the
+    sink of the partition owning their symbol
+    '''
+    def __init__(self, host, port, sinks):
+        self.host = host
+        self.port = port
+        self.sinks = sinks
+        self.batches = [[] for _ in sinks]
+        self.lines = [0] * len(sinks)
+        self.last_send = time.time()
+        self.running = True
+
+    def dispatch(self, line):
+        k = partition_of(symbol_of(line), len(self.sinks))
+        self.batches[k].append(line)
+        self.lines[k] += 1
+        if len(self.batches[k]) >= BATCH_LINES:
+            self.sinks[k].send(self.batches[k])
+            self.batches[k] = []
+
+    def flush(self):
+        for k, batch in enumerate(self.batches):
+            if batch:
+                self.sinks[k].send(batch)
+                self.batches[k] = []
+        self.last_send = time.time()
+
+    def read(self, sock):
+        '''
+        Read from a connected feed until it closes,
+        returns the number of lines dispatched
+        '''
+        pending = ''
+        firstline = True
+        dispatched = 0
+        while self.running:
+            try:
+                block = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                self.flush()
+                continue
+            if not block:
+                return dispatched
+            lines = (pending + block).split('\n')
+            pending = lines.pop()
+            if firstline and lines:
+                # Header
+                lines.pop(0)
+                firstline = False
+            for line in lines:
+                self.dispatch(line)
+            dispatched += len(lines)
+            if time.time() - self.last_send >= BATCH_INTERVAL:
+                self.flush()
+        return dispatched
+
+    def run(self):
+        backoff = Backoff()
+        while self.running:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            try:
+                sock.connect((self.host, self.port))
+            except socket.error, e:
+                delay = backoff.next()
+                print 'Could not connect to the feed ({}), retrying in {:.0f}s'.format(e, delay)
+                sock.close()
+                time.sleep(delay)
+                continue
+
+            print 'Splitting feed {}:{} over {} partitions'.format(self.host, self.port, len(self.sinks))
+            sock.settimeout(BATCH_INTERVAL)
+            try:
+                # A feed closing connections before sending
+                # anything is retried as slowly as a refused one
+                if self.read(sock):
+                    backoff.reset()
+            except socket.error:
+                pass
+            finally:
+                sock.close()
+                self.flush()
+            if not self.running:
+                return
+            delay = backoff.next()
+            print 'Lost connection to the feed, reconnecting in {:.0f}s'.format(delay)
+            time.sleep(delay)
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+def worker_main(conn, index, partitions, robust=False, archive_dir=None):
+    '''
+    Analyse the lines of one partition until the splitter closes the pipe
+    '''
+    # The splitter shuts workers down by closing their pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Connections inherited from the parent can't be shared, open new ones
+    db.session.close()
+    db.engine.dispose()
+
+    # Every partition appends to its own archive directory
+    archive = None
+    if archive_dir:
+        archive = ArchiveWriter(os.path.join(archive_dir, 'partition-{}'.format(index)))
+    trades_analyser = TradesAnalyser(tradeacc_limit=50, robust=robust, archive=archive)
+    firstday = True
+    day = date.today()
+
+    try:
+        while True:
+            if conn.poll(POLL_TIMEOUT):
+                try:
+                    data = conn.recv_bytes()
+                except EOFError:
+                    break
+                if not data:
+                    break
+                for line in data.split('\n'):
+                    t = Trade(line)
+                    if not t.parse_err:
+                        trades_analyser.add(t, None, firstday, commit=True)
+
+            # Analyse the day once it is over
+            if date.today() != day:
+                trades_analyser.force_commit()
+                trades_analyser.alert_stats(firstday, False)
+                firstday = False
+                day = date.today()
+    finally:
+        trades_analyser.force_commit()
+        conn.close()
+
+
+def run_partitioned(host, port, workers, robust=False, archive_dir=None):
+    '''
+    Split a feed over `workers` local processes
+    '''
+    processes = []
+    sinks = []
+    for index in range(workers):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=worker_main, args=(reader, index, workers, robust, archive_dir)
+        )
+        process.start()
+        reader.close()
+        processes.append(process)
+        sinks.append(PipeSink(writer))
+
+    splitter = FeedSplitter(host, port, sinks)
+    try:
+        splitter.run()
+    finally:
+        splitter.close()
+        for process in processes:
+            process.join()
+    return splitter.lines
+
+
+def run_relay(host, port, relay_port, partitions):
+    '''
+    Split a feed over `partitions` consumers, partition k is
+    served on relay_port + k. Consumers run
+    `main.py -s <this host> -p <relay_port + k>`
+    '''
+    sinks = [RelaySink(relay_port + k) for k in range(partitions)]
+    splitter = FeedSplitter(host, port, sinks)
+    try:
+        splitter.run()
+    finally:
+        splitter.close()
+    return splitter.lines
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+####################################################
+# Synthetic trades and a local feed replaying them #
+####################################################
+
+# generate() writes a CSV in the format of the feed (see finance.Trade),
+# the same for the same seed: symbols of every sector with their own
+# price, spread and trade size, more trades at the open and close than
+# at midday, and injected events whose ground truth is returned:
+#
+#   fat_finger_price   one trade at 10x or 1/10 of the price     (FFP)
+#   fat_finger_volume  one trade 50 to 100 times the usual size  (FFV)
+#   volume_spike       20x the usual trades for ten minutes      (VS)
+#   pump_and_dump      price up 15-30% over 40 minutes, back
+#                      down in 20, with three times the trades   (PDBR)
+#
+# Hourly events only stand out of a few days of trades: the nine hours
+# of a single day can't be three standard deviations from their mean.
+#
+# ReplayServer serves any such CSV on a local port like the live feed,
+# `rate` times faster than the trades happened, for from_stream:
+#
+#   python simulate.py generate trades.csv --trades 200000
+#   python simulate.py serve trades.csv --port 8080 --rate 10
+#   python main.py -s localhost -p 8080
+
+import math
+import time
+import json
+import random
+import socket
+import bisect
+import threading
+from datetime import datetime, date, timedelta
+
+HEADER = 'time,buyer,seller,price,size,currency,symbol,sector,bid,ask\n'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+SECTORS = [
+    'Basic Materials', 'Consumer Goods', 'Consumer Services', 'Energy', 'Financial',
+    'Healthcare', 'Industrials', 'Technology', 'Telecommunications', 'Utilities'
+]
+FIRMS = [
+    'janestreetcap.com', 'citadel.com', 'bridgewater.com', 'vinvest.com', 'rochdaleassets.com',
+    'moma.com', 'jlb.com', 'blackrock.com', 'twosigma.com', 'man.com'
+]
+FIRST_NAMES = 'abcdefghijklmnoprstw'
+LAST_NAMES = [
+    'tuffnell', 'newbury', 'lewis', 'smith', 'williams', 'braxton', 'amstell', 'locke', 'lee',
+    'jones', 'taylor', 'brown', 'davies', 'evans', 'wilson', 'thomas', 'johnson', 'roberts'
+]
+
+# Defaults of generate()
+DATE = date(2017, 3, 8)
+TRADES_PER_DAY = 100000
+SYMBOLS = 100
+EVENTS_PER_DAY = 12
+TRADERS = 200
+
+# Trading session, London time
+OPEN = timedelta(hours=8)
+CLOSE = timedelta(hours=16, minutes=30)
+# Events start an hour after the open at the earliest, and end an hour before the close
+EVENT_MARGIN = timedelta(hours=1)
+# Change of the price between two trades of a symbol (standard deviation)
+VOLATILITY = 0.0005
+
+# Event -> code of the anomaly it should raise
+FAT_FINGER_PRICE = 'fat_finger_price'
+FAT_FINGER_VOLUME = 'fat_finger_volume'
+VOLUME_SPIKE = 'volume_spike'
+PUMP_AND_DUMP = 'pump_and_dump'
+EVENTS = {
+    FAT_FINGER_PRICE: 'FFP',
+    FAT_FINGER_VOLUME: 'FFV',
+    VOLUME_SPIKE: 'VS',
+    PUMP_AND_DUMP: 'PDBR',
+}
+SPIKE_DURATION = timedelta(minutes=10)
+SPIKE_FACTOR = 20
+PUMP_DURATION = timedelta(minutes=60)
+PUMP_FACTOR = 3
+
+# Replayed rows sent at once when they are due together
+SEND_BATCH = 500
+
+
+def volume_curve(x):
+    '''
+    Relative number of trades at x (0 at the open, 1 at the close),
+    four times more at both ends than at midday
+    '''
+    return 1 + 3 * (2 * x - 1) ** 2
+
+
+class Symbol:
+    def __init__(self, name, sector, price, spread, size, weight):
+        self.name = name
+        self.sector = sector
+        self.price = price
+        # bid-ask spread relative to the price
+        self.spread = spread
+        # median trade size
+        self.size = size
+        # share of the trades of the day
+        self.weight = weight
+
+
+def make_symbols(rng, count):
+    '''
+    Symbols of every sector, a few of them traded much more than others
+    '''
+    names = set()
+    symbols = []
+    for rank in range(count):
+        name = None
+        while name is None or name in names:
+            name = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(rng.randint(2, 4))) + '.L'
+        names.add(name)
+        symbols.append(Symbol(
+            name, SECTORS[rank % len(SECTORS)],
+            price=round(rng.uniform(50, 5000), 2),
+            spread=rng.uniform(0.0005, 0.003),
+            size=rng.choice([1000, 2000, 5000, 10000, 15000, 20000]),
+            weight=1.0 / (rank + 1) ** 0.8
+        ))
+    total = sum(s.weight for s in symbols)
+    for symbol in symbols:
+        symbol.weight /= total
+    return symbols
+
+
+def make_traders(rng, count):
+    traders = set()
+    while len(traders) < count:
+        traders.add('{}.{}@{}'.format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), rng.choice(FIRMS)))
+    return sorted(traders)
+
+
+class Generator:
+    '''
+    Trades of consecutive days, see generate()
+    '''
+    def __init__(self, symbols=SYMBOLS, seed=0):
+        self.rng = random.Random(seed)
+        self.symbols = make_symbols(self.rng, symbols)
+        self.traders = make_traders(self.rng, TRADERS)
+        self.cumulative = []
+        total = 0.0
+        for symbol in self.symbols:
+            total += symbol.weight
+            self.cumulative.append(total)
+
+    def pick_symbol(self):
+        return min(bisect.bisect_left(self.cumulative, self.rng.random()), len(self.symbols) - 1)
+
+    def session_time(self, day):
+        '''
+        Time of a trade of the day, following volume_curve
+        '''
+        while True:
+            x = self.rng.random()
+            if self.rng.random() * 4 <= volume_curve(x):
+                break
+        opened = datetime.combine(day, datetime.min.time()) + OPEN
+        return opened + timedelta(seconds=x * (CLOSE - OPEN).total_seconds())
+
+    def expected_trades(self, symbol, trades, duration):
+        return symbol.weight * trades * duration.total_seconds() / (CLOSE - OPEN).total_seconds()
+
+    def plan_events(self, day, trades, count):
+        '''
+        Events of the day and the extra trades they add,
+        as (time, symbol index, event index) rows
+        '''
+        rng = self.rng
+        opened = datetime.combine(day, datetime.min.time()) + OPEN
+        latest = (CLOSE - OPEN - EVENT_MARGIN * 2).total_seconds()
+        kinds = sorted(EVENTS)
+        # Among the most traded half, so each symbol has enough history,
+        # and on different symbols as long as there are enough
+        candidates = rng.sample(range(max(len(self.symbols) // 2, 1)), max(len(self.symbols) // 2, 1))
+        events = []
+        rows = []
+        for i in range(count):
+            kind = kinds[i % len(kinds)]
+            index = candidates[i % len(candidates)]
+            symbol = self.symbols[index]
+            start = opened + EVENT_MARGIN + timedelta(seconds=rng.uniform(0, latest))
+            event = {'event': kind, 'code': EVENTS[kind], 'symbol': symbol.name, 'sector': symbol.sector}
+            if kind in (FAT_FINGER_PRICE, FAT_FINGER_VOLUME):
+                end = start
+                if kind == FAT_FINGER_PRICE:
+                    event['factor'] = rng.choice([10.0, 0.1])
+                else:
+                    event['factor'] = float(rng.randint(50, 100))
+                rows.append((start, index, len(events)))
+            else:
+                duration, factor = (SPIKE_DURATION, SPIKE_FACTOR) if kind == VOLUME_SPIKE else (PUMP_DURATION, PUMP_FACTOR)
+                end = start + duration
+                extra = max(int(self.expected_trades(symbol, trades, duration) * (factor - 1)), 50)
+                for _ in range(extra):
+                    rows.append((start + timedelta(seconds=rng.uniform(0, duration.total_seconds())), index, len(events)))
+                if kind == PUMP_AND_DUMP:
+                    event['rise'] = round(rng.uniform(0.15, 0.3), 3)
+                event['trades'] = extra
+            event['from'] = start.strftime(TIME_FORMAT)
+            event['to'] = end.strftime(TIME_FORMAT)
+            event['lines'] = []
+            events.append(event)
+        return events, rows
+
+    def pump(self, pumps, when):
+        '''
+        Price multiplier at `when` of the pumps and dumps,
+        as (start, rise), of a symbol
+        '''
+        multiplier = 1.0
+        for started, rise in pumps:
+            x = (when - started).total_seconds() / PUMP_DURATION.total_seconds()
+            if 0 <= x <= 1:
+                # Up for two thirds of the time, down in the last
+                multiplier *= 1 + rise * (x / (2.0 / 3) if x < 2.0 / 3 else (1 - x) * 3)
+        return multiplier
+
+    def day(self, f, day, trades=TRADES_PER_DAY, events=EVENTS_PER_DAY, line=2):
+        '''
+        Write the trades of a day, starting at line `line` of the file,
+        returns the events with the lines of their trades and the next line
+        '''
+        rng = self.rng
+        planned, rows = self.plan_events(day, trades, events)
+        rows.extend((self.session_time(day), self.pick_symbol(), None) for _ in range(trades))
+        rows.sort(key=lambda row: row[0])
+        pumps = {}
+        for event in planned:
+            if event['event'] == PUMP_AND_DUMP:
+                started = datetime.strptime(event['from'], TIME_FORMAT)
+                pumps.setdefault(event['symbol'], []).append((started, event['rise']))
+        for when, index, event_index in rows:
+            symbol = self.symbols[index]
+            symbol.price = max(symbol.price * math.exp(rng.gauss(0, VOLATILITY)), 0.01)
+            price = symbol.price
+            if symbol.name in pumps:
+                price *= self.pump(pumps[symbol.name], when)
+            size = max(int(rng.lognormvariate(math.log(symbol.size), 0.4)), 1)
+            if event_index is not None:
+                event = planned[event_index]
+                event['lines'].append(line)
+                if event['event'] == FAT_FINGER_PRICE:
+                    price *= event['factor']
+                elif event['event'] == FAT_FINGER_VOLUME:
+                    size = int(size * event['factor'])
+            spread = price * symbol.spread
+            # Trades happen at the bid or the ask
+            if rng.random() < 0.5:
+                ask = round(price, 2)
+                bid = round(price - spread, 2)
+                price = ask
+            else:
+                bid = round(price, 2)
+                ask = round(price + spread, 2)
+                price = bid
+            buyer, seller = rng.sample(self.traders, 2)
+            f.write('{},{},{},{:.2f},{},GBX,{},{},{:.2f},{:.2f}\n'.format(
+                when.strftime(TIME_FORMAT), buyer, seller, price, size,
+                symbol.name, symbol.sector, bid, ask
+            ))
+            line += 1
+        return planned, line
+
+
+def generate(f, trades=TRADES_PER_DAY, symbols=SYMBOLS, days=1, start=DATE, events=EVENTS_PER_DAY, seed=0):
+    '''
+    Write `days` days of `trades` synthetic trades each (plus those of
+    the events) as CSV to f, returns the injected events: their
+    symbol, [from, to] times and the lines of their trades
+    '''
+    generator = Generator(symbols, seed)
+    f.write(HEADER)
+    line = 2
+    day = start
+    injected = []
+    for _ in range(days):
+        # Weekends have no trades
+        while day.weekday() >= 5:
+            day += timedelta(days=1)
+        day_events, line = generator.day(f, day, trades, events, line)
+        injected.extend(day_events)
+        day += timedelta(days=1)
+    return injected
+
+
+def write_events(path, events):
+    with open(path, 'w') as f:
+        json.dump(events, f, indent=2, sort_keys=True)
+
+
+def read_events(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class ReplayServer(threading.Thread):
+    '''
+    Serves the CSV at `path` like the live feed to every client: the
+    header then every row once its time has come, `rate` times faster
+    than the trades happened (as fast as possible with rate 0). With
+    `retime` rows are sent with the time they are sent at.
+    '''
+    def __init__(self, path, port=0, host='localhost', rate=1.0, loop=False, retime=False):
+        threading.Thread.__init__(self, name='replay')
+        self.daemon = True
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+        self.retime = retime
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.sock.settimeout(0.5)
+        self.port = self.sock.getsockname()[1]
+
+    def run(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            client = threading.Thread(target=self.serve, args=(conn,), name='replay-client')
+            client.daemon = True
+            client.start()
+
+    def serve(self, conn):
+        try:
+            conn.sendall(HEADER)
+            while self.running:
+                self.replay(conn)
+                if not self.loop:
+                    break
+        except socket.error:
+            # The client went away
+            pass
+        finally:
+            conn.close()
+
+    def replay(self, conn):
+        started = time.time()
+        first = None
+        batch = []
+        with open(self.path) as f:
+            f.readline()
+            for row in f:
+                if not self.running:
+                    break
+                if self.rate or self.retime:
+                    stamp, rest = row.split(',', 1)
+                if self.rate:
+                    when = datetime.strptime(stamp, TIME_FORMAT)
+                    if first is None:
+                        first = when
+                    wait = started + (when - first).total_seconds() / self.rate - time.time()
+                    if wait > 0:
+                        if batch:
+                            conn.sendall(''.join(batch))
+                            batch = []
+                        time.sleep(wait)
+                if self.retime:
+                    row = datetime.now().strftime(TIME_FORMAT) + ',' + rest
+                batch.append(row)
+                if len(batch) >= SEND_BATCH:
+                    conn.sendall(''.join(batch))
+                    batch = []
+        if batch:
+            conn.sendall(''.join(batch))
+
+    def stop(self):
+        self.running = False
+        self.sock.close()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+#############################################
+# Latency of trades, from receipt to commit #
+#############################################
+
+# Trades read from a feed or file are stamped with a monotonic receive
+# time, and the time since then is recorded when they are parsed, reach
+# the analysis, are checked for anomalies, alerted and committed:
+#
+#   parse      line parsed into a Trade
+#   queue      TradesAnalyser.add started with it
+#   detection  calculate_anomalies_single_trade done
+#   alert      its alerts are in rethinkdb (trades with anomalies only)
+#   commit     the transaction holding it committed
+#
+# Histograms have log sized buckets, a fixed few KB whatever the number
+# of trades, and give p50/p99/p999 within a few percent. The checkpoints
+# of some trades slower than `slow` seconds are kept as full traces.
+
+import math
+import time
+import ctypes
+import ctypes.util
+from collections import deque
+from datetime import datetime
+
+# Shortest and longest latencies told apart (seconds)
+MIN_LATENCY = 1e-6
+MAX_LATENCY = 100.0
+# Buckets every time latency doubles, each ~4% wide
+BUCKETS_PER_DOUBLING = 16
+# Seconds from receipt to commit making a trade an outlier
+SLOW_TRADE = 1.0
+# Seconds between two sampled traces, and traces kept
+TRACE_INTERVAL = 1.0
+MAX_TRACES = 20
+# Checkpoints of a trade, in order
+STAGES = ('parse', 'queue', 'detection', 'alert', 'commit')
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock():
+    # Python 2 has no time.monotonic, call clock_gettime directly
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        # A struct per call, the GIL is released during it
+        spec = _timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    return monotonic
+
+# Seconds never going backwards, even when the wall clock is set
+monotonic = _clock()
+
+
+class LatencyHistogram:
+    '''
+    Counts of latencies in buckets growing by 2 ** (1 / BUCKETS_PER_DOUBLING)
+    '''
+    def __init__(self):
+        self.size = int(math.ceil(math.log(MAX_LATENCY / MIN_LATENCY, 2) * BUCKETS_PER_DOUBLING)) + 1
+        # bucket i holds latencies up to MIN_LATENCY * 2 ** (i / BUCKETS_PER_DOUBLING)
+        self.counts = [0] * self.size
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= MIN_LATENCY:
+            index = 0
+        else:
+            index = min(int(math.ceil(math.log(seconds / MIN_LATENCY, 2) * BUCKETS_PER_DOUBLING)), self.size - 1)
+        self.counts[index] += 1
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket holding the q-quantile
+        '''
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(q * self.count)), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(MIN_LATENCY * 2 ** (float(index) / BUCKETS_PER_DOUBLING), self.max)
+        return self.max
+
+    def metrics(self):
+        return {
+            'items': self.count,
+            'p50_ms': self.quantile(0.5) * 1000,
+            'p99_ms': self.quantile(0.99) * 1000,
+            'p999_ms': self.quantile(0.999) * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+class Tracer:
+    '''
+    Latency histograms per stage of a task, and sampled
+    traces of trades slower than `slow` seconds
+    '''
+    def __init__(self, slow=SLOW_TRADE, interval=TRACE_INTERVAL, max_traces=MAX_TRACES):
+        self.slow = slow
+        self.interval = interval
+        self.histograms = dict((stage, LatencyHistogram()) for stage in STAGES)
+        self.traces = deque(maxlen=max_traces)
+        self.slow_count = 0
+        self.sampled_at = None
+
+    def finish(self, checkpoints, trade_pk=None, symbol=None):
+        '''
+        Record every checkpoint (stage -> monotonic time, 'received' included)
+        of a committed trade, and keep its trace if it was slow
+        '''
+        received = checkpoints['received']
+        for stage in STAGES:
+            at = checkpoints.get(stage)
+            if at is not None:
+                self.histograms[stage].record(at - received)
+        latency = checkpoints['commit'] - received
+        if latency < self.slow:
+            return
+        self.slow_count += 1
+        if self.sampled_at is not None and checkpoints['commit'] - self.sampled_at < self.interval:
+            return
+        self.sampled_at = checkpoints['commit']
+        self.traces.append({
+            'trade_pk': trade_pk,
+            'symbol': symbol,
+            'datetime': datetime.now().isoformat(),
+            # ms since receipt at every checkpoint
+            'stages': dict(
+                (stage, (checkpoints[stage] - received) * 1000)
+                for stage in STAGES if checkpoints.get(stage) is not None
+            )
+        })
+
+    def summary(self):
+        '''
+        Table of the latency from receipt at every checkpoint
+        '''
+        lines = ['{:<12} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('latency', 'items', 'p50 ms', 'p99 ms', 'p999 ms', 'max ms')]
+        for stage in STAGES:
+            histogram = self.histograms[stage]
+            if histogram.count:
+                lines.append('{:<12} {:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                    stage, histogram.count, histogram.quantile(0.5) * 1000, histogram.quantile(0.99) * 1000,
+                    histogram.quantile(0.999) * 1000, histogram.max * 1000
+                ))
+        return '\n'.join(lines)
+
+    def metrics(self):
+        return {
+            'stages': dict(
+                (stage, histogram.metrics()) for stage, histogram in self.histograms.items() if histogram.count
+            ),
+            'slow_trades': self.slow_count,
+            'slow_traces': list(self.traces)
+        }
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Synthetic trades and a local feed, to load test without the real one
+#
+#   python simulate.py generate trades.csv --trades 200000 --seed 1
+#   python simulate.py serve trades.csv --port 8080 --rate 10
+#   python main.py -s localhost -p 8080
+
+import sys
+import time
+import argparse
+from datetime import datetime
+
+from purple import synthetic
+
+
+def generate(args):
+    start = datetime.strptime(args.date, '%Y-%m-%d').date()
+    with open(args.csv, 'w') as f:
+        events = synthetic.generate(
+            f, trades=args.trades, symbols=args.symbols, days=args.days,
+            start=start, events=args.events, seed=args.seed
+        )
+    path = args.events_out or args.csv + '.events.json'
+    synthetic.write_events(path, events)
+    print 'Wrote {} with {} events, ground truth in {}'.format(args.csv, len(events), path)
+
+
+def serve(args):
+    server = synthetic.ReplayServer(
+        args.csv, port=args.port, host=args.host, rate=args.rate, loop=args.loop, retime=args.retime
+    )
+    server.start()
+    print 'Replaying {} on {}:{} at {}x (Ctrl-C to stop)'.format(
+        args.csv, args.host, server.port, args.rate or 'full speed '
+    )
+    try:
+        while server.is_alive():
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic trades and a local feed replaying them')
+    commands = parser.add_subparsers()
+
+    generate_parser = commands.add_parser('generate', help='Write synthetic trades as CSV')
+    generate_parser.add_argument('csv', help='File to write')
+    generate_parser.add_argument(
+        '--trades', type=int, default=synthetic.TRADES_PER_DAY,
+        help='Trades per day, besides those of events. (default: {})'.format(synthetic.TRADES_PER_DAY)
+    )
+    generate_parser.add_argument(
+        '--symbols', type=int, default=synthetic.SYMBOLS,
+        help='(default: {})'.format(synthetic.SYMBOLS)
+    )
+    generate_parser.add_argument('--days', type=int, default=1, help='Week days of trades. (default: 1)')
+    generate_parser.add_argument(
+        '--date', default=synthetic.DATE.isoformat(),
+        help='First day. (default: {})'.format(synthetic.DATE.isoformat())
+    )
+    generate_parser.add_argument(
+        '--events', type=int, default=synthetic.EVENTS_PER_DAY,
+        help='Fat fingers, volume spikes and pump and dumps injected per day.\
+        (default: {})'.format(synthetic.EVENTS_PER_DAY)
+    )
+    generate_parser.add_argument('--seed', type=int, default=0, help='Same seed, same file. (default: 0)')
+    generate_parser.add_argument(
+        '--events-out', metavar='FILE',
+        help='Where the injected events are written. (default: CSV.events.json)'
+    )
+    generate_parser.set_defaults(command=generate)
+
+    serve_parser = commands.add_parser('serve', help='Replay a CSV like the live feed')
+    serve_parser.add_argument('csv', help='Trades to replay')
+    serve_parser.add_argument('--port', type=int, default=8080, help='(default: 8080)')
+    serve_parser.add_argument('--host', default='localhost', help='(default: localhost)')
+    serve_parser.add_argument(
+        '--rate', type=float, default=1.0,
+        help='Times faster than the trades happened, 0 for as fast as\
+        possible. (default: 1)'
+    )
+    serve_parser.add_argument('--loop', action='store_true', help='Start again at the end of the file')
+    serve_parser.add_argument(
+        '--retime', action='store_true',
+        help='Send trades with the time they are sent at instead of theirs'
+    )
+    serve_parser.set_defaults(command=serve)
+
+    args = parser.parse_args()
+    args.command(args)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 
 from purple.finance import Trade
 from purple.analysis import TradesAnalyser
+from purple import db
 import pytest
 
 
@@ -16,6 +17,41 @@ def test_add():
 
 	assert trades_analyser.trades_objs[0]["price"] == t.price
 
+def stored_offset(csv_hash):
+	imports = db.ImportModel.__table__
+	return db.engine.execute(imports.select().where(imports.c.csv_hash == csv_hash)).fetchone()['offset']
+
+def test_import_checkpoint():
+	record = db.ImportModel.get_or_create('checkpoint-test')
+	trades_analyser = TradesAnalyser(tradeacc_limit=1000)
+	trades_analyser.import_record = record
+	try:
+		trades_analyser.read_offset = 100
+		trades_analyser.add(t, 'checkpoint-test', True, commit=True)
+		# A new symbol is committed straight away, but not the checkpoint
+		# past the trades still waiting to be saved
+		trades_analyser.read_offset = 200
+		trades_analyser.add(Trade(TRADE_ROW1.replace('AV.L', 'CHECKPOINT.L')), 'checkpoint-test', True, commit=True)
+		assert stored_offset('checkpoint-test') == 0
+		trades_analyser.save_load()
+		assert record.offset == 200
+	finally:
+		db.session.rollback()
+		db.session.query(db.ImportModel).filter_by(csv_hash='checkpoint-test').delete()
+		db.session.query(db.SymbolModel).filter_by(name='CHECKPOINT.L').delete()
+		db.session.commit()
+
+def test_reserved_ids():
+	# Analysers running at the same time never use the same ids
+	first = TradesAnalyser(tradeacc_limit=1000)
+	second = TradesAnalyser(tradeacc_limit=1000)
+	for trades_analyser in (first, second, first):
+		trades_analyser.add(t,"a",True)
+	first_ids = [trade["id"] for trade in first.trades_objs]
+	second_ids = [trade["id"] for trade in second.trades_objs]
+	assert first_ids[1] > first_ids[0]
+	assert not set(first_ids) & set(second_ids)
+
 ######################################################################
 #                            Manual Testing                          #
 ######################################################################
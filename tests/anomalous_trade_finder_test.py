@@ -2,7 +2,7 @@
 
 import pytest
 from purple.finance import Trade
-from purple.anomalous_trade_finder import AnomalousTradeFinder
+from purple.anomalous_trade_finder import AnomalousTradeFinder, ROBUST_REFRESH
 from numpy import std, mean
 from datetime import datetime
 
@@ -103,6 +103,69 @@ def test_calculate_anomalies_single_trade():
 	assert round(test_finder.stats['AV.L']['vol_stdev'],3) == round(std([15952,10000,12000]),3)
 
 
+def test_robust_sketches():
+	test_finder = AnomalousTradeFinder(robust=True)
+	test_finder.add(t,1)
+	test_finder.add(t1,2)
+	test_finder.add(t2,3)
+	assert test_finder.sketches['AV.L']['volume'].count == 3
+	assert test_finder.sketches['AV.L']['volume'].median() == 12000
+
+def test_merge_sketches():
+	first = AnomalousTradeFinder(robust=True)
+	second = AnomalousTradeFinder(robust=True)
+	first.add(t,1)
+	second.add(t1,2)
+	first.merge_sketches(second)
+	assert first.sketches['AV.L']['price_delta'].count == 2
+
+def test_robust_bounds_cached():
+	test_finder = AnomalousTradeFinder(robust=True)
+	for i in range(3):
+		test_finder.add(t, i)
+	centre, _ = test_finder._robust_bounds('AV.L', 'volume', 1)
+	# A few more values don't move the bounds until ROBUST_REFRESH are added
+	test_finder.add(t1, 3)
+	assert test_finder._robust_bounds('AV.L', 'volume', 1)[0] == centre
+	for i in range(ROBUST_REFRESH):
+		test_finder.add(t1, 4 + i)
+	assert test_finder._robust_bounds('AV.L', 'volume', 1)[0] == t1.size
+
+def test_robust_first_day_keeps_no_history():
+	test_finder = AnomalousTradeFinder(robust=True, persist=False)
+	late = Trade(TRADE_ROW2.replace('15:26:54', '16:00:01'))
+	for i, trade in enumerate([t, t1, t2, late]):
+		test_finder.add(trade, i)
+	assert test_finder.trade_history == {}
+	test_finder.calculate_anomalies_first_day(True)
+	# Same statistics as when the trades are kept
+	assert test_finder.stats['AV.L']['vol_mean'] == mean([15952, 10000, 12000, 12000])
+	assert round(test_finder.stats['AV.L']['delta_stdev'], 6) == round(std([0, 3.79, 0.59, 0]), 6)
+	assert test_finder.stats['AV.L']['hourly_vol'] == [37952, 0]
+	assert test_finder.first_day == {}
+
+def test_anomaly_window():
+	test_finder = AnomalousTradeFinder()
+	start = datetime(2017, 1, 13, 15)
+	test_finder.stats['AV.L'] = {'hour_starts': [start]}
+	window = test_finder._hour_window('AV.L', 0)
+	assert window == (start, datetime(2017, 1, 13, 16))
+	assert test_finder._hour_window('AV.L', 1) is None
+
+	test_finder.add_anomaly(-1, 1, 'Hourly volume spike', 'VS', 1, 'AV.L', window)
+	test_finder.add_anomaly(2, t1.time, 'Fat finger', 'FFP', 1, 'AV.L')
+	assert test_finder.anomalous_trades[0]['from'] == start
+	assert 'from' not in test_finder.anomalous_trades[1]
+
+def test_last_trade_starts_an_hour():
+	test_finder = AnomalousTradeFinder(persist=False)
+	late = Trade(TRADE_ROW2.replace('15:26:54', '16:00:01'))
+	for i, trade in enumerate([t, t1, t2, late]):
+		test_finder.add(trade, i)
+	test_finder.calculate_anomalies_first_day(True)
+	assert len(test_finder.stats['AV.L']['hourly_vol']) == 2
+
+
 ######################################################################
 #                            Manual Testing                          #
 ######################################################################
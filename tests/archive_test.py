@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import pytest
+import pytz
+from datetime import datetime, timedelta
+from purple.finance import Trade
+from purple.archive import ArchiveWriter, ArchiveReader, encode_block, decode_block
+
+tz = pytz.timezone('Europe/London')
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+t = Trade(TRADE_ROW)
+
+@pytest.fixture
+def root():
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path)
+
+def test_block_round_trip():
+    trades = decode_block(encode_block([t]), 'AV.L')
+    assert len(trades) == 1
+    assert trades[0].time == t.time
+    assert trades[0].price == t.price
+    assert trades[0].size == t.size
+    assert trades[0].buyer == t.buyer
+    assert trades[0].sector == t.sector
+
+def test_read_range(root, make_trade):
+    writer = ArchiveWriter(root, block_rows=10)
+    for minute in range(100):
+        writer.add(make_trade('AV.L', 100.0 + minute, minute))
+        writer.add(make_trade('ANTO.L', 100.0 + minute, minute))
+    writer.close()
+
+    reader = ArchiveReader(root)
+    assert reader.days() == ['2017-03-08']
+    start = make_trade(minutes=20).time
+    end = make_trade(minutes=30).time
+    trades = list(reader.read(start, end, symbols=['AV.L']))
+    assert [x.price for x in trades] == [100.0 + m for m in range(20, 30)]
+
+def test_read_across_days(root, make_trade):
+    writer = ArchiveWriter(root)
+    for minute in range(0, 3000, 60):
+        writer.add(make_trade('AV.L', 100.0 + minute, minute))
+    writer.close()
+    start = make_trade().time
+    trades = list(ArchiveReader(root).read(start, start + timedelta(days=3)))
+    assert len(trades) == 50
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import pytz
+from datetime import datetime
+from purple.finance import local_time
+from purple.backtest import plan_jobs, alert_docs
+
+def test_plan_jobs():
+    pairs = [('2017-03-09', 'AV.L'), ('2017-03-08', 'BP.L'), ('2017-03-08', 'AV.L'), ('2017-03-08', 'AV.L')]
+    jobs = plan_jobs(pairs, robust=True)
+    # Every symbol of a day is analysed by exactly one job
+    assert jobs == [
+        ('2017-03-08', 'AV.L', True),
+        ('2017-03-08', 'BP.L', True),
+        ('2017-03-09', 'AV.L', True)
+    ]
+    assert plan_jobs([]) == []
+
+def test_alert_docs(make_trade):
+    trade = make_trade()
+    anomalies = [
+        {'id': 10, 'time': trade.time, 'description': 'Fat finger error on price for AV.L',
+         'error_code': 'FFP', 'severity': 1, 'symbol': 'AV.L'},
+        {'id': -1, 'time': 3, 'description': 'Hourly volume spike from 3 to 4 for AV.L',
+         'error_code': 'VS', 'severity': 2, 'symbol': 'AV.L'}
+    ]
+    docs = alert_docs('run-1', '2017-03-08', anomalies)
+    assert [(d['run'], d['day'], d['trade_pk']) for d in docs] == [('run-1', '2017-03-08', 10), ('run-1', '2017-03-08', -1)]
+    assert not any(d['reviewed'] for d in docs)
+
+def test_local_time():
+    # trades.datetime holds naive London times
+    naive = datetime(2017, 7, 3, 9, 30)
+    assert local_time(naive).utcoffset().total_seconds() == 3600
+    assert local_time(naive).replace(tzinfo=None) == naive
+    # Aware values are converted instead of raising in localize
+    aware = pytz.utc.localize(datetime(2017, 7, 3, 8, 30))
+    assert local_time(aware) == aware
+    assert local_time(aware).hour == 9
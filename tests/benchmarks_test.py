@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+from run import regressions
+from cases import CASES
+
+BASELINE = {
+    'trades': 1000,
+    'results': {
+        'parse': {'rows_per_second': 1000.0, 'peak_rss_mb': 100.0},
+        'startup:help': {'median_ms': 40.0, 'budget_ms': 150.0},
+    }
+}
+
+def test_regressions():
+    results = {
+        'parse': {'rows_per_second': 850.0, 'peak_rss_mb': 110.0},
+        'startup:help': {'median_ms': 45.0, 'budget_ms': 150.0},
+    }
+    assert regressions(results, BASELINE, 1000, 0.2) == []
+
+    results['parse'] = {'rows_per_second': 700.0, 'peak_rss_mb': 130.0}
+    results['startup:help'] = {'median_ms': 160.0, 'budget_ms': 150.0}
+    found = regressions(results, BASELINE, 1000, 0.2)
+    assert len(found) == 4
+    # Runs over another number of trades only compare start times
+    assert len(regressions(results, BASELINE, 5000, 0.2)) == 2
+
+def test_cases():
+    # Cases writing to the dbs are marked so they can be skipped
+    assert set(name for name, (_, db) in CASES.items() if db) == set(['analyser_add', 'batch_writes'])
+    assert set(['parse', 'first_day', 'single_trade', 'predict']) <= set(CASES)
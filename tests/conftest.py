@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+import pytz
+from datetime import datetime, timedelta
+from purple.finance import Trade
+
+tz = pytz.timezone('Europe/London')
+# Time of the trades made at minute 0
+START = tz.localize(datetime(2017, 3, 8, 9, 0, 0))
+
+@pytest.fixture
+def make_trade():
+    '''
+    Builds trades from values, `minutes` after START
+    '''
+    def make(symbol='AV.L', price=470.0, minutes=0, size=1000, sector='Financial'):
+        return Trade.from_values(START + timedelta(minutes=minutes), price, size, symbol, price - 1, price + 1,
+                                 buyer='a@b.com', seller='c@d.com', currency='GBX', sector=sector)
+    return make
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from purple.counterparties import CountMinSketch, TraderIndex, WashTradeFinder, pair_key
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(width=256, depth=4)
+    for key in range(1000):
+        sketch.add(key, 2)
+    sketch.add(7, 100)
+    assert sketch.estimate(7) >= 102
+    assert sketch.estimate(pair_key(1, 2)) >= 0
+
+def test_self_trade(make_trade):
+    finder = WashTradeFinder()
+    anomalies = finder.add(make_trade(), 1, 1, 10)
+    assert [a['error_code'] for a in anomalies] == ['WT']
+
+def test_missing_counterparties(make_trade):
+    index = TraderIndex()
+    assert index.get_id('') is None
+    assert index.get_id(None) is None
+    index.add(None, None, 1000)
+    assert index.ids == {}
+    finder = WashTradeFinder()
+    assert finder.add(make_trade(), None, None, 10) == []
+    assert finder.sold == {}
+
+def test_round_trip(make_trade):
+    finder = WashTradeFinder()
+    # 1 sells to 2, then 2 sells the same amount back to 1
+    assert finder.add(make_trade(), 2, 1, 10) == []
+    anomalies = finder.add(make_trade(minutes=1, size=1050), 1, 2, 11)
+    assert [a['error_code'] for a in anomalies] == ['WT']
+    assert anomalies[0]['id'] == 11
+
+def test_round_trip_outside_window(make_trade):
+    finder = WashTradeFinder(window=60)
+    finder.add(make_trade(), 2, 1, 10)
+    assert finder.add(make_trade(minutes=2), 1, 2, 11) == []
+
+def test_circular_trading(make_trade):
+    finder = WashTradeFinder()
+    # 1 -> 2 -> 3 -> 1
+    finder.add(make_trade(), 2, 1, 10)
+    finder.add(make_trade(minutes=1), 3, 2, 11)
+    anomalies = finder.add(make_trade(minutes=2), 1, 3, 12)
+    assert [a['error_code'] for a in anomalies] == ['CT']
+
+def test_other_symbol_not_linked(make_trade):
+    finder = WashTradeFinder()
+    finder.add(make_trade('ANTO.L'), 2, 1, 10)
+    assert finder.add(make_trade(minutes=1), 1, 2, 11) == []
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+import argparse
+import threading
+import pytest
+from purple.daemon import AnalysisDaemon
+
+def send(port, request):
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.sendall(request + '\n')
+    response = conn.makefile().readline()
+    conn.close()
+    return json.loads(response)
+
+@pytest.fixture
+def daemon():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only-flag', action='store_true')
+    daemon = AnalysisDaemon(parser, port=0)
+    thread = threading.Thread(target=daemon.serve)
+    thread.daemon = True
+    thread.start()
+    yield daemon
+    daemon.stop()
+    thread.join(5)
+    daemon.server.close()
+
+def test_bad_request(daemon):
+    assert send(daemon.port, 'not json') == {'success': False, 'error': 'Bad request'}
+
+def test_wait_for_job(daemon):
+    # The job fails parsing its arguments, the child exits with argparse's code
+    response = send(daemon.port, json.dumps({'args': ['--unknown'], 'wait': True}))
+    assert response['success']
+    assert response['code'] == 2
+    assert daemon.jobs == 1
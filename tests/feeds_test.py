@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+import pytest
+from purple.feeds import Feed, FeedMultiplexer, Backoff, parse_feed
+from purple.pipeline import OverflowQueue, Stage
+
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+
+def serve(lines):
+    # Feed on a free local port sending the given lines once
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def run():
+        conn, _ = server.accept()
+        conn.sendall('\n'.join(lines) + '\n')
+        conn.close()
+        server.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return server.getsockname()[1]
+
+def test_parse_feed():
+    assert parse_feed('cs261.dcs.warwick.ac.uk:8080') == ('cs261.dcs.warwick.ac.uk', 8080)
+    assert parse_feed('cs261.dcs.warwick.ac.uk') == ('cs261.dcs.warwick.ac.uk', 80)
+
+def test_many_feeds():
+    ports = [serve(['header', TRADE_ROW, TRADE_ROW]), serve(['header', TRADE_ROW, 'broken'])]
+    feeds = [Feed('127.0.0.1', port) for port in ports]
+    received = []
+
+    def on_trade(t, feed):
+        received.append((feed.port, t.symbol))
+
+    def on_tick(now):
+        if len(received) == 3 or now - started > 5:
+            multiplexer.stop()
+
+    multiplexer = FeedMultiplexer(feeds, on_trade, on_tick)
+    started = time.time()
+    multiplexer.run()
+
+    assert sorted(received) == sorted([(ports[0], 'AV.L'), (ports[0], 'AV.L'), (ports[1], 'AV.L')])
+    metrics = multiplexer.metrics()
+    assert [m['trades'] for m in metrics] == [2, 1]
+    assert [m['parse_errors'] for m in metrics] == [0, 1]
+
+def test_slow_analysis_does_not_block_reads():
+    # Trades are queued for a slow consumer instead of analysed in the select loop
+    port = serve(['header'] + [TRADE_ROW] * 100)
+    trades = OverflowQueue(1000)
+    analysis = Stage('analysis', trades, lambda t: time.sleep(0.02))
+
+    def on_tick(now):
+        if trades.puts == 100 or now - started > 5:
+            multiplexer.stop()
+
+    multiplexer = FeedMultiplexer([Feed('127.0.0.1', port)], lambda t, feed: trades.put(t), on_tick)
+    analysis.start()
+    started = time.time()
+    multiplexer.run()
+    analysis.stop()
+    trades.close()
+    assert trades.puts == 100
+    # Reading took less than the 2s the analysis needs
+    assert time.time() - started < 1.9
+
+def test_backoff():
+    backoff = Backoff(base=1.0, cap=8.0, jitter=0.5)
+    delays = [backoff.next() for _ in range(6)]
+    # Doubling, capped, and never below half of the full delay
+    for delay, full in zip(delays, [1, 2, 4, 8, 8, 8]):
+        assert full * 0.5 <= delay <= full
+    backoff.reset()
+    assert backoff.next() <= 1.0
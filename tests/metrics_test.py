@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import urllib2
+from purple.metrics import Registry, serve_metrics, write_metrics
+
+def test_render():
+    registry = Registry()
+    trades = registry.counter('trades_total', 'Trades.')
+    anomalies = registry.counter('anomalies_total', 'Anomalies.', ['code', 'severity'])
+    commit = registry.histogram('commit_seconds', 'Commits.', buckets=(0.01, 0.1))
+    trades.inc()
+    trades.inc(2)
+    anomalies.inc(code='FFP', severity=2)
+    commit.observe(0.005)
+    commit.observe(0.05)
+    commit.observe(3)
+    lines = registry.render().split('\n')
+    assert '# TYPE trades_total counter' in lines
+    assert 'trades_total 3.0' in lines
+    assert 'anomalies_total{code="FFP",severity="2"} 1.0' in lines
+    # Buckets are cumulative
+    assert 'commit_seconds_bucket{le="0.01"} 1' in lines
+    assert 'commit_seconds_bucket{le="0.1"} 2' in lines
+    assert 'commit_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'commit_seconds_count 3' in lines
+
+def test_collect_hooks():
+    registry = Registry()
+    depth = registry.gauge('queue_depth', 'Depth.', ['queue'])
+    hook = lambda: depth.set(7, queue='lines')
+    registry.on_collect(hook)
+    assert 'queue_depth{queue="lines"} 7.0' in registry.render()
+    registry.remove_hook(hook)
+    depth.set(0, queue='lines')
+    assert 'queue_depth{queue="lines"} 0.0' in registry.render()
+
+def test_expose(tmpdir):
+    registry = Registry()
+    registry.counter('trades_total', 'Trades.').inc()
+    path = str(tmpdir.join('purple.prom'))
+    write_metrics(path, registry)
+    assert 'trades_total 1.0' in open(path).read()
+    server = serve_metrics(0, 'localhost', registry)
+    try:
+        response = urllib2.urlopen('http://localhost:{}/metrics'.format(server.server_port))
+        assert response.info()['Content-Type'].startswith('text/plain')
+        assert 'trades_total 1.0' in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import pytest
+from purple.pipeline import OverflowQueue, Stage, StreamReader, BLOCK, SHED, SPILL
+
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+
+def test_shed():
+    queue = OverflowQueue(2, policy=SHED)
+    assert [queue.put(str(i)) for i in range(4)] == [True, True, False, False]
+    assert queue.get(0) == '0'
+    assert queue.get(0) == '1'
+    assert queue.get(0) is None
+    assert queue.metrics()['shed'] == 2
+
+def test_spill_keeps_order():
+    queue = OverflowQueue(3, policy=SPILL)
+    for i in range(10):
+        queue.put(str(i))
+    metrics = queue.metrics()
+    assert metrics['in_memory'] == 3 and metrics['on_disk'] == 7
+
+    received = [queue.get(0) for _ in range(5)]
+    # Items put after the spill drained part way still come after it
+    queue.put('10')
+    while queue.depth():
+        received.append(queue.get(0))
+    assert received == [str(i) for i in range(11)]
+    queue.close()
+
+def test_spill_keeps_receive_times():
+    queue = OverflowQueue(1, policy=SPILL)
+    queue.put((1.5, 'a,b'))
+    queue.put((2.25, 'c,d'))
+    assert queue.metrics()['on_disk'] == 1
+    assert [queue.get(0), queue.get(0)] == [(1.5, 'a,b'), (2.25, 'c,d')]
+    queue.close()
+
+def test_block_waits():
+    queue = OverflowQueue(1, policy=BLOCK)
+    queue.put('a')
+    thread = threading.Thread(target=queue.put, args=('b',))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    assert queue.get(0) == 'a'
+    thread.join(2)
+    assert queue.get(0) == 'b'
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OverflowQueue(1, policy='drop')
+
+def test_stage():
+    inbox, outbox = OverflowQueue(10), OverflowQueue(10)
+    stage = Stage('double', inbox, lambda x: x * 2 if x != 'skip' else None, outbox)
+    inbox.put('a')
+    inbox.put('skip')
+    assert stage.step(0) and stage.step(0)
+    assert not stage.step(0)
+    assert outbox.get(0) == 'aa'
+    assert outbox.depth() == 0
+    assert stage.metrics()['items'] == 2
+
+def test_stream_reader():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    def serve():
+        conn, _ = server.accept()
+        conn.sendall('header\n' + TRADE_ROW + '\n' + TRADE_ROW)
+        conn.sendall('\n')
+        conn.close()
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    lines = OverflowQueue(10)
+    reader = StreamReader('127.0.0.1', port, lines, sock=socket.create_connection(('127.0.0.1', port)))
+    reader.start()
+    received, line = lines.get(5)
+    assert line == TRADE_ROW
+    assert lines.get(5)[1] == TRADE_ROW
+    reader.stop()
+    assert reader.metrics()['lines'] == 2
+
+def test_stream_reader_stop():
+    ours, theirs = socket.socketpair()
+    ours.settimeout(0.1)
+    lines = OverflowQueue(10)
+    reader = StreamReader('127.0.0.1', 0, lines, sock=ours)
+    reader.start()
+    # Once a line is read the reader waits for the next one
+    theirs.sendall('header\n' + TRADE_ROW + '\n')
+    assert lines.get(5)[1] == TRADE_ROW
+    reader.stop()
+    reader.join(5)
+    # Stopping isn't counted as the feed going down
+    assert not reader.is_alive()
+    assert reader.metrics()['reconnects'] == 0
+    theirs.close()
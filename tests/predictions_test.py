@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from datetime import timedelta
+from purple.finance import Trade
+from predictions import predict, fit_window, to_timestamp, Predictor, DISTANCE
+
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+TRADE_ROW1 = '2017-01-13 15:26:51.272423,j.lewis@jlb.com,h.smith@bank.com,473.53,10000,GBX,AV.L,Financial,472.68,473.53'
+TRADE_ROW2 = '2017-01-13 15:26:54.258723,m.williams@fake.com,q.fake@fake.biz,474.12,12000,GBX,AV.L,Financial,473.98,474.12'
+trades = [Trade(TRADE_ROW), Trade(TRADE_ROW1), Trade(TRADE_ROW2)]
+
+def test_fit_window_line():
+    # prices exactly on a line: gradient 2, no deviation from it
+    m, c, stdev, gap = fit_window([0, 1, 2, 3], [1, 3, 5, 7])
+    assert round(m, 6) == 2
+    assert round(c, 6) == 1
+    assert gap == 0.75
+
+def test_predict_lines():
+    lines = predict(trades)
+    assert len(lines) == 8
+    assert len(lines[0]) == 2
+    assert all(len(line) == DISTANCE + 1 for line in lines[1:])
+
+def test_predictor_matches_batch():
+    predictor = Predictor()
+    for i, trade in enumerate(trades):
+        predictor.add(trade, i)
+    incremental = predictor.predict('AV.L')
+    batch = predict(trades)
+    for line, other in zip(incremental, batch):
+        for point, other_point in zip(line, other):
+            assert point[0] == other_point[0]
+            assert round(point[1], 6) == round(other_point[1], 6)
+
+def test_predictor_cache():
+    predictor = Predictor()
+    predictor.add(trades[0], 1)
+    assert predictor.predict('AV.L') is None
+    predictor.add(trades[1], 2)
+    first = predictor.predict('AV.L')
+    assert predictor.predict('AV.L') is first
+    predictor.add(trades[2], 3)
+    assert predictor.predict('AV.L') is not first
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import pstats
+import pytest
+from purple.profiling import StageTimers, profiled, SAMPLING, CPROFILE
+
+def busy():
+    total = 0
+    for i in xrange(2000000):
+        total += i * i
+    return total
+
+def test_stage_timers():
+    timers = StageTimers()
+    timers.record('add', 0.002)
+    timers.record('add', 0.004)
+    timers.record('commit', 0.1)
+    metrics = timers.metrics()
+    assert metrics['add']['items'] == 2
+    assert metrics['commit']['max_ms'] == 100
+    # Most time spent first
+    assert timers.summary().split('\n')[1].startswith('commit')
+
+@pytest.mark.parametrize('kind', [CPROFILE, SAMPLING])
+def test_profiled(tmpdir, kind):
+    path = str(tmpdir.join('busy.prof'))
+    assert profiled(kind, path, busy) == busy()
+    stats = pstats.Stats(path)
+    assert any(name == 'busy' for (_, _, name) in stats.stats)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+import pytest
+from purple.realtime import OutageLog
+
+class FakeNotifications:
+    def __init__(self):
+        self.added = []
+        self.updated = []
+
+    def add(self, **kwargs):
+        self.added.append(kwargs)
+        return 'notification'
+
+    def update(self, pk, **kwargs):
+        self.updated.append((pk, kwargs))
+
+class FakeTasks:
+    def __init__(self):
+        self.updates = []
+
+    def update(self, pk, **kwargs):
+        self.updates.append((pk, kwargs))
+
+def test_outages_share_one_notification():
+    notifications = FakeNotifications()
+    tasks = FakeTasks()
+    outages = OutageLog('task', notifications, tasks)
+
+    for _ in range(3):
+        outages.begin(rate=2.0)
+        assert outages.down
+        outages.attempt()
+        outages.start -= timedelta(seconds=10)
+        outage = outages.end()
+        assert not outages.down
+
+    assert len(notifications.added) == 1
+    # Every later outage and every reconnection edits the same notification
+    assert len(notifications.updated) == 5
+    assert all(pk == 'notification' for pk, _ in notifications.updated)
+    assert notifications.updated[-1][1]['title'] == 'Feed reconnected'
+
+    assert outage['attempts'] == 1
+    assert outage['missed_trades'] == 20
+    pk, update = tasks.updates[-1]
+    assert pk == 'task'
+    assert len(update['outages']) == 3
+
+def test_quiet_outage():
+    notifications = FakeNotifications()
+    outages = OutageLog(None, notifications, FakeTasks())
+    outages.begin(rate=0, notify=False)
+    outages.end()
+    assert notifications.added == [] and notifications.updated == []
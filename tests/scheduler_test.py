@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from purple.scheduler import JobScheduler, job_type
+
+class FakeTasks:
+    def __init__(self):
+        self.tasks = {}
+
+    def queue(self, **kwargs):
+        pk = 'task{}'.format(len(self.tasks))
+        self.tasks[pk] = dict(kwargs, state='queued', terminated=False)
+        return pk
+
+    def get(self, pk):
+        return self.tasks.get(pk)
+
+    def end(self, pk, state='finished'):
+        self.tasks[pk].update(state=state, terminated=True)
+
+class Launcher:
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, argv):
+        self.started.append(argv)
+        return 100 + len(self.started)
+
+def test_job_type():
+    assert job_type(['-f', 'trades.csv']) == 'file'
+    assert job_type(['-s', 'cs261.dcs.warwick.ac.uk', '-p', '80']) == 'stream'
+    assert job_type(['--backtest', '2017-01-01', '2017-01-31']) == 'backtest'
+    assert job_type(['--reset-db', '--init-db']) is None
+
+def test_streams_first():
+    tasks = FakeTasks()
+    launch = Launcher()
+    scheduler = JobScheduler(launch, max_running=1, task_manager=tasks)
+
+    first = scheduler.submit(['-f', 'a.csv'])
+    second = scheduler.submit(['-f', 'b.csv'])
+    stream = scheduler.submit(['-s', 'host'])
+    assert first['pid'] == 101
+    assert second['pid'] is None and stream['pid'] is None
+    assert launch.started == [['-f', 'a.csv', '--task-id', first['task']]]
+
+    # The stream was submitted last but starts before the other file
+    scheduler.done(101, 0)
+    assert launch.started[-1][:2] == ['-s', 'host']
+    assert tasks.get(first['task'])['state'] == 'finished'
+
+    scheduler.done(stream['pid'], 1)
+    assert tasks.get(stream['task'])['state'] == 'failed'
+    assert launch.started[-1][:2] == ['-f', 'b.csv']
+    assert scheduler.metrics() == {'queued': 0, 'running': 1, 'submitted': 3, 'finished': 2}
+
+def test_cancelled_and_maintenance():
+    tasks = FakeTasks()
+    launch = Launcher()
+    scheduler = JobScheduler(launch, max_running=1, task_manager=tasks)
+
+    scheduler.submit(['-f', 'a.csv'])
+    queued = scheduler.submit(['-f', 'b.csv'])
+    tasks.end(queued['task'], state='cancelled')
+    # Jobs without a task don't wait for a slot
+    reset = scheduler.submit(['--reset-db', '--init-db'])
+    assert reset['pid'] == 102
+
+    scheduler.done(101, 0)
+    assert len(launch.started) == 2
+    assert scheduler.metrics()['queued'] == 0
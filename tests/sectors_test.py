@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from datetime import timedelta
+from purple.sectors import RollingWindow, SectorTracker
+
+def test_rolling_window_expiry():
+    window = RollingWindow(size=10)
+    for minute in range(30):
+        window.add(minute, 100, 0.0)
+    assert window.volume == 1000
+    assert window.trades == 10
+    assert len(window.buckets) == 10
+
+def test_rolling_window_completed_bucket():
+    window = RollingWindow(size=10)
+    assert window.add(0, 100, 0.0) is None
+    window.add(0, 50, 0.0)
+    assert window.add(1, 10, 0.0) == (0, 150, 0.0, 2)
+
+def test_sector_stats(make_trade):
+    tracker = SectorTracker()
+    tracker.add(make_trade('A.L', 100.0, 0), 1)
+    tracker.add(make_trade('A.L', 110.0, 1), 2)
+    tracker.add(make_trade('B.L', 50.0, 1), 3)
+    stats = tracker.sector_stats('Financial')
+    assert stats['volume'] == 3000
+    assert stats['symbols'] == 2
+    assert round(stats['return'], 4) == round((1.1 ** 0.5) - 1, 4)
+
+def test_sector_deviation(make_trade):
+    tracker = SectorTracker(min_symbols=3)
+    symbols = ['S{}.L'.format(i) for i in range(10)]
+    anomalies = []
+    for minute in range(10):
+        for i, symbol in enumerate(symbols):
+            price = 100.0 + (minute * (1 + i % 3) * 0.01)
+            anomalies += tracker.add(make_trade(symbol, price, minute), minute * 10 + i)
+    assert anomalies == []
+    anomalies = tracker.add(make_trade('S0.L', 200.0, 11), 100)
+    assert [a['error_code'] for a in anomalies] == ['SD']
+    # no repeated alert while the symbol stays deviated
+    assert tracker.add(make_trade('S0.L', 200.0, 11), 101) == []
+
+def test_sector_volume_spike(make_trade):
+    tracker = SectorTracker(warmup=30)
+    for minute in range(40):
+        tracker.add(make_trade('A.L', 100.0, minute, size=1000 + minute % 5), minute)
+    tracker.add(make_trade('A.L', 100.0, 40, size=10 ** 7), 40)
+    anomalies = tracker.add(make_trade('A.L', 100.0, 41), 41)
+    assert 'SVS' in [a['error_code'] for a in anomalies]
+
+def hourly_spike(trade, hour):
+    # Hourly volume spike of the hour starting with trade, `hour` hours after the
+    # first trade of its symbol
+    start = trade.time.replace(minute=0)
+    return {'id': -1, 'time': hour, 'description': 'Hourly volume spike from {} to {} for {}'.format(hour, hour + 1, trade.symbol),
+            'error_code': 'VS', 'severity': 3, 'symbol': trade.symbol, 'from': start, 'to': start + timedelta(hours=1)}
+
+def test_collapse(make_trade):
+    tracker = SectorTracker(min_symbols=3)
+    anomalies = []
+    for i in range(3):
+        trade = make_trade('S{}.L'.format(i), 100.0, 0)
+        tracker.add(trade, i)
+        anomalies.append(dict(hourly_spike(trade, 1), severity=3 - i))
+    collapsed = tracker.collapse(anomalies)
+    assert len(collapsed) == 1
+    assert collapsed[0]['error_code'] == 'VS-S'
+    assert collapsed[0]['severity'] == 1
+    assert collapsed[0]['symbols'] == ['S0.L', 'S1.L', 'S2.L']
+    assert collapsed[0]['from'] == anomalies[0]['from']
+    assert collapsed[0]['to'] == anomalies[0]['to']
+
+def test_collapse_by_window(make_trade):
+    # Hour 3 of symbols that opened two hours apart are different hours
+    tracker = SectorTracker(min_symbols=3)
+    early = [make_trade('S{}.L'.format(i), 100.0, 120) for i in range(3)]
+    late = [make_trade('L{}.L'.format(i), 100.0, 240) for i in range(3)]
+    for i, trade in enumerate(early + late):
+        tracker.add(trade, i)
+    collapsed = tracker.collapse([hourly_spike(trade, 3) for trade in early + late])
+    assert [a['symbols'] for a in collapsed] == [['S0.L', 'S1.L', 'S2.L'], ['L0.L', 'L1.L', 'L2.L']]
+    # Without a window, hour indexes of different symbols are never merged
+    anomalies = [dict(hourly_spike(trade, 3)) for trade in early]
+    for anomaly in anomalies:
+        del anomaly['from'], anomaly['to']
+    assert tracker.collapse(anomalies) == anomalies
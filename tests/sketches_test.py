@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import random
+import pytest
+from purple.sketches import QuantileSketch, robust_centre_scale
+
+def uniform_sketch(start, stop, compression=100):
+    sketch = QuantileSketch(compression=compression)
+    for value in range(start, stop):
+        sketch.add(value)
+    return sketch
+
+def test_quantiles():
+    sketch = uniform_sketch(0, 10001)
+    assert abs(sketch.median() - 5000) < 50
+    assert abs(sketch.quantile(0.99) - 9900) < 20
+    assert sketch.quantile(0) == 0
+    assert sketch.quantile(1) == 10000
+
+def test_bounded_memory():
+    sketch = uniform_sketch(0, 100000, compression=50)
+    assert len(sketch.centroids) + len(sketch.buffer) < 50 * 10
+
+def test_mad():
+    # MAD of uniform 0..10000 is 2500
+    sketch = uniform_sketch(0, 10001)
+    assert abs(sketch.mad() - 2500) < 50
+
+def test_mad_skewed():
+    # Exact MAD of an exponential sample, within the sketch's error
+    rand = random.Random(2)
+    values = sorted(rand.expovariate(1) for _ in range(20000))
+    median = values[len(values) // 2]
+    exact = sorted(abs(value - median) for value in values)[len(values) // 2]
+    sketch = QuantileSketch()
+    for value in values:
+        sketch.add(value)
+    assert abs(sketch.mad() - exact) < exact * 0.02
+
+def test_merge():
+    merged = uniform_sketch(0, 5000).merge(uniform_sketch(5000, 10001))
+    assert merged.count == 10001
+    assert abs(merged.median() - 5000) < 50
+    assert merged.min == 0 and merged.max == 10000
+
+def test_robust_to_outliers():
+    rand = random.Random(1)
+    sketch = QuantileSketch()
+    for _ in range(5000):
+        sketch.add(rand.gauss(0, 1))
+    sketch.add(1e6)
+    centre, scale = robust_centre_scale(sketch)
+    assert abs(centre) < 0.1
+    assert abs(scale - 1) < 0.1
+
+def test_serialise():
+    sketch = uniform_sketch(0, 1001)
+    copy = QuantileSketch.from_dict(sketch.to_dict())
+    assert copy.median() == sketch.median()
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pytest
+from purple.finance import Trade
+from purple.spill import SymbolSpill
+from purple.anomalous_trade_finder import AnomalousTradeFinder
+
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+TRADE_ROW1 = '2017-01-13 15:26:51.272423,j.lewis@jlb.com,h.smith@bank.com,473.53,10000,GBX,AV.L,Financial,472.68,473.53'
+TRADE_ROW2 = '2017-01-13 15:26:54.258723,m.williams@fake.com,q.fake@fake.biz,474.12,12000,GBX,ANTO.L,Financial,473.98,474.12'
+t = Trade(TRADE_ROW)
+t1 = Trade(TRADE_ROW1)
+t2 = Trade(TRADE_ROW2)
+
+def test_spill_round_trip():
+    spill = SymbolSpill(buffer_rows=1)
+    finder = AnomalousTradeFinder(spill=spill)
+    finder.add(t, 1)
+    finder.add(t1, 2)
+    finder.add(t2, 3)
+    assert finder.trade_history == {}
+    assert sorted(spill.symbols()) == ['ANTO.L', 'AV.L']
+
+    rows = spill.load('AV.L')
+    assert [row['id'] for row in rows] == [1, 2]
+    assert rows[1]['price_delta'] == 3.79
+    assert rows[0]['time'] == t.time
+    assert rows[1]['volume'] == 10000
+    spill.close()
+    assert not os.path.exists(spill.directory)
+
+def test_spill_matches_memory():
+    memory = AnomalousTradeFinder()
+    spill = SymbolSpill()
+    spilled = AnomalousTradeFinder(spill=spill)
+    for i, trade in enumerate([t, t1, t2]):
+        memory.add(trade, i)
+        spilled.add(trade, i)
+    for symbol in memory.trade_history:
+        assert spill.load(symbol) == memory.trade_history[symbol]
+    spill.close()
+
+def test_spill_first_day():
+    spill = SymbolSpill()
+    finder = AnomalousTradeFinder(persist=False, spill=spill)
+    memory = AnomalousTradeFinder(persist=False)
+    for i, trade in enumerate([t, t1, Trade(TRADE_ROW1.replace('15:26:51', '15:26:59'))]):
+        finder.add(trade, i)
+        memory.add(trade, i)
+    assert finder.calculate_anomalies_first_day(True) == memory.calculate_anomalies_first_day(True)
+    assert finder.stats['AV.L']['delta_mean'] == memory.stats['AV.L']['delta_mean']
+    assert finder.spill is None
+    assert not os.path.exists(spill.directory)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+import threading
+import multiprocessing
+import pytest
+from purple.splitter import symbol_of, partition_of, FeedSplitter, PipeSink, RelaySink, RELAY_HEADER
+
+TRADE_ROW = '2017-01-13 15:26:41.917266,w.tuffnell@janestreetcap.com,j.newbury@citadel.com,469.74,15952,GBX,AV.L,Financial,469.08,469.74'
+TRADE_ROW1 = '2017-01-13 15:26:54.258723,m.williams@fake.com,q.fake@fake.biz,474.12,12000,GBX,ANTO.L,Financial,473.98,474.12'
+
+class ListSink:
+    def __init__(self):
+        self.lines = []
+
+    def send(self, lines):
+        self.lines.extend(lines)
+
+    def close(self):
+        pass
+
+def test_symbol_of():
+    assert symbol_of(TRADE_ROW) == 'AV.L'
+    assert symbol_of('broken') == ''
+
+def test_partition_of():
+    # Stable and within range
+    assert partition_of('AV.L', 4) == partition_of('AV.L', 4)
+    assert all(0 <= partition_of(s, 3) < 3 for s in ['AV.L', 'ANTO.L', 'AAL.L', 'BP.L'])
+    assert partition_of('AV.L', 1) == 0
+
+def test_dispatch():
+    sinks = [ListSink(), ListSink()]
+    splitter = FeedSplitter('127.0.0.1', 0, sinks)
+    for line in [TRADE_ROW, TRADE_ROW1, TRADE_ROW]:
+        splitter.dispatch(line)
+    splitter.flush()
+
+    k = partition_of('AV.L', 2)
+    assert sinks[k].lines.count(TRADE_ROW) == 2
+    # A symbol only ever goes to one partition
+    assert TRADE_ROW not in sinks[1 - k].lines
+    assert sum(splitter.lines) == 3
+
+def test_pipe_sink():
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    sink = PipeSink(writer)
+    sink.send([TRADE_ROW, TRADE_ROW1])
+    sink.close()
+    assert reader.recv_bytes().split('\n') == [TRADE_ROW, TRADE_ROW1]
+    # Empty message once closed
+    assert reader.recv_bytes() == ''
+
+def test_relay_sink():
+    sink = RelaySink(0, host='127.0.0.1')
+    received = []
+
+    def consume():
+        client = socket.create_connection(('127.0.0.1', sink.port))
+        data = ''
+        while data.count('\n') < 2:
+            data += client.recv(4096)
+        received.extend(data.split('\n')[:2])
+        client.close()
+
+    thread = threading.Thread(target=consume)
+    thread.daemon = True
+    thread.start()
+    sink.send([TRADE_ROW])
+    thread.join(5)
+    sink.close()
+    assert received == [RELAY_HEADER, TRADE_ROW]
+
+def test_relay_sink_without_consumer():
+    # Sending never waits for a consumer, batches are shed once the queue is full
+    sink = RelaySink(0, host='127.0.0.1', queue_size=2)
+    for _ in range(3):
+        sink.send([TRADE_ROW])
+    assert sink.queue.shed == 1
+    sink.close()
+
+def test_reconnect_backoff():
+    # A feed accepting connections and closing them at once
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    server.settimeout(0.1)
+    splitter = FeedSplitter('127.0.0.1', server.getsockname()[1], [ListSink()])
+    thread = threading.Thread(target=splitter.run)
+    thread.daemon = True
+    thread.start()
+    connections = 0
+    deadline = time.time() + 1.5
+    while time.time() < deadline:
+        try:
+            client, _ = server.accept()
+        except socket.timeout:
+            continue
+        client.close()
+        connections += 1
+    splitter.stop()
+    server.close()
+    # Waits of 0.5s and more between attempts, not a tight loop
+    assert 1 <= connections <= 4
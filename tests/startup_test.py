@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import subprocess
+import pytest
+
+HEAVY_MODULES = ('sqlalchemy', 'numpy', 'rethinkdb', 'psycopg2', 'purple.app')
+
+def python(code):
+    return subprocess.check_output([sys.executable, '-c', code]).strip().split('\n')
+
+def test_help_imports_nothing_heavy():
+    output = python(
+        'import sys\n'
+        'sys.argv = ["main.py", "--help"]\n'
+        'import main\n'
+        'try:\n'
+        '    main.main()\n'
+        'except SystemExit:\n'
+        '    pass\n'
+        'print "loaded:" + " ".join(m for m in {} if m in sys.modules)\n'.format(HEAVY_MODULES)
+    )
+    assert output[0].startswith('usage')
+    assert output[-1] == 'loaded:'
+
+def test_lazy_engine():
+    output = python(
+        'import sys\n'
+        'from purple import db\n'
+        'db.engine.dispose()\n'
+        'print db.engine.engine is None, "psycopg2" in sys.modules\n'
+    )
+    assert output == ['True False']
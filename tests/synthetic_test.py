@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import time
+import socket
+from StringIO import StringIO
+from purple.finance import Trade
+from purple.synthetic import generate, ReplayServer, HEADER
+
+def generated(seed=1):
+    f = StringIO()
+    events = generate(f, trades=2000, symbols=10, days=2, events=4, seed=seed)
+    return f.getvalue(), events
+
+def test_generate():
+    csv, events = generated()
+    assert (csv, events) == generated()
+    assert csv != generated(2)[0]
+
+    lines = csv.split('\n')[:-1]
+    assert lines[0] + '\n' == HEADER
+    trades = [Trade(line) for line in lines[1:]]
+    assert not any(t.parse_err for t in trades)
+    assert len(set(t.symbol for t in trades)) == 10
+    # Two week days (2017-03-08 is a Wednesday), in order
+    assert sorted(set(t.time.date().isoformat() for t in trades)) == ['2017-03-08', '2017-03-09']
+    assert [t.time for t in trades] == sorted(t.time for t in trades)
+
+    assert sorted(set(e['code'] for e in events)) == ['FFP', 'FFV', 'PDBR', 'VS']
+    for event in events:
+        assert event['lines']
+        for line in event['lines']:
+            assert lines[line - 1].split(',')[6] == event['symbol']
+
+def test_replay(tmpdir):
+    path = str(tmpdir.join('trades.csv'))
+    rows = [
+        '2017-03-08 08:00:00.000000,a@b.com,c@d.com,1.0,10,GBX,AV.L,Financial,1.0,1.1',
+        '2017-03-08 08:00:01.000000,a@b.com,c@d.com,1.0,10,GBX,AV.L,Financial,1.0,1.1',
+        '2017-03-08 08:00:02.000000,a@b.com,c@d.com,1.0,10,GBX,AV.L,Financial,1.0,1.1',
+    ]
+    with open(path, 'w') as f:
+        f.write(HEADER + '\n'.join(rows) + '\n')
+    server = ReplayServer(path, rate=10)
+    server.start()
+    try:
+        started = time.time()
+        sock = socket.create_connection(('localhost', server.port))
+        received = ''
+        while True:
+            block = sock.recv(4096)
+            if not block:
+                break
+            received += block
+        # Two seconds of trades replayed ten times faster
+        assert time.time() - started >= 0.19
+        assert received == HEADER + '\n'.join(rows) + '\n'
+    finally:
+        server.stop()
@@ -17,4 +17,18 @@ def test_trade_parse_attr():
     # check number is correctly parsed (float)
     t = Trade(TRADE_ROW)
     assert t.price == 469.74
-    
\ No newline at end of file
+    
+def test_trade_from_values():
+    parsed = Trade(TRADE_ROW)
+    t = Trade.from_values(parsed.time, parsed.price, parsed.size, parsed.symbol, parsed.bid, parsed.ask)
+    assert t.parse_err == False
+    assert t.symbol == 'AV.L'
+    assert t.ask - t.bid == parsed.ask - parsed.bid
+
+def test_file_hash():
+    import hashlib
+    from purple.app import file_hash
+    with open('tests/test_csv.csv', 'r') as f:
+        expected = hashlib.sha1(f.read()).hexdigest()
+        assert file_hash(f) == expected
+    assert expected != hashlib.sha1().hexdigest()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import random
+from purple.tracing import LatencyHistogram, Tracer, monotonic
+
+def test_quantiles():
+    histogram = LatencyHistogram()
+    random.seed(4)
+    latencies = sorted(random.expovariate(100) for _ in range(10000))
+    for latency in latencies:
+        histogram.record(latency)
+    for q in (0.5, 0.99, 0.999):
+        exact = latencies[int(q * len(latencies)) - 1]
+        # Within a bucket (~4.4%)
+        assert abs(histogram.quantile(q) - exact) / exact < 0.05
+    assert histogram.quantile(1) == latencies[-1]
+    # Fixed memory whatever the number of latencies
+    assert len(histogram.counts) == LatencyHistogram().size
+
+def test_slow_traces():
+    tracer = Tracer(slow=1.0, interval=10)
+    fast = {'received': 0.0, 'parse': 0.001, 'queue': 0.002, 'detection': 0.003, 'commit': 0.05}
+    tracer.finish(fast, 1, 'AV.L')
+    slow = {'received': 1.0, 'parse': 1.001, 'queue': 2.5, 'detection': 2.501, 'alert': 2.6, 'commit': 3.0}
+    tracer.finish(slow, 2, 'AV.L')
+    # Sampled at most once per interval
+    tracer.finish(dict(slow, commit=4.0), 3, 'AV.L')
+    metrics = tracer.metrics()
+    assert metrics['slow_trades'] == 2
+    assert len(metrics['slow_traces']) == 1
+    trace = metrics['slow_traces'][0]
+    assert trace['trade_pk'] == 2
+    assert round(trace['stages']['queue']) == 1500
+    assert metrics['stages']['commit']['items'] == 3
+    assert metrics['stages']['alert']['items'] == 2
+
+def test_monotonic():
+    first = monotonic()
+    assert monotonic() >= first